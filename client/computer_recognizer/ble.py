@@ -1,17 +1,42 @@
 import asyncio
+import base64
+import hashlib
+import hmac
 import json
+import os
+import time
 import requests
 from datetime import datetime
 from bleak import BleakClient, BleakScanner
 from PIL import Image
 import io
 
+try:
+    # Necessari solo per la modalità encoding locale
+    import face_recognition
+    import numpy as np
+    from gallery_replica import GalleryReplica
+except ImportError:
+    face_recognition = None
+
 # UUIDs dei servizi e caratteristiche
 SERVICE_UUID = "4fafc201-1fb5-459e-8fcc-c5c9c331914b"
 IMAGE_UUID = "beb5483e-36e1-4688-b7f5-ea07361b26a8"
 DATA_UUID = "80dcca86-d593-484b-8b13-72db9d98faea"
 CONTROL_UUID = "a9da86e1-4456-4bea-b82d-b7a8e834bb0a"
 
+RECOGNIZE_TIMEOUT = 10  # Secondi prima di rinunciare al riconoscimento
+
+# Modalità encoding locale: il gateway calcola l'encoding e invia ~1 KB invece della foto
+LOCAL_ENCODING = os.environ.get("GATEWAY_LOCAL_ENCODING", "0") == "1"
+GATEWAY_ID = os.environ.get("GATEWAY_ID", "")
+GATEWAY_KEY = os.environ.get("GATEWAY_KEY", "")
+
+# Replica offline della gallery (richiede la modalità encoding locale)
+OFFLINE_REPLICA = os.environ.get("GATEWAY_OFFLINE_REPLICA", "0") == "1"
+REPLICA_PATH = os.environ.get("GATEWAY_REPLICA_PATH", "gallery_replica.db")
+REPLICA_SYNC_INTERVAL = 60  # Secondi tra due sincronizzazioni
+
 # Variabili globali per i dati dell'immagine
 image_buffer = bytearray()
 image_size = 0
@@ -21,6 +46,7 @@ transfer_active = False
 image_metadata_received = False
 chunks_received = set()
 client_instance = None
+replica = None
 
 
 def get_server_url():
@@ -152,8 +178,11 @@ def save_and_process_image():
         flipped_img.save(img_byte_arr, format="JPEG")
         img_byte_arr = img_byte_arr.getvalue()
 
-        # Invia immagine al server
-        asyncio.create_task(send_image_to_server(img_byte_arr))
+        # Invia l'encoding (se calcolabile in locale) o l'immagine al server
+        if LOCAL_ENCODING and face_recognition and GATEWAY_KEY:
+            asyncio.create_task(send_encoding_to_server(flipped_img, img_byte_arr))
+        else:
+            asyncio.create_task(send_image_to_server(img_byte_arr))
 
         # Mostra l'immagine localmente
         flipped_img.show()
@@ -172,7 +201,11 @@ async def send_image_to_server(image_bytes):
         files = {"image": ("image.jpg", image_bytes, "image/jpeg")}
 
         print("Invio foto al server...")
-        response = requests.post(url, files=files, timeout=10)
+        # Il server abbandona il lavoro se la risposta arriverebbe troppo tardi
+        headers = {"X-Request-Deadline-Ms": str((RECOGNIZE_TIMEOUT - 1) * 1000)}
+        response = requests.post(
+            url, files=files, headers=headers, timeout=RECOGNIZE_TIMEOUT
+        )
 
         if response.status_code == 200:
             data = response.json()
@@ -192,6 +225,139 @@ async def send_image_to_server(image_bytes):
         print(f"Errore nell'invio dell'immagine: {str(e)}")
 
 
+def sign_request(method, path, body, query=""):
+    """Header di autenticazione HMAC del gateway (stessa formula del server)"""
+    timestamp = str(int(time.time()))
+    message = f"{method}\n{path}\n{query}\n{timestamp}\n".encode("utf-8") + body
+    signature = hmac.new(
+        GATEWAY_KEY.encode("utf-8"), message, hashlib.sha256
+    ).hexdigest()
+    return {
+        "X-Gateway-Id": GATEWAY_ID,
+        "X-Timestamp": timestamp,
+        "X-Signature": signature,
+    }
+
+
+def encoding_version():
+    """Versione e impostazioni di encoding del server, note dall'ultima sincronizzazione"""
+    if replica is None:
+        return None, {}
+    tag, settings = replica.encoding_version()
+    return tag, settings or {}
+
+
+def compute_encoding(img, settings):
+    """Encoding del volto calcolato sul gateway (None se non c'è un solo volto)"""
+    image = np.array(img.convert("RGB"))
+    face_locations = face_recognition.face_locations(
+        image,
+        number_of_times_to_upsample=settings.get("upsample", 1),
+        model=settings.get("detection_model", "hog"),
+    )
+    if len(face_locations) != 1:
+        print(f"Volti rilevati: {len(face_locations)}, serve esattamente un volto")
+        return None
+    return face_recognition.face_encodings(
+        image,
+        face_locations,
+        num_jitters=settings.get("jitters", 1),
+        model=settings.get("encoding_model", "small"),
+    )[0]
+
+
+async def send_encoding_to_server(img, image_bytes):
+    """Invia al server solo l'encoding del volto, firmato con la chiave del gateway"""
+    try:
+        version, settings = encoding_version()
+        encoding = await asyncio.to_thread(compute_encoding, img, settings)
+    except Exception as e:
+        print(f"Encoding locale non riuscito ({e}), invio della foto...")
+        await send_image_to_server(image_bytes)
+        return
+    if encoding is None:
+        return
+
+    try:
+        path = "/recognize-encoding"
+        payload = {
+            "encoding": base64.b64encode(
+                np.asarray(encoding, dtype="<f4").tobytes()
+            ).decode("ascii")
+        }
+        if version is not None:
+            # Il server rifiuta (409) encoding calcolati con un'altra versione
+            payload["encoding_version"] = version
+        body = json.dumps(payload).encode("utf-8")
+        headers = sign_request("POST", path, body)
+        headers["Content-Type"] = "application/json"
+        headers["X-Request-Deadline-Ms"] = str((RECOGNIZE_TIMEOUT - 1) * 1000)
+
+        print(f"Invio encoding al server ({len(body)} byte)...")
+        try:
+            response = requests.post(
+                f"{get_server_url()}{path}",
+                data=body,
+                headers=headers,
+                timeout=RECOGNIZE_TIMEOUT,
+            )
+        except (requests.ConnectionError, requests.Timeout):
+            if replica is None:
+                raise
+            recognize_offline(encoding)
+            return
+
+        if response.status_code == 200:
+            data = response.json()
+            patient_id = data.get("id")
+            confidence = data.get("confidence", 0)
+
+            if patient_id:
+                print(
+                    f"Paziente riconosciuto (ID: {patient_id}, conf: {confidence:.2f})"
+                )
+                await fetch_patient_data(patient_id)
+            else:
+                print("Paziente non riconosciuto")
+        elif response.status_code == 409 and replica is not None:
+            # Il server è passato a una nuova versione: si riallinea la replica
+            print("Versione di encoding cambiata, sincronizzazione della replica...")
+            await asyncio.to_thread(replica.sync)
+        else:
+            print(f"Errore: {response.status_code}")
+    except Exception as e:
+        print(f"Errore nell'invio dell'encoding: {str(e)}")
+
+
+def recognize_offline(encoding):
+    """Riconoscimento sulla replica locale quando il server non risponde"""
+    patient_id, confidence = replica.match(np.asarray(encoding))
+    replica.record(patient_id, confidence)
+    if patient_id:
+        # La replica non contiene dati anagrafici: solo l'identificativo
+        print(
+            f"[offline] Paziente riconosciuto (ID: {patient_id}, conf: {confidence:.2f})"
+        )
+    else:
+        print("[offline] Paziente non riconosciuto")
+
+
+async def replica_sync_loop():
+    """Sincronizza la replica e riconcilia il log offline a intervalli regolari"""
+    while True:
+        try:
+            applied = await asyncio.to_thread(replica.sync)
+            sent = await asyncio.to_thread(replica.flush_log)
+            if applied or sent:
+                print(
+                    f"Replica aggiornata: {applied} modifiche, "
+                    f"{sent} riconoscimenti offline inviati"
+                )
+        except Exception as e:
+            print(f"Sincronizzazione replica non riuscita: {e}")
+        await asyncio.sleep(REPLICA_SYNC_INTERVAL)
+
+
 async def fetch_patient_data(patient_id):
     """Recupera i dati del paziente dal server"""
     try:
@@ -242,7 +408,11 @@ async def request_next_chunk(client):
 
 
 async def main():
-    global client_instance
+    global client_instance, replica
+
+    if OFFLINE_REPLICA and LOCAL_ENCODING and face_recognition and GATEWAY_KEY:
+        replica = GalleryReplica(REPLICA_PATH, get_server_url(), sign_request)
+        asyncio.create_task(replica_sync_loop())
 
     print("Ricerca del dispositivo EWatch...")
 
@@ -0,0 +1,252 @@
+"""Replica locale della gallery di encoding per i gateway BLE.
+
+Contiene solo gli encoding (e le partizioni), mai l'anagrafica dei pazienti.
+Si aggiorna in modo incrementale da /gallery/changes e, quando il server non è
+raggiungibile, permette il riconoscimento locale; i riconoscimenti fatti offline
+restano in coda e vengono inviati a /gallery/access-log al ritorno della rete.
+"""
+
+import base64
+import json
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+
+import numpy as np
+import requests
+
+SIMILARITY_THRESHOLD = 0.6  # Stessa soglia del server
+SYNC_TIMEOUT = 30
+LOG_BATCH_SIZE = 500
+
+
+class GalleryReplica:
+    """Gallery locale sincronizzata per numero di sequenza"""
+
+    def __init__(self, path, server_url, sign_request):
+        self.path = path
+        self.server_url = server_url.rstrip("/")
+        self.sign_request = sign_request
+        self.lock = threading.Lock()
+        self.ids = []
+        self.matrix = None
+        self.init_database()
+        self.reload()
+
+    def init_database(self):
+        conn = sqlite3.connect(self.path)
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS replica_meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS encodings (
+                patient_id TEXT PRIMARY KEY,
+                encoding BLOB NOT NULL,
+                partitions TEXT
+            )
+        """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pending_log (
+                entry_id TEXT PRIMARY KEY,
+                patient_id TEXT,
+                confidence REAL,
+                recognized_at TEXT,
+                success INTEGER
+            )
+        """
+        )
+        conn.commit()
+        conn.close()
+
+    def reload(self):
+        """Ricostruisce la matrice in memoria dal database locale"""
+        conn = sqlite3.connect(self.path)
+        rows = conn.execute("SELECT patient_id, encoding FROM encodings").fetchall()
+        conn.close()
+
+        with self.lock:
+            self.ids = [patient_id for patient_id, _ in rows]
+            self.matrix = (
+                np.array([np.frombuffer(blob, dtype="<f4") for _, blob in rows])
+                if rows
+                else None
+            )
+
+    def last_seq(self):
+        conn = sqlite3.connect(self.path)
+        row = conn.execute(
+            "SELECT value FROM replica_meta WHERE key = 'last_seq'"
+        ).fetchone()
+        conn.close()
+        return int(row[0]) if row else 0
+
+    def encoding_version(self):
+        """Tag e impostazioni degli encoding della replica (None se mai sincronizzata)"""
+        conn = sqlite3.connect(self.path)
+        rows = dict(
+            conn.execute(
+                """
+                SELECT key, value FROM replica_meta
+                WHERE key IN ('encoding_version', 'encoding_settings')
+            """
+            ).fetchall()
+        )
+        conn.close()
+        if "encoding_settings" not in rows:
+            return None, None
+        return rows.get("encoding_version", ""), json.loads(rows["encoding_settings"])
+
+    def get(self, path, params):
+        query = "&".join(f"{key}={value}" for key, value in params.items())
+        response = requests.get(
+            f"{self.server_url}{path}?{query}",
+            headers=self.sign_request("GET", path, b"", query),
+            timeout=SYNC_TIMEOUT,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def post(self, path, payload):
+        body = json.dumps(payload).encode("utf-8")
+        headers = self.sign_request("POST", path, body)
+        headers["Content-Type"] = "application/json"
+        response = requests.post(
+            f"{self.server_url}{path}", data=body, headers=headers, timeout=SYNC_TIMEOUT
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def sync(self):
+        """Scarica le modifiche dopo l'ultima sequenza applicata. Restituisce quante"""
+        applied = 0
+        since = self.last_seq()
+
+        while True:
+            page = self.get("/gallery/changes", {"since": since})
+
+            # Ogni pagina è applicata in una transazione insieme alla nuova sequenza
+            conn = sqlite3.connect(self.path)
+            with conn:
+                for change in page["changes"]:
+                    if change["op"] == "reset":
+                        # Nuova versione di encoding: seguono gli "add" di tutti
+                        conn.execute("DELETE FROM encodings")
+                    elif change["op"] == "add":
+                        conn.execute(
+                            """
+                            INSERT OR REPLACE INTO encodings
+                            (patient_id, encoding, partitions) VALUES (?, ?, ?)
+                        """,
+                            (
+                                change["id"],
+                                base64.b64decode(change["encoding"]),
+                                json.dumps(change.get("partitions", [])),
+                            ),
+                        )
+                    else:
+                        conn.execute(
+                            "DELETE FROM encodings WHERE patient_id = ?",
+                            (change["id"],),
+                        )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO replica_meta (key, value) VALUES (?, ?)",
+                    [
+                        ("last_seq", str(page["next_since"])),
+                        ("encoding_version", page.get("encoding_version", "")),
+                        (
+                            "encoding_settings",
+                            json.dumps(page.get("encoding_settings") or {}),
+                        ),
+                    ],
+                )
+            conn.close()
+
+            applied += len(page["changes"])
+            since = page["next_since"]
+            if not page["more"]:
+                break
+
+        if applied:
+            self.reload()
+        return applied
+
+    def match(self, target_encoding):
+        """Paziente più vicino nella replica: (patient_id, confidenza) o (None, 0.0)"""
+        with self.lock:
+            if self.matrix is None:
+                return None, 0.0
+            distances = np.linalg.norm(self.matrix - target_encoding, axis=1)
+            best = int(np.argmin(distances))
+            if distances[best] < SIMILARITY_THRESHOLD:
+                return self.ids[best], 1.0 - float(distances[best])
+        return None, 0.0
+
+    def record(self, patient_id, confidence):
+        """Accoda un riconoscimento offline da riconciliare con il server"""
+        conn = sqlite3.connect(self.path)
+        with conn:
+            conn.execute(
+                """
+                INSERT INTO pending_log
+                (entry_id, patient_id, confidence, recognized_at, success)
+                VALUES (?, ?, ?, ?, ?)
+            """,
+                (
+                    uuid.uuid4().hex,
+                    patient_id,
+                    confidence,
+                    datetime.now().isoformat(),
+                    1 if patient_id else 0,
+                ),
+            )
+        conn.close()
+
+    def flush_log(self):
+        """Invia i riconoscimenti offline in coda. Restituisce quanti ne ha inviati"""
+        sent = 0
+        while True:
+            conn = sqlite3.connect(self.path)
+            rows = conn.execute(
+                """
+                SELECT entry_id, patient_id, confidence, recognized_at, success
+                FROM pending_log ORDER BY recognized_at LIMIT ?
+            """,
+                (LOG_BATCH_SIZE,),
+            ).fetchall()
+            conn.close()
+            if not rows:
+                return sent
+
+            entries = [
+                {
+                    "entry_id": entry_id,
+                    "patient_id": patient_id,
+                    "confidence": confidence,
+                    "recognized_at": recognized_at,
+                    "success": success,
+                }
+                for entry_id, patient_id, confidence, recognized_at, success in rows
+            ]
+            result = self.post("/gallery/access-log", {"entries": entries})
+
+            # Si cancellano solo le voci confermate (anche se già ricevute prima)
+            conn = sqlite3.connect(self.path)
+            with conn:
+                conn.executemany(
+                    "DELETE FROM pending_log WHERE entry_id = ?",
+                    [(entry_id,) for entry_id in result["acknowledged"]],
+                )
+            conn.close()
+            sent += len(result["acknowledged"])
+            if len(result["acknowledged"]) < len(rows):
+                return sent
@@ -12,7 +12,7 @@ from kivy.clock import mainthread, Clock
 from kivy.utils import platform
 from kivy.logger import Logger
 from settings_screen import SettingsScreen
-from settings_screen import get_server_url
+from settings_screen import get_server_url, get_request_headers
 from camera_widget import CameraWidget
 from ble_screen import BleScreen
 
@@ -27,6 +27,8 @@ import requests
 import os
 import asyncio
 
+RECOGNIZE_TIMEOUT = 10  # Secondi prima di rinunciare al riconoscimento
+
 
 class RecognizeScreen(Screen):
     def __init__(self, **kwargs):
@@ -123,7 +125,10 @@ class RecognizeScreen(Screen):
             files = {"image": ("image.jpg", self.photo_bytes, "image/jpeg")}
 
             self.update_status("Invio foto al server...")
-            response = requests.post(url, files=files, timeout=10)
+            headers = get_request_headers(RECOGNIZE_TIMEOUT)
+            response = requests.post(
+                url, files=files, headers=headers, timeout=RECOGNIZE_TIMEOUT
+            )
 
             if response.status_code == 200:
                 data = response.json()
@@ -3,6 +3,7 @@ from kivy.uix.screenmanager import Screen
 from kivy.uix.textinput import TextInput
 from kivy.uix.button import Button
 from kivy.uix.label import Label
+from kivy.uix.spinner import Spinner
 from kivy.clock import mainthread
 from kivy.storage.jsonstore import JsonStore
 
@@ -12,6 +13,13 @@ import threading, requests
 DEFAULT_SERVER_IP = "192.168.25.45"
 DEFAULT_SERVER_PORT = "5000"
 
+# Classi di priorità riconosciute dal server (header X-Priority)
+PRIORITY_CLASSES = ["emergency", "routine", "bulk"]
+DEFAULT_PRIORITY = "routine"
+
+# Margine sottratto al timeout HTTP nella deadline comunicata al server
+DEADLINE_MARGIN_SECONDS = 1
+
 # Store per salvare le impostazioni
 store = JsonStore("settings.json")
 
@@ -27,6 +35,32 @@ def get_server_url():
     return f"http://{ip}:{port}"
 
 
+def get_request_priority():
+    """Ottiene la classe di priorità configurata per le richieste al server"""
+    if store.exists("priority"):
+        return store.get("priority")["class"]
+    return DEFAULT_PRIORITY
+
+
+def get_partitions():
+    """Partizioni (struttura/reparto) del dispositivo, separate da virgola"""
+    if store.exists("partitions"):
+        return store.get("partitions")["value"]
+    return ""
+
+
+def get_request_headers(timeout):
+    """Header comuni: priorità, partizioni e tempo residuo prima di rinunciare"""
+    deadline_ms = max(0, int((timeout - DEADLINE_MARGIN_SECONDS) * 1000))
+    headers = {
+        "X-Priority": get_request_priority(),
+        "X-Request-Deadline-Ms": str(deadline_ms),
+    }
+    if get_partitions():
+        headers["X-Partitions"] = get_partitions()
+    return headers
+
+
 def get_app_storage_path():
     """Ottiene il percorso di storage interno dell'app"""
     if platform == "android":
@@ -68,6 +102,31 @@ class SettingsScreen(Screen):
         self.port_input = TextInput(multiline=False, size_hint_y=None, height="40dp")
         layout.add_widget(self.port_input)
 
+        # Priorità delle richieste
+        priority_label = Label(
+            text="Priorità richieste:", size_hint_y=None, height="40dp"
+        )
+        layout.add_widget(priority_label)
+
+        self.priority_input = Spinner(
+            text=DEFAULT_PRIORITY,
+            values=PRIORITY_CLASSES,
+            size_hint_y=None,
+            height="40dp",
+        )
+        layout.add_widget(self.priority_input)
+
+        # Partizioni (struttura/reparto) in cui registrare e cercare i pazienti
+        partitions_label = Label(
+            text="Reparti (separati da virgola):", size_hint_y=None, height="40dp"
+        )
+        layout.add_widget(partitions_label)
+
+        self.partitions_input = TextInput(
+            multiline=False, size_hint_y=None, height="40dp"
+        )
+        layout.add_widget(self.partitions_input)
+
         # URL corrente
         self.current_url_label = Label(text="", size_hint_y=None, height="40dp")
         layout.add_widget(self.current_url_label)
@@ -123,6 +182,8 @@ class SettingsScreen(Screen):
             self.ip_input.text = DEFAULT_SERVER_IP
             self.port_input.text = DEFAULT_SERVER_PORT
 
+        self.priority_input.text = get_request_priority()
+        self.partitions_input.text = get_partitions()
         self.update_current_url()
 
     def save_settings(self, instance):
@@ -144,6 +205,8 @@ class SettingsScreen(Screen):
             return
 
         store.put("server", ip=ip, port=port)
+        store.put("priority", **{"class": self.priority_input.text})
+        store.put("partitions", value=self.partitions_input.text.strip())
         self.status_label.text = "Impostazioni salvate!"
         self.update_current_url()
 
@@ -186,6 +249,8 @@ class SettingsScreen(Screen):
         """Reset alle impostazioni di default"""
         self.ip_input.text = DEFAULT_SERVER_IP
         self.port_input.text = DEFAULT_SERVER_PORT
+        self.priority_input.text = DEFAULT_PRIORITY
+        self.partitions_input.text = ""
         self.status_label.text = "Reset alle impostazioni di default"
         self.update_current_url()
 
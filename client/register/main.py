@@ -9,15 +9,20 @@ from kivy.uix.textinput import TextInput
 from kivy.uix.button import Button
 from kivy.uix.label import Label
 from kivy.uix.scrollview import ScrollView
+from kivy.uix.popup import Popup
 from kivy.clock import mainthread, Clock
 from kivy.utils import platform
 from settings_screen import SettingsScreen
-from settings_screen import get_server_url
+from settings_screen import get_server_url, get_request_headers
 from camera_widget import CameraWidget
 from kivy.core.window import Window
 
 import io, threading, requests
 
+REGISTER_TIMEOUT = 30  # Secondi prima di rinunciare alla registrazione
+STATUS_POLL_WAIT = 20  # Long-poll sullo stato della registrazione in coda
+STATUS_POLL_ATTEMPTS = 6
+
 # Window.softinput_mode = "pan"  # Options: '', 'pan', 'scale', 'resize'
 
 
@@ -210,14 +215,27 @@ class RegisterScreen(Screen):
         try:
             server_url = get_server_url()
             files = {"foto": ("foto.jpg", io.BytesIO(self.photo_bytes), "image/jpeg")}
+            headers = get_request_headers(REGISTER_TIMEOUT)
             r = requests.post(
-                f"{server_url}/register", data=payload, files=files, timeout=30
+                f"{server_url}/register",
+                data=payload,
+                files=files,
+                headers=headers,
+                timeout=REGISTER_TIMEOUT,
             )
 
-            if r.status_code == 200:
+            if r.status_code == 202:
+                # Registrazione in coda: si attende l'esito dal server
+                self._show_result("Registration queued, processing photo...")
+                self._wait_for_job(server_url, r.json()["job_id"])
+            elif r.status_code == 200:
                 resp = r.json()
                 self._show_result(f"✓ Successfully registered! ID: {resp.get('id')}")
                 self._clear_form()
+            elif (
+                r.status_code == 409 and r.json().get("status") == "duplicate_suspected"
+            ):
+                self._ask_duplicate(server_url, r.json())
             else:
                 self._show_result(f"✗ Server error: {r.text}")
         except requests.exceptions.ConnectTimeout:
@@ -227,6 +245,82 @@ class RegisterScreen(Screen):
         except Exception as e:
             self._show_result(f"✗ Errore: {str(e)}")
 
+    def _wait_for_job(self, server_url, job_id):
+        """Long-poll su /register-status finché il job non è concluso"""
+        for _ in range(STATUS_POLL_ATTEMPTS):
+            r = requests.get(
+                f"{server_url}/register-status/{job_id}",
+                params={"wait": STATUS_POLL_WAIT},
+                timeout=STATUS_POLL_WAIT + 10,
+            )
+            if r.status_code != 200:
+                self._show_result(f"✗ Server error: {r.text}")
+                return
+
+            resp = r.json()
+            if resp["status"] == "done":
+                self._show_result(f"✓ Successfully registered! ID: {resp.get('id')}")
+                self._clear_form()
+                return
+            if resp["status"] == "failed":
+                self._show_result(f"✗ Registration failed: {resp.get('error')}")
+                return
+            if resp["status"] == "duplicate_suspected":
+                self._ask_duplicate(server_url, resp)
+                return
+            self._show_result(f"Registration {resp['status']}, please wait...")
+
+        self._show_result(f"Registration still pending (job {job_id})")
+
+    @mainthread
+    def _ask_duplicate(self, server_url, resp):
+        """Il server ha trovato pazienti simili: l'operatore decide"""
+        candidates = "\n".join(
+            f"{c['id']} ({c['confidence']:.0%})" for c in resp.get("candidates", [])
+        )
+        self.status.text = "Possible duplicate patient, waiting for confirmation"
+
+        content = BoxLayout(orientation="vertical", spacing=10, padding=10)
+        content.add_widget(
+            Label(text=f"This person may already be registered:\n{candidates}")
+        )
+        buttons = BoxLayout(size_hint_y=None, height="48dp", spacing=10)
+        popup = Popup(title="Possible duplicate", content=content, size_hint=(0.9, 0.6))
+
+        def decide(action):
+            popup.dismiss()
+            threading.Thread(
+                target=self._confirm_duplicate,
+                args=(server_url, resp["job_id"], action),
+            ).start()
+
+        btn_register = Button(text="Register as new patient")
+        btn_register.bind(on_press=lambda x: decide("register"))
+        btn_discard = Button(text="Discard")
+        btn_discard.bind(on_press=lambda x: decide("discard"))
+        buttons.add_widget(btn_register)
+        buttons.add_widget(btn_discard)
+        content.add_widget(buttons)
+        popup.open()
+
+    def _confirm_duplicate(self, server_url, job_id, action):
+        try:
+            r = requests.post(
+                f"{server_url}/register-confirm/{job_id}",
+                data={"action": action},
+                timeout=REGISTER_TIMEOUT,
+            )
+            if r.status_code == 202:
+                self._show_result("Registration confirmed, processing...")
+                self._wait_for_job(server_url, job_id)
+            elif r.status_code == 200:
+                self._show_result("Registration discarded")
+                self._clear_form()
+            else:
+                self._show_result(f"✗ Server error: {r.text}")
+        except requests.exceptions.RequestException:
+            self._show_result("✗ Unable to connect to server")
+
     @mainthread
     def _show_result(self, msg):
         self.status.text = msg
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Ricostruisce gli aggregati orari e giornalieri dal log dei riconoscimenti.
+
+Serve una volta per i log scritti prima di recognition_rollups, o dopo
+un'importazione fatta a mano. Procede un giorno alla volta: per ogni giorno
+cancella e ricalcola i suoi bucket in una transazione che tiene il lock di
+scrittura, così i riconoscimenti registrati intanto dal server non vanno persi
+né contati due volte. Si può eseguire con il server in funzione e ripetere.
+
+    python backfill_rollups.py --since 2024-01-01
+"""
+
+import argparse
+import sqlite3
+import time
+
+import face_server
+
+
+def rebuild_day(conn, day):
+    """Ricalcola i bucket del giorno. Restituisce le righe di log aggregate"""
+    # Tutte le righe il cui recognition_time inizia con il giorno ("~" segue "T" e " ")
+    day_range = (day, f"{day}~")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute(
+            """
+            DELETE FROM recognition_rollups
+            WHERE (granularity = 'day' AND bucket = ?)
+               OR (granularity = 'hour' AND bucket >= ? AND bucket < ?)
+        """,
+            (day,) + day_range,
+        )
+        for granularity, bucket_sql in face_server.ROLLUP_BUCKET_SQL.items():
+            conn.execute(
+                f"""
+                INSERT INTO recognition_rollups (granularity, bucket, recognitions,
+                                                 successes, confidence_sum, confidence_count)
+                SELECT ?, {bucket_sql}, COUNT(*),
+                       SUM(success != 0),
+                       TOTAL(CASE WHEN success != 0 THEN confidence END),
+                       COUNT(CASE WHEN success != 0 THEN confidence END)
+                FROM recognition_log
+                WHERE recognition_time >= ? AND recognition_time < ?
+                GROUP BY {bucket_sql}
+            """,
+                (granularity,) + day_range,
+            )
+        rows = conn.execute(
+            """
+            SELECT COALESCE(SUM(recognitions), 0) FROM recognition_rollups
+            WHERE granularity = 'day' AND bucket = ?
+        """,
+            (day,),
+        ).fetchone()[0]
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ricostruzione degli aggregati")
+    parser.add_argument("--since", help="Primo giorno da ricostruire (YYYY-MM-DD)")
+    args = parser.parse_args()
+
+    face_server.init_database()
+    conn = sqlite3.connect(face_server.DATABASE, isolation_level=None)
+    days = [
+        row[0]
+        for row in conn.execute(
+            """
+            SELECT DISTINCT substr(recognition_time, 1, 10) FROM recognition_log
+            WHERE recognition_time >= ? ORDER BY 1
+        """,
+            (args.since or "",),
+        )
+    ]
+    print(f"{len(days)} giorni da ricostruire")
+
+    started_at = time.time()
+    total = 0
+    for number, day in enumerate(days, start=1):
+        total += rebuild_day(conn, day)
+        if number % 30 == 0:
+            print(f"  {number} giorni, {total} riconoscimenti")
+    conn.close()
+    print(
+        f"Aggregati ricostruiti in {time.time() - started_at:.1f}s: "
+        f"{len(days)} giorni, {total} riconoscimenti"
+    )
+
+
+if __name__ == "__main__":
+    main()
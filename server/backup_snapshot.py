@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""Snapshot a caldo di database, encoding e foto, senza fermare il server.
+
+Il database è copiato con l'API di backup di SQLite, a passi di --pages
+pagine, tenendo aperta una transazione di lettura: in modalità WAL le
+scritture del server proseguono e la copia resta quella dell'istante
+iniziale. Nella stessa transazione si leggono i file a cui la copia fa
+riferimento (encoding, ritagli e originali delle foto, proiezione PCA), così
+l'archivio contiene esattamente la gallery alla sequenza gallery_changes
+indicata nel manifest. Encoding e foto non vengono mai riscritti, quindi si
+copiano dopo, senza lock.
+
+Database e file sono letti al più a --max-mb-per-second, perché il disco
+resti libero per i riconoscimenti. Il risultato è un .tar.gz con
+manifest.json, scritto con un nome temporaneo e rinominato solo a fine copia.
+Per il ripristino si estrae l'archivio nella cartella di face_server.py.
+
+    python backup_snapshot.py --output-dir backups --max-mb-per-second 20
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import tarfile
+import time
+from datetime import datetime
+
+import face_server
+
+MANIFEST_NAME = "manifest.json"
+COPY_BLOCK_BYTES = 1 << 20
+
+
+class Throttle:
+    """Limita i byte letti al secondo, dormendo quando si è in anticipo"""
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.started_at = time.time()
+        self.consumed = 0
+
+    def consume(self, size):
+        if not self.bytes_per_second:
+            return
+        self.consumed += size
+        ahead = self.consumed / self.bytes_per_second - (time.time() - self.started_at)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+class ThrottledReader:
+    """File in lettura per tarfile.addfile, al ritmo del Throttle"""
+
+    def __init__(self, source, throttle):
+        self.source = source
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.throttle.consume(len(data))
+        return data
+
+
+def snapshot_files(cursor, tag):
+    """File a cui fa riferimento il database (nella transazione dello snapshot)"""
+    paths = set()
+    cursor.execute("SELECT face_encoding_path, photo_path FROM patients")
+    for row in cursor.fetchall():
+        paths.update(path for path in row if path)
+    cursor.execute("SELECT original_path, crop_path FROM photos")
+    for row in cursor.fetchall():
+        paths.update(path for path in row if path)
+    projection = os.path.join(face_server.encodings_folder(tag), "pca_projection.npz")
+    if os.path.exists(projection):
+        paths.add(projection)
+    return sorted(paths)
+
+
+def backup_database(source, target_path, pages, throttle):
+    """Copia il database a passi, nella transazione di lettura già aperta"""
+    page_size = source.execute("PRAGMA page_size").fetchone()[0]
+    target = sqlite3.connect(target_path)
+    source.backup(
+        target,
+        pages=pages,
+        progress=lambda status, remaining, total: throttle.consume(pages * page_size),
+    )
+    target.close()
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for block in iter(lambda: source.read(COPY_BLOCK_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def archive_name(path):
+    """Percorso nell'archivio, relativo alla cartella del server"""
+    return os.path.normpath(path).lstrip(os.sep)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Snapshot a caldo del server")
+    parser.add_argument("--output-dir", default="backups")
+    parser.add_argument(
+        "--max-mb-per-second",
+        type=float,
+        default=20.0,
+        help="Limite di lettura dal disco (0 = nessuno)",
+    )
+    parser.add_argument(
+        "--pages", type=int, default=256, help="Pagine del database per passo"
+    )
+    parser.add_argument("--compress-level", type=int, default=6)
+    args = parser.parse_args()
+
+    face_server.init_database()
+    os.makedirs(args.output_dir, exist_ok=True)
+    name = f"face_snapshot_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    archive_path = os.path.join(args.output_dir, f"{name}.tar.gz")
+    temp_archive = f"{archive_path}.tmp"
+    temp_database = os.path.join(args.output_dir, f"{name}.db.tmp")
+    throttle = Throttle(args.max_mb_per_second * 1e6)
+    started_at = time.time()
+
+    source = sqlite3.connect(face_server.DATABASE, isolation_level=None)
+    mode = source.execute("PRAGMA journal_mode").fetchone()[0]
+    if mode != "wal":
+        raise SystemExit(
+            f"Database in modalità {mode}: serve WAL per non bloccare il server "
+            f"(viene attivata da init_database, riprovare a server fermo)"
+        )
+    try:
+        source.execute("BEGIN")
+        cursor = source.cursor()
+        cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM gallery_changes")
+        gallery_seq = cursor.fetchone()[0]
+        cursor.execute(
+            "SELECT value FROM gallery_meta WHERE key = 'active_encoding_version'"
+        )
+        row = cursor.fetchone()
+        tag = row[0] if row else ""
+        cursor.execute("SELECT COUNT(*) FROM patients")
+        patients = cursor.fetchone()[0]
+        paths = snapshot_files(cursor, tag)
+        backup_database(source, temp_database, args.pages, throttle)
+        source.execute("COMMIT")
+        source.close()
+        print(
+            f"Database copiato in {time.time() - started_at:.1f}s "
+            f"(sequenza {gallery_seq}, {patients} pazienti, {len(paths)} file)"
+        )
+
+        files = []
+        missing = []
+        with tarfile.open(
+            temp_archive, "w:gz", compresslevel=args.compress_level
+        ) as archive:
+            archive.add(temp_database, arcname=archive_name(face_server.DATABASE))
+            for path in paths:
+                try:
+                    with open(path, "rb") as source_file:
+                        info = archive.gettarinfo(
+                            arcname=archive_name(path), fileobj=source_file
+                        )
+                        archive.addfile(info, ThrottledReader(source_file, throttle))
+                except FileNotFoundError:
+                    # Paziente eliminato dopo lo snapshot: il file non c'è più
+                    missing.append(path)
+                    continue
+                files.append({"path": archive_name(path), "bytes": info.size})
+
+            manifest = {
+                "created_at": datetime.now().isoformat(),
+                "database": archive_name(face_server.DATABASE),
+                "database_bytes": os.path.getsize(temp_database),
+                "database_sha256": file_sha256(temp_database),
+                "gallery_seq": gallery_seq,
+                "encoding_version": tag,
+                "patients": patients,
+                "files": files,
+                "missing": missing,
+                "elapsed_seconds": round(time.time() - started_at, 1),
+            }
+            data = json.dumps(manifest, indent=2).encode()
+            info = tarfile.TarInfo(MANIFEST_NAME)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            archive.addfile(info, io.BytesIO(data))
+        os.replace(temp_archive, archive_path)
+    finally:
+        for path in (temp_archive, temp_database):
+            if os.path.exists(path):
+                os.remove(path)
+
+    total = sum(entry["bytes"] for entry in files)
+    print(
+        f"Snapshot scritto in {archive_path} in {time.time() - started_at:.1f}s: "
+        f"{len(files)} file ({total / 1e6:.1f} MB), {len(missing)} mancanti"
+    )
+
+
+if __name__ == "__main__":
+    main()
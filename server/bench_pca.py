@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Benchmark della ricerca in due fasi (prefiltro PCA) contro la ricerca esatta.
+
+Misura la latenza media di GalleryIndex.search nei due modi e l'accordo delle
+decisioni (stesso paziente e stessa accettazione rispetto alla soglia).
+Senza --synthetic usa la gallery reale e la proiezione salvata.
+
+    python bench_pca.py --synthetic 50000 --dims 32 --queries 500
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+import face_server
+from fit_pca import fit_pca_projection
+
+# Scala degli encoding sintetici: distanze tra identità ~1.0, stessa identità ~0.3
+IDENTITY_SCALE = 0.06
+CAPTURE_NOISE = 0.025
+
+
+def synthetic_gallery(size, rng):
+    gallery = face_server.GalleryIndex()
+    gallery.loaded = True
+    for index in range(size):
+        gallery._append(f"synthetic-{index}", rng.normal(0, IDENTITY_SCALE, 128))
+    return gallery
+
+
+def build_queries(gallery, count, rng):
+    """Metà foto di pazienti registrati (con rumore), metà persone sconosciute"""
+    dims = gallery.buffer.shape[1]
+    known = gallery.buffer[rng.integers(0, len(gallery.ids), count // 2)]
+    known = known + rng.normal(0, CAPTURE_NOISE, known.shape)
+    unknown = rng.normal(0, IDENTITY_SCALE, (count - count // 2, dims))
+    return np.vstack([known, unknown])
+
+
+def run(gallery, queries):
+    results = []
+    started_at = time.perf_counter()
+    for query in queries:
+        results.append(gallery.search(query))
+    elapsed = time.perf_counter() - started_at
+    return results, elapsed / len(queries) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del prefiltro PCA")
+    parser.add_argument(
+        "--synthetic", type=int, help="Usa una gallery sintetica di N pazienti"
+    )
+    parser.add_argument("--dims", type=int, default=32, help="Dimensioni ridotte")
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--shortlist", type=int, default=face_server.PCA_SHORTLIST_SIZE)
+    args = parser.parse_args()
+    rng = np.random.default_rng(42)
+
+    if args.synthetic:
+        gallery = synthetic_gallery(args.synthetic, rng)
+        encodings = gallery.buffer[: len(gallery.ids)]
+        mean, components, _ = fit_pca_projection(encodings, args.dims)
+        projection = {"mean": mean, "components": components}
+    else:
+        gallery = face_server.GalleryIndex()
+        gallery.load()
+        gallery.load_projection()
+        projection = gallery.projection
+        if projection is None:
+            print("Nessuna proiezione salvata: eseguire prima fit_pca.py")
+            return
+
+    # Il benchmark usa sempre il prefiltro, qualunque sia la dimensione
+    gallery.prefilter_min_size = 0
+    gallery.projection_checked_at = float("inf")
+    gallery.version_checked_at = float("inf")  # niente ricarica durante le misure
+    gallery.synced_at = float("inf")
+    face_server.PCA_SHORTLIST_SIZE = args.shortlist
+    queries = build_queries(gallery, args.queries, rng)
+
+    gallery.set_projection(None)
+    exact, exact_ms = run(gallery, queries)
+    gallery.set_projection(projection)
+    approximate, approximate_ms = run(gallery, queries)
+
+    threshold = face_server.SIMILARITY_THRESHOLD
+    exact_matches = same_patient = same_decision = 0
+    for (exact_id, exact_distance), (approx_id, approx_distance) in zip(
+        exact, approximate
+    ):
+        exact_accept = exact_distance < threshold
+        approx_accept = approx_distance < threshold
+        same_decision += exact_accept == approx_accept and (
+            not exact_accept or exact_id == approx_id
+        )
+        if exact_accept:
+            exact_matches += 1
+            same_patient += exact_id == approx_id
+
+    total = len(queries)
+    print(
+        f"Gallery: {len(gallery.ids)} encoding, proiezione a "
+        f"{len(projection['components'])} dimensioni, shortlist {args.shortlist}"
+    )
+    print(f"Ricerca esatta:      {exact_ms:8.3f} ms/query")
+    print(
+        f"Ricerca in due fasi: {approximate_ms:8.3f} ms/query "
+        f"(speedup {exact_ms / approximate_ms:.2f}x)"
+    )
+    if exact_matches:
+        print(
+            f"Stesso paziente sui {exact_matches} match esatti: "
+            f"{same_patient / exact_matches * 100:.2f}%"
+        )
+    print(f"Stessa decisione (match/no match): {same_decision / total * 100:.2f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Benchmark delle registrazioni massive: /register sincrono contro la coda asincrona.
+
+Invia le stesse registrazioni in modalità sync=1 (il client attende encoding e
+salvataggio) e in modalità asincrona (il client riceve subito il job e ne segue
+lo stato con il long-poll), misurando throughput e tempo in cui ogni client
+resta bloccato sulla richiesta. Va eseguito contro un server di test:
+
+    python bench_register.py --target http://localhost:5001 --photos foto_test/ \\
+        --count 200 --concurrency 8
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from replay_trace import SYNTHETIC_FORM_VALUES, percentile
+
+STATUS_POLL_WAIT = 20
+JOB_PENDING_STATUSES = ("queued", "processing")
+JOB_WAIT_TIMEOUT_SECONDS = 600
+
+
+def load_photos(args):
+    if args.photo:
+        paths = [args.photo]
+    else:
+        paths = sorted(
+            os.path.join(args.photos, name)
+            for name in os.listdir(args.photos)
+            if name.lower().endswith((".jpg", ".jpeg", ".png"))
+        )
+    photos = []
+    for path in paths:
+        with open(path, "rb") as photo_file:
+            photos.append(photo_file.read())
+    return photos
+
+
+def submit(target, photo, sync):
+    """Una registrazione: restituisce (risposta, secondi di attesa del client)"""
+    data = dict(SYNTHETIC_FORM_VALUES, sync="1" if sync else "0")
+    started_at = time.perf_counter()
+    response = requests.post(
+        f"{target}/register",
+        data=data,
+        files={"foto": ("foto.jpg", photo, "image/jpeg")},
+        timeout=120,
+    )
+    return response, time.perf_counter() - started_at
+
+
+def wait_for_job(target, job_id, timeout):
+    """Stato del job appena esce dalla coda ("timeout" se non ci arriva entro timeout s)"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        wait = max(1, min(STATUS_POLL_WAIT, int(deadline - time.time())))
+        try:
+            response = requests.get(
+                f"{target}/register-status/{job_id}",
+                params={"wait": wait},
+                timeout=wait + 10,
+            )
+            status = response.json().get("status")
+        except (requests.RequestException, ValueError):
+            return "failed"
+        # Anche duplicate_suspected e stati sconosciuti chiudono l'attesa
+        if status not in JOB_PENDING_STATUSES:
+            return status or "failed"
+    return "timeout"
+
+
+def run(target, photos, count, concurrency, sync, job_timeout):
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(
+            executor.map(
+                lambda i: submit(target, photos[i % len(photos)], sync), range(count)
+            )
+        )
+    submitted_at = time.perf_counter()
+
+    outcomes = []
+    if sync:
+        outcomes = ["done" if r.status_code == 200 else "failed" for r, _ in results]
+    else:
+        job_ids = [r.json()["job_id"] for r, _ in results if r.status_code == 202]
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            outcomes = list(
+                executor.map(lambda j: wait_for_job(target, j, job_timeout), job_ids)
+            )
+        outcomes += ["failed"] * (len(results) - len(job_ids))
+    finished_at = time.perf_counter()
+
+    held = [seconds * 1000 for _, seconds in results]
+    return {
+        "done": outcomes.count("done"),
+        "failed": len(outcomes) - outcomes.count("done"),
+        "submit_seconds": submitted_at - started_at,
+        "total_seconds": finished_at - started_at,
+        "held_mean_ms": sum(held) / len(held),
+        "held_p95_ms": percentile(held, 95),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark registrazioni massive")
+    parser.add_argument("--target", default="http://localhost:5000")
+    parser.add_argument("--photo", help="Foto usata per tutte le registrazioni")
+    parser.add_argument("--photos", help="Cartella di foto (usate a rotazione)")
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--job-timeout",
+        type=float,
+        default=JOB_WAIT_TIMEOUT_SECONDS,
+        help="Secondi massimi di attesa di ogni job asincrono",
+    )
+    args = parser.parse_args()
+
+    if not args.photo and not args.photos:
+        parser.error("Indicare --photo o --photos")
+    photos = load_photos(args)
+    if not photos:
+        parser.error("Nessuna foto trovata")
+    target = args.target.rstrip("/")
+
+    print(
+        f"{args.count} registrazioni, {args.concurrency} client concorrenti, "
+        f"{len(photos)} foto"
+    )
+    print(
+        f"{'modalità':<10}{'ok':>6}{'errori':>8}{'invio s':>10}{'totale s':>10}"
+        f"{'reg/s':>9}{'attesa media':>14}{'attesa p95':>12}"
+    )
+    for mode, sync in (("sync", True), ("async", False)):
+        stats = run(
+            target, photos, args.count, args.concurrency, sync, args.job_timeout
+        )
+        print(
+            f"{mode:<10}{stats['done']:>6}{stats['failed']:>8}"
+            f"{stats['submit_seconds']:>10.2f}{stats['total_seconds']:>10.2f}"
+            f"{stats['done'] / stats['total_seconds']:>9.2f}"
+            f"{stats['held_mean_ms']:>12.1f}ms{stats['held_p95_ms']:>10.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""Benchmark della latenza di ricerca scatter-gather al variare del numero di shard.
+
+Per ogni configurazione crea una gallery sintetica divisa per hash degli ID,
+avvia gli shard come processi face_server.py locali (porte consecutive) e
+misura la latenza di ShardClient.search, cioè il fan-out del coordinatore
+senza il costo dell'encoding.
+
+    python bench_shards.py --gallery 50000 --shards 1,2,4 --queries 300
+"""
+
+import argparse
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+import numpy as np
+import requests
+
+import face_server
+from bench_pca import CAPTURE_NOISE, IDENTITY_SCALE
+from coordinator import ShardClient
+from replay_trace import percentile
+
+SERVER_SCRIPT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "face_server.py"
+)
+STARTUP_TIMEOUT_SECONDS = 120
+
+
+def seed_shard(directory, patients):
+    """Scrive database ed encoding di uno shard senza passare da /register"""
+    face_server.DATABASE = os.path.join(directory, "face_db.db")
+    face_server.ENCODINGS_FOLDER = os.path.join(directory, "face_encodings")
+    os.makedirs(face_server.ENCODINGS_FOLDER, exist_ok=True)
+    face_server.init_database()
+
+    now = datetime.now().isoformat()
+    rows = []
+    for patient_id, encoding in patients:
+        path = face_server.save_face_encoding(encoding, patient_id)
+        rows.append((patient_id, "Bench", path, now, now))
+
+    conn = sqlite3.connect(face_server.DATABASE)
+    conn.executemany(
+        """
+        INSERT INTO patients (id, name, face_encoding_path, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+    """,
+        rows,
+    )
+    conn.commit()
+    conn.close()
+
+
+def start_shards(root, gallery, shard_count, base_port, token):
+    """Divide la gallery per hash e avvia un processo per shard"""
+    assignments = [[] for _ in range(shard_count)]
+    for patient_id, encoding in gallery:
+        assignments[face_server.shard_of(patient_id, shard_count)].append(
+            (patient_id, encoding)
+        )
+
+    processes, urls = [], []
+    for index, patients in enumerate(assignments):
+        directory = os.path.join(root, f"shard_{shard_count}_{index}")
+        os.makedirs(directory)
+        seed_shard(directory, patients)
+
+        port = base_port + index
+        env = dict(
+            os.environ,
+            FACE_SHARD_INDEX=str(index),
+            FACE_SHARD_COUNT=str(shard_count),
+            FACE_SHARD_TOKEN=token,
+            FACE_SERVER_PORT=str(port),
+            FACE_DEBUG="0",
+        )
+        processes.append(
+            subprocess.Popen(
+                [sys.executable, SERVER_SCRIPT],
+                cwd=directory,
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        )
+        urls.append(f"http://127.0.0.1:{port}")
+
+    # Attende che tutti gli shard abbiano caricato la gallery
+    deadline = time.time() + STARTUP_TIMEOUT_SECONDS
+    for url, process in zip(urls, processes):
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"Shard {url} terminato all'avvio")
+            try:
+                requests.get(f"{url}/", timeout=1)
+                break
+            except requests.RequestException:
+                if time.time() > deadline:
+                    raise RuntimeError(f"Shard {url} non pronto")
+                time.sleep(0.2)
+
+    return processes, urls, [len(patients) for patients in assignments]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark latenza vs numero di shard")
+    parser.add_argument("--gallery", type=int, default=20000, help="Pazienti sintetici")
+    parser.add_argument("--shards", default="1,2,4", help="Configurazioni da provare")
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--base-port", type=int, default=5101)
+    parser.add_argument("--timeout", type=float, default=2.0, help="Timeout per shard")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    gallery = [
+        (str(uuid.uuid4()), rng.normal(0, IDENTITY_SCALE, 128))
+        for _ in range(args.gallery)
+    ]
+    # Metà foto di pazienti registrati (con rumore), metà persone sconosciute
+    known = [gallery[i][1] for i in rng.integers(0, len(gallery), args.queries // 2)]
+    queries = [e + rng.normal(0, CAPTURE_NOISE, 128) for e in known] + [
+        rng.normal(0, IDENTITY_SCALE, 128)
+        for _ in range(args.queries - args.queries // 2)
+    ]
+    token = uuid.uuid4().hex
+
+    print(f"Gallery sintetica: {args.gallery} pazienti, {args.queries} query")
+    print(
+        f"{'shard':>6}{'per shard':>11}{'media':>9}{'p50':>9}{'p95':>9}{'p99':>9}"
+        f"{'parziali':>10}"
+    )
+    with tempfile.TemporaryDirectory() as root:
+        for shard_count in [int(value) for value in args.shards.split(",")]:
+            processes, urls, sizes = start_shards(
+                root, gallery, shard_count, args.base_port, token
+            )
+            try:
+                client = ShardClient(urls, token, args.timeout)
+                client.search(queries[:5])  # riscaldamento delle connessioni
+
+                latencies = []
+                partial = 0
+                for query in queries:
+                    started_at = time.perf_counter()
+                    _, _, missing = client.search([query])
+                    latencies.append((time.perf_counter() - started_at) * 1000)
+                    partial += bool(missing)
+            finally:
+                for process in processes:
+                    process.terminate()
+                for process in processes:
+                    process.wait()
+
+            print(
+                f"{shard_count:>6}{max(sizes):>11}"
+                f"{sum(latencies) / len(latencies):>9.2f}"
+                f"{percentile(latencies, 50):>9.2f}{percentile(latencies, 95):>9.2f}"
+                f"{percentile(latencies, 99):>9.2f}{partial:>10}"
+            )
+
+
+if __name__ == "__main__":
+    main()
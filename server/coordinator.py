@@ -0,0 +1,624 @@
+#!/usr/bin/env python3
+"""Coordinatore scatter-gather per una gallery divisa in shard.
+
+Ogni shard è un face_server.py avviato con FACE_SHARD_INDEX, FACE_SHARD_COUNT e
+lo stesso FACE_SHARD_TOKEN: possiede gli ID paziente del suo intervallo di hash.
+Il coordinatore calcola l'encoding una sola volta, lo invia a tutti gli shard in
+parallelo, unisce le distanze migliori e instrada /register e /dati allo shard
+proprietario. Uno shard che non risponde entro FACE_SHARD_TIMEOUT viene escluso
+dalla risposta (segnalata come parziale) invece di bloccarla.
+
+    FACE_SHARD_URLS=http://localhost:5001,http://localhost:5002 \\
+    FACE_SHARD_TOKEN=segreto python coordinator.py
+"""
+
+import base64
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+
+import numpy as np
+import requests
+from flask import Flask, Response, jsonify, request
+
+from face_server import (
+    ACCESS_WINDOW_SECONDS,
+    DEFAULT_ENCODING_SETTINGS,
+    DUPLICATE_MAX_CANDIDATES,
+    SIMILARITY_THRESHOLD,
+    UPLOAD_FOLDER,
+    DeadlineExceeded,
+    load_and_process_image,
+    shard_of,
+)
+
+app = Flask(__name__)
+
+# Configurazione
+SHARD_URLS = [
+    url.strip().rstrip("/")
+    for url in os.environ.get("FACE_SHARD_URLS", "").split(",")
+    if url.strip()
+]
+SHARD_TOKEN = os.environ.get("FACE_SHARD_TOKEN", "")
+SHARD_TIMEOUT_SECONDS = float(os.environ.get("FACE_SHARD_TIMEOUT", 2.0))
+REGISTER_TIMEOUT_SECONDS = 30
+COORDINATOR_PORT = int(os.environ.get("FACE_COORDINATOR_PORT", 5000))
+LATENCY_EWMA_ALPHA = 0.2
+
+# Header del client inoltrati così come sono agli shard
+FORWARDED_HEADERS = ("X-Priority", "X-Partitions", "X-Request-Deadline-Ms")
+
+
+def encode_base64(encoding):
+    """Encoding per gli shard: base64 di float32 little-endian"""
+    return base64.b64encode(np.asarray(encoding, dtype="<f4").tobytes()).decode("ascii")
+
+
+class ShardClient:
+    """Fan-out delle richieste verso gli shard, con timeout e metriche per shard"""
+
+    def __init__(self, urls, token, timeout):
+        self.urls = urls
+        self.token = token
+        self.timeout = timeout
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=max(4, 4 * len(urls)))
+        self.lock = threading.Lock()
+        self.stats = [
+            {"requests": 0, "timeouts": 0, "errors": 0, "latency_ms": None}
+            for _ in urls
+        ]
+        # Versione di encoding degli shard (tag, impostazioni), aggiornata dai 409
+        self.version = ("", dict(DEFAULT_ENCODING_SETTINGS))
+
+    def encoding_version(self):
+        with self.lock:
+            return self.version
+
+    def update_encoding_version(self, response):
+        """Lo shard ha risposto 409: adotta la versione che indica"""
+        try:
+            body = response.json()
+            version = (body["encoding_version"], body["encoding_settings"])
+        except (ValueError, KeyError):
+            return
+        with self.lock:
+            self.version = version
+
+    def session(self):
+        # Una sessione per thread: connessioni keep-alive senza condividerle
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def headers(self, extra=None):
+        headers = {"X-Shard-Token": self.token}
+        headers.update(extra or {})
+        return headers
+
+    def record(self, index, seconds=None, outcome="ok"):
+        with self.lock:
+            stats = self.stats[index]
+            stats["requests"] += 1
+            if outcome == "timeout":
+                stats["timeouts"] += 1
+            elif outcome == "error":
+                stats["errors"] += 1
+            if seconds is not None:
+                latency_ms = seconds * 1000
+                previous = stats["latency_ms"]
+                stats["latency_ms"] = (
+                    latency_ms
+                    if previous is None
+                    else previous + LATENCY_EWMA_ALPHA * (latency_ms - previous)
+                )
+
+    def post_json(self, index, path, payload, timeout, extra_headers=None):
+        started_at = time.time()
+        try:
+            response = self.session().post(
+                f"{self.urls[index]}{path}",
+                json=payload,
+                headers=self.headers(extra_headers),
+                timeout=timeout,
+            )
+            response.raise_for_status()
+        except requests.Timeout:
+            self.record(index, outcome="timeout")
+            raise
+        except Exception:
+            self.record(index, outcome="error")
+            raise
+        self.record(index, time.time() - started_at)
+        return response.json()
+
+    def fan_out(self, path, payload, timeout, extra_headers=None):
+        """Stessa richiesta a tutti gli shard in parallelo.
+
+        Restituisce le risposte per indice di shard e gli indici mancanti
+        (timeout, errore o versione di encoding diversa, che viene adottata).
+        """
+        futures = {
+            self.executor.submit(
+                self.post_json, index, path, payload, timeout, extra_headers
+            ): index
+            for index in range(len(self.urls))
+        }
+        done, not_done = wait(futures, timeout=timeout)
+
+        results = {}
+        missing = [futures[future] for future in not_done]
+        for future in done:
+            index = futures[future]
+            try:
+                results[index] = future.result()
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code == 409:
+                    self.update_encoding_version(e.response)
+                missing.append(index)
+            except Exception:
+                missing.append(index)
+        return results, sorted(missing)
+
+    def search(self, encodings, partitions=(), deadline=None, encoding_version=None):
+        """Migliori (patient_id, distanza) per ogni encoding su tutti gli shard.
+
+        Restituisce anche gli indici degli shard che hanno risposto e di quelli
+        mancanti (timeout, errore o versione di encoding diversa).
+        """
+        timeout = self.timeout
+        extra_headers = {}
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise DeadlineExceeded("match")
+            timeout = min(timeout, remaining)
+            extra_headers["X-Request-Deadline-Ms"] = str(int(remaining * 1000))
+
+        payload = {
+            "encodings": [encode_base64(e) for e in encodings],
+            "partitions": list(partitions),
+            "encoding_version": (
+                self.encoding_version()[0]
+                if encoding_version is None
+                else encoding_version
+            ),
+        }
+        results, missing = self.fan_out(
+            "/shard/search", payload, timeout, extra_headers
+        )
+
+        best = [(None, float("inf"))] * len(encodings)
+        for result in results.values():
+            for position, match in enumerate(result["results"]):
+                if match["id"] and match["distance"] < best[position][1]:
+                    best[position] = (match["id"], match["distance"])
+
+        return best, sorted(results), missing
+
+    def duplicate_candidates(self, encoding, encoding_version):
+        """Possibili duplicati su tutti gli shard, i più vicini per primi"""
+        payload = {
+            "encoding": encode_base64(encoding),
+            "encoding_version": encoding_version,
+        }
+        results, missing = self.fan_out("/shard/duplicates", payload, self.timeout)
+        candidates = sorted(
+            (
+                (candidate["id"], candidate["distance"])
+                for result in results.values()
+                for candidate in result["candidates"]
+            ),
+            key=lambda candidate: candidate[1],
+        )
+        return candidates[:DUPLICATE_MAX_CANDIDATES], missing
+
+    def forward(self, index, method, path, timeout, **kwargs):
+        """Inoltra una richiesta del client allo shard indicato"""
+        started_at = time.time()
+        try:
+            response = self.session().request(
+                method, f"{self.urls[index]}{path}", timeout=timeout, **kwargs
+            )
+        except requests.Timeout:
+            self.record(index, outcome="timeout")
+            raise
+        except Exception:
+            self.record(index, outcome="error")
+            raise
+        self.record(index, time.time() - started_at)
+        return response
+
+    def metrics(self):
+        with self.lock:
+            return [
+                {
+                    "url": url,
+                    **stats,
+                    "latency_ms": (
+                        round(stats["latency_ms"], 2)
+                        if stats["latency_ms"] is not None
+                        else None
+                    ),
+                }
+                for url, stats in zip(self.urls, self.stats)
+            ]
+
+
+shards = ShardClient(SHARD_URLS, SHARD_TOKEN, SHARD_TIMEOUT_SECONDS)
+
+
+def encode_for_shards(image_path, deadline):
+    """Encoding con il modello della versione attiva sugli shard.
+
+    Restituisce (encoding, tag, errore). Il tag va passato a shards.search: se
+    nel frattempo gli shard sono passati a un'altra versione lo segnalano con
+    un 409 e la ricerca va ripetuta con un nuovo encoding.
+    """
+    tag, settings = shards.encoding_version()
+    face_encoding, error = load_and_process_image(
+        image_path, deadline=deadline, settings=settings
+    )
+    return face_encoding, tag, error
+
+
+def request_deadline():
+    """Istante entro cui il client attende la risposta (header X-Request-Deadline-Ms)"""
+    try:
+        budget_ms = float(request.headers["X-Request-Deadline-Ms"])
+    except (KeyError, ValueError):
+        return None
+    return time.time() + budget_ms / 1000.0
+
+
+def forwarded_headers():
+    return {
+        header: request.headers[header]
+        for header in FORWARDED_HEADERS
+        if header in request.headers
+    }
+
+
+def relay(response):
+    """Restituisce al client la risposta di uno shard così com'è"""
+    return Response(
+        response.content,
+        status=response.status_code,
+        content_type=response.headers.get("Content-Type", "application/json"),
+    )
+
+
+def shard_unavailable(index):
+    return (
+        jsonify({"error": f"Shard {index} non raggiungibile", "match": False}),
+        503,
+    )
+
+
+# --- API Endpoints ---
+
+
+@app.route("/", methods=["GET"])
+def health_check():
+    """Stato del coordinatore e di ciascuno shard"""
+    statuses = []
+    for index, url in enumerate(shards.urls):
+        try:
+            response = shards.forward(index, "GET", "/", SHARD_TIMEOUT_SECONDS)
+            statuses.append({"url": url, "status": response.json().get("status")})
+        except Exception:
+            statuses.append({"url": url, "status": "offline"})
+    online = sum(1 for status in statuses if status["status"] == "online")
+    return (
+        jsonify(
+            {
+                "status": "online" if online == len(statuses) else "degraded",
+                "service": "Secure Face Recognition Coordinator",
+                "shards": statuses,
+                "timestamp": datetime.now().isoformat(),
+            }
+        ),
+        200,
+    )
+
+
+@app.route("/register", methods=["POST"])
+def register_patient():
+    """Assegna l'ID al nuovo paziente e inoltra la registrazione allo shard proprietario.
+
+    Lo shard proprietario vede solo la sua parte di gallery: i duplicati si
+    cercano qui su tutti gli shard e i candidati gli arrivano nell'header
+    X-Duplicate-Candidates.
+    """
+    if "foto" not in request.files:
+        return jsonify({"error": "Foto mancante"}), 400
+
+    patient_id = str(uuid.uuid4())
+    index = shard_of(patient_id, len(shards.urls))
+    photo = request.files["foto"]
+    photo_bytes = photo.read()
+    headers = shards.headers(forwarded_headers())
+    headers["X-Patient-Id"] = patient_id
+
+    if request.values.get("allow_duplicate", "0") != "1":
+        try:
+            candidates, missing, error = screen_duplicates(photo_bytes)
+        except DeadlineExceeded:
+            return jsonify({"error": "Deadline della richiesta superata"}), 504
+        if error:
+            return jsonify({"error": error}), 400
+        if missing:
+            # Un controllo parziale lascerebbe passare i duplicati degli shard mancanti
+            return (
+                jsonify(
+                    {
+                        "error": "Controllo dei duplicati non completo, riprovare",
+                        "missing_shards": missing,
+                    }
+                ),
+                503,
+            )
+        headers["X-Duplicate-Candidates"] = json.dumps(
+            [
+                {"id": candidate_id, "distance": distance}
+                for candidate_id, distance in candidates
+            ]
+        )
+
+    try:
+        response = shards.forward(
+            index,
+            "POST",
+            "/register",
+            REGISTER_TIMEOUT_SECONDS,
+            data=list(request.form.items(multi=True)),
+            files={"foto": (photo.filename, photo_bytes, photo.mimetype)},
+            headers=headers,
+        )
+    except requests.Timeout:
+        return jsonify({"error": f"Shard {index} non ha risposto in tempo"}), 504
+    except requests.RequestException:
+        return shard_unavailable(index)
+    return relay(response)
+
+
+def screen_duplicates(photo_bytes):
+    """Candidati duplicati su tutti gli shard: (candidati, shard mancanti, errore)"""
+    temp_path = os.path.join(UPLOAD_FOLDER, f"temp_{uuid.uuid4().hex}.jpg")
+    with open(temp_path, "wb") as temp_file:
+        temp_file.write(photo_bytes)
+    try:
+        for _ in range(2):
+            face_encoding, tag, error = encode_for_shards(temp_path, request_deadline())
+            if error:
+                return [], [], error
+            candidates, missing = shards.duplicate_candidates(face_encoding, tag)
+            if shards.encoding_version()[0] == tag:
+                break
+    finally:
+        os.remove(temp_path)
+    return candidates, missing, None
+
+
+@app.route("/register-status/<job_id>", methods=["GET"])
+def registration_status(job_id):
+    """Il job di registrazione vive sullo shard del paziente (stesso ID)"""
+    try:
+        index = shard_of(str(uuid.UUID(job_id)), len(shards.urls))
+    except ValueError:
+        return jsonify({"error": "Job di registrazione non trovato"}), 404
+
+    wait = request.args.get("wait", "0")
+    try:
+        timeout = SHARD_TIMEOUT_SECONDS + float(wait)
+    except ValueError:
+        return jsonify({"error": "Parametro wait non valido"}), 400
+    try:
+        response = shards.forward(
+            index,
+            "GET",
+            f"/register-status/{job_id}",
+            timeout,
+            params={"wait": wait},
+        )
+    except requests.RequestException:
+        return shard_unavailable(index)
+    return relay(response)
+
+
+@app.route("/register-confirm/<job_id>", methods=["POST"])
+def confirm_registration(job_id):
+    """La conferma dei duplicati va allo shard che ha in carico il job"""
+    try:
+        index = shard_of(str(uuid.UUID(job_id)), len(shards.urls))
+    except ValueError:
+        return jsonify({"error": "Job di registrazione non trovato"}), 404
+
+    try:
+        response = shards.forward(
+            index,
+            "POST",
+            f"/register-confirm/{job_id}",
+            SHARD_TIMEOUT_SECONDS,
+            data=request.form.to_dict(),
+            json=request.get_json(silent=True),
+        )
+    except requests.RequestException:
+        return shard_unavailable(index)
+    return relay(response)
+
+
+@app.route("/recognize", methods=["POST"])
+def recognize_patient():
+    """Encoding una volta sola, ricerca su tutti gli shard, log sullo shard proprietario"""
+    try:
+        if "foto" not in request.files:
+            return jsonify({"error": "Nessuna foto ricevuta"}), 400
+
+        deadline = request_deadline()
+        partitions = request.form.getlist("partitions[]")
+        partitions += request.headers.get("X-Partitions", "").split(",")
+        partitions = sorted({p.strip() for p in partitions if p.strip()})
+        fallback_global = request.form.get("fallback_global", "1") != "0"
+
+        temp_path = os.path.join(UPLOAD_FOLDER, f"temp_{uuid.uuid4().hex}.jpg")
+        request.files["foto"].save(temp_path)
+        try:
+            face_encoding, tag, error = encode_for_shards(temp_path, deadline)
+            if error:
+                return jsonify({"error": error, "match": False}), 400
+
+            search_scope = "partition" if partitions else "global"
+            best, responded, missing = shards.search(
+                [face_encoding], partitions, deadline, tag
+            )
+            if shards.encoding_version()[0] != tag:
+                # Versione cambiata sugli shard: una sola ripetizione con il nuovo modello
+                face_encoding, tag, error = encode_for_shards(temp_path, deadline)
+                if error:
+                    return jsonify({"error": error, "match": False}), 400
+                best, responded, missing = shards.search(
+                    [face_encoding], partitions, deadline, tag
+                )
+        finally:
+            os.remove(temp_path)
+        patient_id, distance = best[0]
+        if partitions and fallback_global and distance >= SIMILARITY_THRESHOLD:
+            search_scope = "global"
+            best, responded, missing = shards.search([face_encoding], (), deadline, tag)
+            patient_id, distance = best[0]
+
+        if not responded:
+            return (
+                jsonify({"error": "Nessuno shard raggiungibile", "match": False}),
+                503,
+            )
+
+        shard_info = {
+            "queried": len(shards.urls),
+            "responded": len(responded),
+            "missing": missing,
+        }
+        matched = patient_id is not None and distance < SIMILARITY_THRESHOLD
+        confidence = 1.0 - distance if matched else 0.0
+
+        # La sessione di accesso vive sullo shard che possiede il paziente
+        owner = shard_of(patient_id, len(shards.urls)) if matched else 0
+        try:
+            shards.post_json(
+                owner,
+                "/shard/log",
+                {
+                    "patient_id": patient_id if matched else None,
+                    "confidence": confidence,
+                },
+                SHARD_TIMEOUT_SECONDS,
+            )
+        except Exception:
+            if matched:
+                return shard_unavailable(owner)
+
+        if matched:
+            return (
+                jsonify(
+                    {
+                        "match": True,
+                        "id": patient_id,
+                        "confidence": round(confidence, 3),
+                        "search_scope": search_scope,
+                        "partial": bool(missing),
+                        "shards": shard_info,
+                        "access_valid_until": (
+                            datetime.now() + timedelta(seconds=ACCESS_WINDOW_SECONDS)
+                        ).isoformat(),
+                        "message": f"Paziente riconosciuto con confidenza {round(confidence * 100, 1)}%. Accesso ai dati autorizzato per {ACCESS_WINDOW_SECONDS} secondi.",
+                    }
+                ),
+                200,
+            )
+
+        return (
+            jsonify(
+                {
+                    "match": False,
+                    "search_scope": search_scope,
+                    "partial": bool(missing),
+                    "shards": shard_info,
+                    "message": "Nessun paziente corrispondente trovato",
+                }
+            ),
+            200,
+        )
+
+    except DeadlineExceeded as e:
+        return (
+            jsonify(
+                {
+                    "error": "Deadline della richiesta superata",
+                    "deadline_exceeded": True,
+                    "aborted_before": e.stage,
+                    "match": False,
+                }
+            ),
+            504,
+        )
+    except Exception as e:
+        return jsonify({"error": f"Errore interno del server: {str(e)}"}), 500
+
+
+@app.route("/dati", methods=["POST"])
+def get_patient_data():
+    """Inoltra la richiesta dei dati allo shard che possiede il paziente"""
+    patient_id = request.form.get("id", "").strip()
+    if not patient_id:
+        return jsonify({"error": "ID paziente mancante"}), 400
+
+    index = shard_of(patient_id, len(shards.urls))
+    try:
+        response = shards.forward(
+            index,
+            "POST",
+            "/dati",
+            SHARD_TIMEOUT_SECONDS,
+            data={"id": patient_id},
+        )
+    except requests.RequestException:
+        return shard_unavailable(index)
+    return relay(response)
+
+
+@app.route("/patient-count", methods=["GET"])
+def get_patient_count():
+    """Somma dei pazienti registrati su tutti gli shard"""
+    total = 0
+    missing = []
+    for index in range(len(shards.urls)):
+        try:
+            response = shards.forward(
+                index, "GET", "/patient-count", SHARD_TIMEOUT_SECONDS
+            )
+            total += response.json()["total_patients"]
+        except Exception:
+            missing.append(index)
+    return jsonify({"total_patients": total, "partial": bool(missing)}), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Latenza, timeout ed errori per shard"""
+    return jsonify({"shards": shards.metrics()}), 200
+
+
+if __name__ == "__main__":
+    if not SHARD_URLS or not SHARD_TOKEN:
+        raise SystemExit("Impostare FACE_SHARD_URLS e FACE_SHARD_TOKEN")
+    print(
+        f"Coordinatore di {len(SHARD_URLS)} shard su http://0.0.0.0:{COORDINATOR_PORT}"
+    )
+    print(f"Timeout per shard: {SHARD_TIMEOUT_SECONDS}s")
+    app.run(host="0.0.0.0", port=COORDINATOR_PORT, threaded=True)
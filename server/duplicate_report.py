@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""Report dei pazienti registrati più volte (cluster di duplicati nella gallery).
+
+Confronta tutti gli encoding a coppie con il motore vettoriale (face_engine),
+a blocchi quadrati di --block righe: la memoria resta limitata anche con
+gallery grandi e ogni coppia è calcolata una sola volta. Le coppie sotto
+soglia vengono unite in cluster (union-find). Il risultato va in un CSV, un
+cluster per gruppo di righe, da far verificare a un operatore.
+
+    python duplicate_report.py --threshold 0.5 --output duplicati.csv
+"""
+
+import argparse
+import csv
+import sqlite3
+import time
+
+import numpy as np
+
+import face_engine
+import face_server
+
+
+class UnionFind:
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    def find(self, item):
+        while self.parent[item] != item:
+            self.parent[item] = self.parent[self.parent[item]]
+            item = self.parent[item]
+        return item
+
+    def union(self, first, second):
+        first, second = self.find(first), self.find(second)
+        if first != second:
+            self.parent[max(first, second)] = min(first, second)
+
+
+def duplicate_pairs(encodings, threshold, block):
+    """Coppie (i, j, distanza) con i < j e distanza sotto soglia"""
+    pairs = []
+    count = len(encodings)
+    for start in range(0, count, block):
+        rows = encodings[start : start + block]
+        for other in range(start, count, block):
+            distances = face_engine.pairwise_distances(
+                rows, encodings[other : other + block]
+            )
+            for i, j in zip(*np.nonzero(distances < threshold)):
+                first, second = start + int(i), other + int(j)
+                if first < second:
+                    pairs.append((first, second, float(distances[i, j])))
+    return pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report dei pazienti duplicati")
+    parser.add_argument(
+        "--threshold", type=float, default=face_server.DUPLICATE_THRESHOLD
+    )
+    parser.add_argument("--block", type=int, default=2048, help="Righe per blocco")
+    parser.add_argument("--output", default="duplicate_report.csv")
+    args = parser.parse_args()
+
+    face_server.init_database()
+    gallery = face_server.gallery
+    gallery.ensure_loaded()
+    ids = list(gallery.ids)
+    if not ids:
+        print("Gallery vuota")
+        return
+    encodings = gallery.matrix().astype(np.float32)
+    print(
+        f"Gallery: {len(ids)} encoding (versione {gallery.encoding_tag or 'originale'})"
+    )
+
+    started_at = time.time()
+    pairs = duplicate_pairs(encodings, args.threshold, args.block)
+
+    clusters = UnionFind(len(ids))
+    closest = {}
+    for first, second, distance in pairs:
+        clusters.union(first, second)
+        for row in (first, second):
+            closest[row] = min(closest.get(row, distance), distance)
+    groups = {}
+    for row in closest:
+        groups.setdefault(clusters.find(row), []).append(row)
+    print(
+        f"{len(pairs)} coppie sotto soglia {args.threshold} in "
+        f"{time.time() - started_at:.1f}s, {len(groups)} cluster"
+    )
+
+    conn = sqlite3.connect(face_server.DATABASE)
+    details = {
+        patient_id: (name, surname, created_at)
+        for patient_id, name, surname, created_at in conn.execute(
+            "SELECT id, name, surname, created_at FROM patients"
+        )
+    }
+    conn.close()
+
+    with open(args.output, "w", newline="") as output:
+        writer = csv.writer(output)
+        writer.writerow(
+            ["cluster", "patient_id", "name", "surname", "created_at", "min_distance"]
+        )
+        ordered = sorted(groups.values(), key=len, reverse=True)
+        for number, rows in enumerate(ordered, start=1):
+            for row in sorted(
+                rows, key=lambda r: details.get(ids[r], ("",) * 3)[2] or ""
+            ):
+                name, surname, created_at = details.get(ids[row], ("", "", ""))
+                writer.writerow(
+                    [
+                        number,
+                        ids[row],
+                        name,
+                        surname,
+                        created_at,
+                        round(closest[row], 4),
+                    ]
+                )
+    print(f"Report scritto in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+"""Motore di confronto degli encoding condiviso da face_server.py e server.py.
+
+Gli encoding stanno in righe contigue di un'unica matrice (con capacità in
+eccesso, cresce per raddoppio): le distanze verso tutta la gallery, o verso un
+sottoinsieme di righe, si calcolano con una sola operazione vettoriale invece
+di leggere e confrontare un file .npy alla volta.
+
+La classe non ha lock propri: chi la usa da più thread deve proteggerla.
+"""
+
+import os
+
+import numpy as np
+
+ENCODING_EXTENSION = ".npy"
+INITIAL_CAPACITY = 64
+
+
+def distances_to(candidates, target_encoding):
+    """Distanze euclidee tra ogni riga di `candidates` e un encoding"""
+    return np.linalg.norm(candidates - target_encoding, axis=1)
+
+
+def pairwise_distances(targets, candidates):
+    """Matrice delle distanze tra più encoding e tutti i candidati"""
+    # |a - b|^2 = |a|^2 + |b|^2 - 2 a.b, per tutte le coppie insieme
+    squared = (
+        np.sum(targets**2, axis=1)[:, None]
+        + np.sum(candidates**2, axis=1)[None, :]
+        - 2.0 * targets @ candidates.T
+    )
+    return np.sqrt(np.maximum(squared, 0.0))
+
+
+def shortlist(approximate_distances, size):
+    """Indici delle `size` distanze più piccole (in ordine qualsiasi)"""
+    size = min(size, len(approximate_distances))
+    return np.argpartition(approximate_distances, size - 1)[:size]
+
+
+class EncodingMatrix:
+    """Encoding indicizzati per chiave (ID paziente) in una matrice contigua"""
+
+    def __init__(self):
+        self.ids = []  # riga -> chiave
+        self.positions = {}  # chiave -> riga
+        self.buffer = None  # righe valide: [0, len(ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def _append(self, key, encoding):
+        """Aggiunge o sostituisce l'encoding di `key`. Restituisce la riga"""
+        if key in self.positions:
+            row = self.positions[key]
+        else:
+            if self.buffer is None:
+                self.buffer = np.empty((INITIAL_CAPACITY, len(encoding)))
+            elif len(self.ids) == len(self.buffer):
+                grown = np.empty((2 * len(self.buffer), self.buffer.shape[1]))
+                grown[: len(self.ids)] = self.buffer[: len(self.ids)]
+                self.buffer = grown
+            row = len(self.ids)
+            self.positions[key] = row
+            self.ids.append(key)
+
+        self.buffer[row] = encoding
+        return row
+
+    def _remove(self, key):
+        """Toglie `key`: l'ultima riga prende il suo posto.
+
+        Restituisce (riga liberata, ultima riga) perché chi tiene dati
+        paralleli per riga possa spostarli allo stesso modo, None se assente.
+        """
+        position = self.positions.pop(key, None)
+        if position is None:
+            return None
+        last = len(self.ids) - 1
+        if position != last:
+            moved = self.ids[last]
+            self.buffer[position] = self.buffer[last]
+            self.ids[position] = moved
+            self.positions[moved] = position
+        self.ids.pop()
+        return position, last
+
+    def add(self, key, encoding):
+        self._append(key, encoding)
+
+    def remove(self, key):
+        self._remove(key)
+
+    def matrix(self, rows=None):
+        """Encoding validi (tutti, o solo le righe indicate)"""
+        if rows is not None:
+            return self.buffer[rows]
+        return self.buffer[: len(self.ids)]
+
+    def encoding_of(self, key):
+        row = self.positions.get(key)
+        return None if row is None else self.buffer[row].copy()
+
+    def nearest(self, target_encoding, rows=None):
+        """Chiave più vicina: (chiave, distanza) o (None, inf)"""
+        if not self.ids or (rows is not None and len(rows) == 0):
+            return None, float("inf")
+        distances = distances_to(self.matrix(rows), target_encoding)
+        best = int(np.argmin(distances))
+        row = best if rows is None else int(rows[best])
+        return self.ids[row], float(distances[best])
+
+    def nearest_k(self, target_encoding, k, rows=None):
+        """Le `k` chiavi più vicine, in ordine di distanza: [(chiave, distanza)]"""
+        if not self.ids or (rows is not None and len(rows) == 0):
+            return []
+        distances = distances_to(self.matrix(rows), target_encoding)
+        closest = shortlist(distances, k)
+        closest = closest[np.argsort(distances[closest])]
+        return [
+            (
+                self.ids[int(index if rows is None else rows[index])],
+                float(distances[index]),
+            )
+            for index in closest
+        ]
+
+    def nearest_batch(self, target_encodings, rows=None):
+        """Chiave più vicina per ciascun encoding, con un'unica matrice di distanze"""
+        targets = np.asarray(target_encodings)
+        if not self.ids or (rows is not None and len(rows) == 0):
+            return [(None, float("inf"))] * len(targets)
+        distances = pairwise_distances(targets, self.matrix(rows))
+        best = np.argmin(distances, axis=1)
+        return [
+            (
+                self.ids[int(column if rows is None else rows[column])],
+                float(distances[target, column]),
+            )
+            for target, column in enumerate(best)
+        ]
+
+    def nbytes(self):
+        return self.buffer.nbytes if self.buffer is not None else 0
+
+
+def load_folder(folder):
+    """EncodingMatrix con tutti i file <chiave>.npy di una cartella"""
+    encodings = EncodingMatrix()
+    for filename in sorted(os.listdir(folder)):
+        if not filename.endswith(ENCODING_EXTENSION):
+            continue
+        encoding = np.load(os.path.join(folder, filename))
+        encodings.add(filename[: -len(ENCODING_EXTENSION)], encoding)
+    return encodings
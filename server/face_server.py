@@ -4,13 +4,35 @@ import os
 import uuid
 import sqlite3
 import json
+import time
+import threading
+import queue
+import hmac
+import hashlib
+import base64
+import math
+import random
+import signal
+import sys
+import cProfile
+import pstats
+import tracemalloc
+from collections import Counter, OrderedDict, deque
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g
+
+# I modelli dlib sono caricati all'import di face_recognition (prima fase dell'avvio)
+MODELS_IMPORT_STARTED_AT = time.time()
 import face_recognition
+
+MODELS_LOAD_SECONDS = time.time() - MODELS_IMPORT_STARTED_AT
 import numpy as np
 from PIL import Image
 import io
 
+import face_engine
+import photo_store
+
 app = Flask(__name__)
 
 # Configurazione
@@ -20,6 +42,118 @@ DATABASE = "face_db.db"
 SIMILARITY_THRESHOLD = 0.6  # Soglia per il riconoscimento (più basso = più strict)
 ACCESS_WINDOW_SECONDS = 60  # Tempo in secondi per accedere ai dati dopo riconoscimento
 
+# Registrazione del traffico (opt-in) per il replay con replay_trace.py
+TRACE_ENABLED = os.environ.get("FACE_TRACE_ENABLED", "0") == "1"
+TRACE_FOLDER = os.environ.get("FACE_TRACE_FOLDER", "face_traces")
+TRACE_SAVE_PHOTOS = os.environ.get("FACE_TRACE_PHOTOS", "0") == "1"
+# Header non sensibili riportati nel trace
+TRACE_HEADERS = ("X-Priority", "X-Request-Deadline-Ms")
+
+# Endpoint amministrativi (profilazione, memoria): disattivati se il token è vuoto
+ADMIN_TOKEN = os.environ.get("FACE_ADMIN_TOKEN", "")
+PROFILE_FOLDER = os.environ.get("FACE_PROFILE_FOLDER", "face_profiles")
+PROFILE_DEFAULT_SECONDS = 30
+SAMPLER_INTERVAL_MS = 10
+
+# Controllo di ammissione davanti alla fase di rilevamento/encoding
+ENCODING_CONCURRENCY = int(
+    os.environ.get("FACE_ENCODING_CONCURRENCY", os.cpu_count() or 2)
+)
+RECOGNITION_QUEUE_DEPTH = int(os.environ.get("FACE_QUEUE_DEPTH", 16))
+DEGRADED_MODE_ENABLED = os.environ.get("FACE_DEGRADED_MODE", "1") == "1"
+DEGRADED_QUEUE_THRESHOLD = 8  # Richieste in coda oltre le quali si degrada
+DEGRADED_MAX_DIMENSION = 480  # Lato massimo (px) dell'immagine in modalità degradata
+
+# Classi di priorità, dalla più alta alla più bassa
+PRIORITY_CLASSES = ("emergency", "routine", "bulk")
+DEFAULT_PRIORITY = "routine"
+PRIORITY_AGING_SECONDS = 2.0  # Ogni 2 s di attesa valgono una classe in più
+EMERGENCY_RESERVED_SLOTS = 4  # Posti in coda riservati alle emergenze
+
+# Insieme "caldo" dei pazienti riconosciuti di recente, cercato per primo
+HOT_SET_SIZE = 64
+EARLY_ACCEPT_THRESHOLD = 0.4  # Distanza sotto cui il match nel set caldo è accettato
+
+# Ricerca in due fasi: distanze approssimate su vettori ridotti con PCA (vedi
+# fit_pca.py), distanze esatte a 128 dimensioni solo sui candidati migliori
+PCA_MIN_GALLERY_SIZE = 5000  # Sotto questa soglia la ricerca esatta è già veloce
+PCA_SHORTLIST_SIZE = 100
+PCA_RELOAD_CHECK_SECONDS = 5  # Ogni quanto controllare se la proiezione è cambiata
+
+# Cache dei risultati per foto ripetute (retry del gateway, doppio tocco)
+RESULT_CACHE_TTL_SECONDS = 30
+RESULT_CACHE_MAX_ENTRIES = 256
+PHASH_MAX_DISTANCE = 4  # Bit diversi (su 64) entro cui due foto sono "uguali"
+# Hash percettivo vicino: il match si riusa solo se anche gli encoding coincidono
+# (stessa foto ricompressa), mai per una persona diversa nella stessa inquadratura
+RESULT_CACHE_ENCODING_TOLERANCE = 0.1
+
+# Gateway autorizzati a inviare encoding già calcolati (FACE_GATEWAY_KEYS="gw1:chiave,...")
+GATEWAY_KEYS = dict(
+    entry.strip().split(":", 1)
+    for entry in os.environ.get("FACE_GATEWAY_KEYS", "").split(",")
+    if ":" in entry
+)
+GATEWAY_MAX_CLOCK_SKEW_SECONDS = 60  # Finestra oltre cui una firma è considerata replay
+ENCODING_DIMENSIONS = 128
+GALLERY_SYNC_PAGE_SIZE = 500  # Modifiche per risposta di /gallery/changes
+# Ogni quanto la gallery in memoria controlla le modifiche scritte da altri processi
+GALLERY_SYNC_CHECK_SECONDS = float(os.environ.get("FACE_GALLERY_SYNC_SECONDS", 1.0))
+ACCESS_LOG_MAX_BATCH = 1000  # Voci per invio di log offline dai gateway
+
+# Sharding: ogni nodo possiede un intervallo di hash degli ID paziente (coordinator.py)
+SHARD_INDEX = int(os.environ.get("FACE_SHARD_INDEX", 0))
+SHARD_COUNT = int(os.environ.get("FACE_SHARD_COUNT", 1))
+SHARD_TOKEN = os.environ.get("FACE_SHARD_TOKEN", "")
+SERVER_PORT = int(os.environ.get("FACE_SERVER_PORT", 5000))
+DEBUG_MODE = os.environ.get("FACE_DEBUG", "1") == "1"
+
+# Registrazione asincrona: /register mette in coda, i worker fanno encoding e salvataggio
+REGISTRATION_ASYNC = os.environ.get("FACE_REGISTER_ASYNC", "1") == "1"
+REGISTRATION_WORKERS = int(os.environ.get("FACE_REGISTER_WORKERS", 2))
+REGISTRATION_MAX_ATTEMPTS = 3
+REGISTRATION_RETRY_SECONDS = 2.0  # Attesa prima del secondo tentativo, poi raddoppia
+REGISTRATION_LONG_POLL_MAX_SECONDS = 25
+
+# Controllo dei duplicati alla registrazione: di default la stessa soglia del riconoscimento
+DUPLICATE_THRESHOLD = float(
+    os.environ.get("FACE_DUPLICATE_THRESHOLD", SIMILARITY_THRESHOLD)
+)
+DUPLICATE_MAX_CANDIDATES = 5
+
+# Versioni degli encoding: ogni tag ha la sua cartella e le sue impostazioni (reencode_gallery.py)
+DEFAULT_ENCODING_SETTINGS = {
+    "detection_model": "hog",
+    "upsample": 1,
+    "encoding_model": "small",
+    "jitters": 1,
+}
+ENCODING_VERSION_CHECK_SECONDS = (
+    5  # Ogni quanto controllare se è attiva un'altra versione
+)
+
+# Avvio: fasi eseguite prima che /ready dichiari il server pronto
+STARTUP_PHASES = ("models", "database", "gallery", "warmup")
+STARTUP_OPEN_PATHS = ("/", "/ready", "/help")  # Raggiungibili anche durante l'avvio
+STARTUP_RETRY_AFTER_SECONDS = 5
+WARMUP_IMAGE_SIZE = 480  # Lato dell'immagine sintetica usata per il warm-up
+
+# Aggregati dei riconoscimenti per ora e per giorno (/stats/timeseries)
+ROLLUP_STEPS = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+ROLLUP_DEFAULT_BUCKETS = {"hour": 24, "day": 30}
+TIMESERIES_MAX_BUCKETS = 2000
+
+# Statistiche in diretta (/stats/stream): un solo produttore per tutti i client
+STATS_STREAM_INTERVAL_SECONDS = 1.0  # Al più un aggiornamento per intervallo
+STATS_STREAM_REFRESH_SECONDS = 10  # Ricalcolo anche senza scritture (sessioni scadute)
+STATS_STREAM_KEEPALIVE_SECONDS = 15
+STATS_STREAM_QUEUE_SIZE = 16  # Messaggi in attesa per client, poi si scartano i vecchi
+STATS_STREAM_MAX_SUBSCRIBERS = 100
+STATS_STREAM_MAX_EVENTS = 200  # Riconoscimenti per messaggio, gli altri solo contati
+
+# Fasi della pipeline tra cui si controlla la deadline inviata dal client
+PIPELINE_STAGES = ("decode", "detect", "encode", "match")
+
 # Crea cartelle necessarie
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(ENCODINGS_FOLDER, exist_ok=True)
@@ -31,6 +165,9 @@ def init_database():
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
 
+    # WAL: i lettori (backup_snapshot.py compreso) non bloccano le scritture
+    cursor.execute("PRAGMA journal_mode=WAL")
+
     # Tabella pazienti
     cursor.execute(
         """
@@ -66,6 +203,124 @@ def init_database():
         )
     """
     )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_recognition_log_time
+        ON recognition_log (recognition_time)
+    """
+    )
+
+    # Aggregati per ora e per giorno, aggiornati insieme al log (backfill_rollups.py)
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS recognition_rollups (
+            granularity TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            recognitions INTEGER NOT NULL DEFAULT 0,
+            successes INTEGER NOT NULL DEFAULT 0,
+            confidence_sum REAL NOT NULL DEFAULT 0,
+            confidence_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (granularity, bucket)
+        )
+    """
+    )
+
+    # Partizioni (struttura, reparto, ricovero) a cui appartiene un paziente
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS patient_partitions (
+            patient_id TEXT NOT NULL,
+            partition TEXT NOT NULL,
+            PRIMARY KEY (patient_id, partition)
+        )
+    """
+    )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_patient_partitions_partition
+        ON patient_partitions (partition)
+    """
+    )
+
+    # Modifiche della gallery in ordine di sequenza, per la sincronizzazione dei gateway
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS gallery_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id TEXT NOT NULL,
+            op TEXT NOT NULL,
+            changed_at TEXT
+        )
+    """
+    )
+    # Pazienti registrati prima della tabella: una voce "add" ciascuno
+    cursor.execute("SELECT COUNT(*) FROM gallery_changes")
+    if cursor.fetchone()[0] == 0:
+        cursor.execute(
+            """
+            INSERT INTO gallery_changes (patient_id, op, changed_at)
+            SELECT id, 'add', created_at FROM patients ORDER BY created_at
+        """
+        )
+
+    # Voci di log offline già ricevute dai gateway (invii ripetuti idempotenti)
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS gateway_log_receipts (
+            gateway_id TEXT NOT NULL,
+            entry_id TEXT NOT NULL,
+            received_at TEXT,
+            PRIMARY KEY (gateway_id, entry_id)
+        )
+    """
+    )
+
+    # Registrazioni in coda (l'ID del job coincide con l'ID del futuro paziente)
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS registration_jobs (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            priority TEXT,
+            fields TEXT,
+            partitions TEXT,
+            photo_path TEXT,
+            error TEXT,
+            created_at TEXT,
+            updated_at TEXT
+        )
+    """
+    )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_registration_jobs_status
+        ON registration_jobs (status)
+    """
+    )
+
+    # Registrazioni fermate come possibili duplicati, in attesa dell'operatore
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS duplicate_reviews (
+            job_id TEXT PRIMARY KEY,
+            candidates TEXT,
+            status TEXT NOT NULL,
+            created_at TEXT,
+            resolved_at TEXT
+        )
+    """
+    )
+
+    # Metadati della gallery (versione di encoding attiva e relative impostazioni)
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS gallery_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    """
+    )
 
     # Tabella sessioni di accesso (per controllo timer)
     cursor.execute(
@@ -78,10 +333,69 @@ def init_database():
     """
     )
 
+    # Archivio delle foto per contenuto (photo_store.py)
+    photo_store.init_tables(cursor)
+
     conn.commit()
     conn.close()
 
 
+# --- Deadline e fasi della pipeline ---
+class DeadlineExceeded(Exception):
+    """Il client ha già rinunciato alla richiesta (deadline superata)"""
+
+    def __init__(self, stage):
+        super().__init__(f"Deadline superata prima della fase '{stage}'")
+        self.stage = stage
+
+
+class PipelineMetrics:
+    """Durata media delle fasi e lavoro evitato grazie alle deadline"""
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.lock = threading.Lock()
+        self.stage_seconds = {stage: 0.0 for stage in stages}
+        self.aborted = {stage: 0 for stage in stages}
+        self.avoided_seconds = 0.0
+
+    def record(self, stage, seconds):
+        with self.lock:
+            previous = self.stage_seconds[stage]
+            self.stage_seconds[stage] = (
+                seconds if previous == 0.0 else 0.8 * previous + 0.2 * seconds
+            )
+
+    def check_deadline(self, deadline, stage):
+        """Interrompe la pipeline se la deadline è passata prima di `stage`"""
+        if deadline is None or time.time() <= deadline:
+            return
+        self.abort(stage)
+
+    def abort(self, stage):
+        """Registra il lavoro evitato da `stage` in poi e interrompe la pipeline"""
+        with self.lock:
+            self.aborted[stage] += 1
+            skipped = self.stages[self.stages.index(stage) :]
+            self.avoided_seconds += sum(self.stage_seconds[s] for s in skipped)
+        raise DeadlineExceeded(stage)
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "mean_stage_seconds": {
+                    stage: round(seconds, 4)
+                    for stage, seconds in self.stage_seconds.items()
+                },
+                "aborted_before_stage": dict(self.aborted),
+                "deadline_aborts": sum(self.aborted.values()),
+                "avoided_seconds_estimate": round(self.avoided_seconds, 3),
+            }
+
+
+pipeline = PipelineMetrics(PIPELINE_STAGES)
+
+
 # --- Utilità per gestione immagini ---
 def save_image(file, folder, filename):
     """Salva un'immagine nella cartella specificata"""
@@ -90,54 +404,173 @@ def save_image(file, folder, filename):
     return filepath
 
 
-def load_and_process_image(image_path):
-    """Carica e processa un'immagine per il riconoscimento facciale"""
+def load_and_process_faces(
+    image_path, max_dimension=None, deadline=None, max_faces=None, settings=None
+):
+    """Rileva e codifica tutti i volti di un'immagine con un'unica chiamata.
+
+    Restituisce (encodings, posizioni, errore). Le posizioni (top, right,
+    bottom, left) sono nelle coordinate dell'immagine originale anche in
+    modalità degradata. Con `max_faces` si rifiuta l'immagine prima dell'encoding.
+    Senza `settings` si usano quelle della versione di encoding attiva.
+    """
+    settings = settings or gallery.active_version()[1]
     try:
         # Carica l'immagine
+        pipeline.check_deadline(deadline, "decode")
+        started_at = time.time()
         image = face_recognition.load_image_file(image_path)
+        scale = 1.0
+
+        # Riduce la risoluzione di rilevamento (modalità degradata)
+        if max_dimension and max(image.shape[:2]) > max_dimension:
+            original_height = image.shape[0]
+            resized = Image.fromarray(image)
+            resized.thumbnail((max_dimension, max_dimension))
+            image = np.array(resized)
+            scale = original_height / image.shape[0]
+        pipeline.record("decode", time.time() - started_at)
 
         # Trova i volti nell'immagine
-        face_locations = face_recognition.face_locations(image)
+        pipeline.check_deadline(deadline, "detect")
+        started_at = time.time()
+        face_locations = face_recognition.face_locations(
+            image,
+            number_of_times_to_upsample=settings["upsample"],
+            model=settings["detection_model"],
+        )
+        pipeline.record("detect", time.time() - started_at)
 
         if not face_locations:
-            return None, "Nessun volto rilevato nell'immagine"
+            return [], [], "Nessun volto rilevato nell'immagine"
 
-        if len(face_locations) > 1:
+        if max_faces is not None and len(face_locations) > max_faces:
             return (
-                None,
+                [],
+                face_locations,
                 "Rilevati più volti. Assicurati che ci sia solo una persona nell'immagine",
             )
 
-        # Genera encoding del volto
-        face_encodings = face_recognition.face_encodings(image, face_locations)
+        # Genera gli encoding di tutti i volti in una sola passata
+        pipeline.check_deadline(deadline, "encode")
+        started_at = time.time()
+        face_encodings = face_recognition.face_encodings(
+            image,
+            face_locations,
+            num_jitters=settings["jitters"],
+            model=settings["encoding_model"],
+        )
+        pipeline.record("encode", time.time() - started_at)
 
         if not face_encodings:
-            return None, "Impossibile generare encoding del volto"
+            return [], face_locations, "Impossibile generare encoding del volto"
 
-        return face_encodings[0], None
+        locations = [
+            tuple(int(round(coordinate * scale)) for coordinate in location)
+            for location in face_locations
+        ]
+        return face_encodings, locations, None
 
+    except DeadlineExceeded:
+        raise
     except Exception as e:
-        return None, f"Errore nel processamento dell'immagine: {str(e)}"
+        return [], [], f"Errore nel processamento dell'immagine: {str(e)}"
+
+
+def load_and_process_image(
+    image_path, max_dimension=None, deadline=None, settings=None
+):
+    """Carica e processa un'immagine per il riconoscimento facciale"""
+    face_encoding, _, error = load_face_with_location(
+        image_path, max_dimension, deadline, settings
+    )
+    return face_encoding, error
+
+
+def load_face_with_location(
+    image_path, max_dimension=None, deadline=None, settings=None
+):
+    """Come load_and_process_image, con anche la posizione del volto (per il ritaglio)"""
+    face_encodings, locations, error = load_and_process_faces(
+        image_path, max_dimension, deadline, max_faces=1, settings=settings
+    )
+    if error:
+        return None, None, error
+    return face_encodings[0], locations[0], None
+
 
+def encode_for_registration(photo_path, deadline=None):
+    """Encoding di un nuovo paziente: (encoding, posizione, errore, tag della versione).
 
-def save_face_encoding(encoding, patient_id):
-    """Salva l'encoding del volto su file"""
-    encoding_path = os.path.join(ENCODINGS_FOLDER, f"{patient_id}.npy")
+    Tag e impostazioni si leggono insieme; se reencode_gallery.py attiva un'altra
+    versione durante l'encoding si ricodifica, così nella cartella di una
+    versione non finisce mai un encoding calcolato con il modello precedente.
+    """
+    for _ in range(2):
+        tag, settings = gallery.active_version()
+        face_encoding, face_location, error = load_face_with_location(
+            photo_path, deadline=deadline, settings=settings
+        )
+        if error or gallery.active_version()[0] == tag:
+            break
+    return face_encoding, face_location, error, tag
+
+
+def encodings_folder(tag=""):
+    """Cartella degli encoding di una versione ("" è la versione originale)"""
+    return os.path.join(ENCODINGS_FOLDER, tag) if tag else ENCODINGS_FOLDER
+
+
+def read_active_encoding_version():
+    """Tag e impostazioni della versione di encoding attiva"""
+    try:
+        conn = sqlite3.connect(DATABASE)
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT value FROM gallery_meta WHERE key = 'active_encoding_version'"
+        )
+        row = cursor.fetchone()
+        tag = row[0] if row else ""
+        cursor.execute(
+            "SELECT value FROM gallery_meta WHERE key = ?",
+            (f"encoding_settings:{tag}",),
+        )
+        row = cursor.fetchone()
+        conn.close()
+    except sqlite3.OperationalError:
+        # Database non ancora inizializzato: versione originale
+        return "", dict(DEFAULT_ENCODING_SETTINGS)
+    return tag, json.loads(row[0]) if row else dict(DEFAULT_ENCODING_SETTINGS)
+
+
+def save_face_encoding(encoding, patient_id, tag=None):
+    """Salva l'encoding del volto su file (nella cartella della versione attiva)"""
+    folder = encodings_folder(gallery.encoding_tag if tag is None else tag)
+    encoding_path = os.path.join(folder, f"{patient_id}.npy")
     np.save(encoding_path, encoding)
     return encoding_path
 
 
-def load_face_encoding(patient_id):
-    """Carica l'encoding del volto da file"""
-    encoding_path = os.path.join(ENCODINGS_FOLDER, f"{patient_id}.npy")
+def load_face_encoding(patient_id, tag=None):
+    """Carica l'encoding del volto da file (della versione attiva)"""
+    folder = encodings_folder(gallery.encoding_tag if tag is None else tag)
+    encoding_path = os.path.join(folder, f"{patient_id}.npy")
     if os.path.exists(encoding_path):
         return np.load(encoding_path)
     return None
 
 
 # --- Funzioni database ---
-def save_patient(patient_data):
-    """Salva un paziente nel database"""
+def record_gallery_change(cursor, patient_id, op):
+    """Accoda una modifica della gallery ("add", "remove" o "reset") per i gateway"""
+    cursor.execute(
+        "INSERT INTO gallery_changes (patient_id, op, changed_at) VALUES (?, ?, ?)",
+        (patient_id, op, datetime.now().isoformat()),
+    )
+
+
+def save_patient(patient_data, partitions=(), photo=None):
+    """Salva un paziente (con partizioni e foto in archivio) nel database"""
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
 
@@ -150,184 +583,2501 @@ def save_patient(patient_data):
     """,
         patient_data,
     )
+    cursor.executemany(
+        "INSERT OR IGNORE INTO patient_partitions (patient_id, partition) VALUES (?, ?)",
+        [(patient_data[0], partition) for partition in partitions],
+    )
+    if photo is not None:
+        photo_store.record_photo(cursor, photo, patient_data[0])
+    record_gallery_change(cursor, patient_data[0], "add")
 
     conn.commit()
     conn.close()
 
 
-def get_patient(patient_id):
-    """Recupera i dati di un paziente"""
+def update_partitions(patient_id, add=(), remove=()):
+    """Aggiorna le partizioni di un paziente nel database"""
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
 
-    cursor.execute("SELECT * FROM patients WHERE id = ?", (patient_id,))
-    result = cursor.fetchone()
+    cursor.executemany(
+        "INSERT OR IGNORE INTO patient_partitions (patient_id, partition) VALUES (?, ?)",
+        [(patient_id, partition) for partition in add],
+    )
+    cursor.executemany(
+        "DELETE FROM patient_partitions WHERE patient_id = ? AND partition = ?",
+        [(patient_id, partition) for partition in remove],
+    )
+    # Le partizioni fanno parte della replica: il paziente va reinviato
+    record_gallery_change(cursor, patient_id, "add")
+
+    conn.commit()
     conn.close()
 
-    if result:
-        # Parse JSON stored as text for lists
-        diseases = json.loads(result[8]) if result[8] else []
-        medications = json.loads(result[9]) if result[9] else []
 
-        return {
-            "id": result[0],
-            "name": result[1],
-            "surname": result[2],
-            "age": result[3],
-            "weight": result[4],
-            "height": result[5],
-            "blood_type": result[6],
-            "allergies": result[7],
-            "diseases": diseases,
-            "medications": medications,
-            "photo_path": result[10],
-            "face_encoding_path": result[11],
-            "created_at": result[12],
-            "updated_at": result[13],
-        }
-    return None
+def delete_patient(patient_id):
+    """Elimina un paziente con le sue partizioni e sessioni. False se non esiste"""
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+
+    cursor.execute(
+        "SELECT photo_path, face_encoding_path FROM patients WHERE id = ?",
+        (patient_id,),
+    )
+    row = cursor.fetchone()
+    if row is None:
+        conn.close()
+        return False
 
+    cursor.execute("DELETE FROM patients WHERE id = ?", (patient_id,))
+    cursor.execute("DELETE FROM patient_partitions WHERE patient_id = ?", (patient_id,))
+    cursor.execute("DELETE FROM access_sessions WHERE patient_id = ?", (patient_id,))
+    record_gallery_change(cursor, patient_id, "remove")
+    # Le foto in archivio si cancellano solo se nessun altro paziente le usa
+    released = photo_store.release_patient(cursor, patient_id)
 
-def log_recognition(patient_id, confidence, image_path, success):
-    """Registra un tentativo di riconoscimento"""
+    conn.commit()
+    conn.close()
+
+    photo_path, encoding_path = row
+    paths = [encoding_path] + (released if released is not None else [photo_path])
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
+    return True
+
+
+def gallery_changes_since(since, limit):
+    """Ultima modifica di ciascun paziente con seq > since, in ordine di seq.
+
+    Più modifiche dello stesso paziente collassano nell'ultima: una replica
+    ferma da giorni riceve solo lo stato finale e non tutta la storia.
+    """
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
 
-    now = datetime.now()
+    # Con MAX() SQLite restituisce le altre colonne della stessa riga
+    cursor.execute(
+        """
+        SELECT patient_id, op, MAX(seq) AS last_seq
+        FROM gallery_changes
+        WHERE seq > ?
+        GROUP BY patient_id
+        ORDER BY last_seq
+        LIMIT ?
+    """,
+        (since, limit + 1),
+    )
+    changes = cursor.fetchall()
+    cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM gallery_changes")
+    current_seq = cursor.fetchone()[0]
+
+    more = len(changes) > limit
+    changes = changes[:limit]
+    memberships = {}
+    added = [patient_id for patient_id, op, _ in changes if op == "add"]
+    if added:
+        placeholders = ",".join("?" * len(added))
+        cursor.execute(
+            f"SELECT patient_id, partition FROM patient_partitions "
+            f"WHERE patient_id IN ({placeholders})",
+            added,
+        )
+        for patient_id, partition in cursor.fetchall():
+            memberships.setdefault(patient_id, []).append(partition)
+
+    conn.close()
+    return changes, memberships, current_seq, more
+
+
+def rollup_bucket(granularity, recognition_time):
+    """Inizio dell'ora ("2024-05-01T13:00:00") o del giorno ("2024-05-01")"""
+    if granularity == "hour":
+        return recognition_time[:13].replace(" ", "T") + ":00:00"
+    return recognition_time[:10]
+
+
+# Stessi bucket di rollup_bucket, calcolati in SQL (backfill_rollups.py)
+ROLLUP_BUCKET_SQL = {
+    "hour": "replace(substr(recognition_time, 1, 13), ' ', 'T') || ':00:00'",
+    "day": "substr(recognition_time, 1, 10)",
+}
+
 
+def insert_recognition_row(
+    cursor, patient_id, recognition_time, confidence, image_path, success
+):
+    """Inserisce una riga nel log dei riconoscimenti (condivisa da tutti i percorsi).
+
+    Nella stessa transazione aggiorna gli aggregati orari e giornalieri. La
+    confidenza media è quella dei riconoscimenti riusciti: i falliti hanno 0.
+    """
     cursor.execute(
         """
-        INSERT INTO recognition_log (patient_id, recognition_time, confidence, 
+        INSERT INTO recognition_log (patient_id, recognition_time, confidence,
                                    image_path, success)
         VALUES (?, ?, ?, ?, ?)
     """,
-        (patient_id, now.isoformat(), confidence, image_path, success),
+        (patient_id, recognition_time, confidence, image_path, success),
     )
-
-    # Se il riconoscimento è riuscito, crea/aggiorna la sessione di accesso
-    if success and patient_id:
-        valid_until = now + timedelta(seconds=ACCESS_WINDOW_SECONDS)
+    if not recognition_time:
+        return
+    counted = bool(success) and confidence is not None
+    for granularity in ROLLUP_STEPS:
         cursor.execute(
             """
-            INSERT OR REPLACE INTO access_sessions 
-            (patient_id, last_recognition_time, session_valid_until)
-            VALUES (?, ?, ?)
+            INSERT INTO recognition_rollups (granularity, bucket, recognitions,
+                                             successes, confidence_sum, confidence_count)
+            VALUES (?, ?, 1, ?, ?, ?)
+            ON CONFLICT (granularity, bucket) DO UPDATE SET
+                recognitions = recognitions + 1,
+                successes = successes + excluded.successes,
+                confidence_sum = confidence_sum + excluded.confidence_sum,
+                confidence_count = confidence_count + excluded.confidence_count
         """,
-            (patient_id, now.isoformat(), valid_until.isoformat()),
+            (
+                granularity,
+                rollup_bucket(granularity, recognition_time),
+                1 if success else 0,
+                confidence if counted else 0.0,
+                1 if counted else 0,
+            ),
         )
 
-    conn.commit()
-    conn.close()
 
+def rollup_floor(granularity, moment):
+    """Inizio del bucket che contiene `moment`"""
+    moment = moment.replace(minute=0, second=0, microsecond=0)
+    return moment if granularity == "hour" else moment.replace(hour=0)
 
-def check_access_permission(patient_id):
-    """Verifica se è possibile accedere ai dati del paziente"""
+
+def local_datetime(value):
+    """Data ISO in ora locale senza fuso, come recognition_time"""
+    if not isinstance(value, str):
+        raise TypeError("Data non in formato ISO")
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+
+def recognition_timeseries(granularity, start, end):
+    """Aggregati dei bucket da `start` (incluso) a `end` (escluso), senza buchi"""
+    step = ROLLUP_STEPS[granularity]
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
-
     cursor.execute(
         """
-        SELECT session_valid_until FROM access_sessions 
-        WHERE patient_id = ?
+        SELECT bucket, recognitions, successes, confidence_sum, confidence_count
+        FROM recognition_rollups
+        WHERE granularity = ? AND bucket >= ? AND bucket < ?
     """,
-        (patient_id,),
+        (
+            granularity,
+            rollup_bucket(granularity, start.isoformat()),
+            rollup_bucket(granularity, end.isoformat()),
+        ),
     )
-
-    result = cursor.fetchone()
+    rows = {row[0]: row[1:] for row in cursor.fetchall()}
     conn.close()
 
-    if not result:
-        return False, "Nessuna sessione di riconoscimento valida trovata"
-
-    valid_until = datetime.fromisoformat(result[0])
-    now = datetime.now()
-
-    if now > valid_until:
-        return (
-            False,
-            "Sessione di accesso scaduta. Eseguire nuovamente il riconoscimento",
+    series = []
+    current = start
+    while current < end:
+        bucket = rollup_bucket(granularity, current.isoformat())
+        recognitions, successes, confidence_sum, confidence_count = rows.get(
+            bucket, (0, 0, 0.0, 0)
         )
-
-    remaining_seconds = int((valid_until - now).total_seconds())
-    return (
-        True,
-        f"Accesso autorizzato. Sessione valida per altri {remaining_seconds} secondi",
+        series.append(
+            {
+                "bucket": bucket,
+                "recognitions": recognitions,
+                "successes": successes,
+                "success_rate": (
+                    round(successes / recognitions * 100, 2) if recognitions else None
+                ),
+                "mean_confidence": (
+                    round(confidence_sum / confidence_count, 4)
+                    if confidence_count
+                    else None
+                ),
+            }
+        )
+        current += step
+    return series
+
+
+def store_registered_patient(
+    patient_id,
+    fields,
+    partitions,
+    photo_path,
+    face_encoding,
+    face_location=None,
+    tag=None,
+):
+    """Salva encoding e anagrafica di un paziente appena codificato.
+
+    Con la posizione del volto la foto caricata passa nell'archivio per
+    contenuto e il paziente punta al ritaglio del volto. `tag` è la versione
+    con cui è stato calcolato l'encoding (di norma quella attiva).
+    """
+    tag = gallery.encoding_tag if tag is None else tag
+    encoding_path = save_face_encoding(face_encoding, patient_id, tag=tag)
+
+    timestamp = datetime.now().isoformat()
+    photo = None
+    upload_path = photo_path
+    if face_location is not None:
+        photo = photo_store.store_photo(upload_path, face_location, timestamp)
+        photo_path = photo["crop_path"]
+    patient_data = (
+        patient_id,
+        fields["name"],
+        fields["surname"],
+        fields["age"],
+        fields["weight"],
+        fields["height"],
+        fields["blood_type"],
+        fields["allergies"],
+        json.dumps(fields["diseases"]),
+        json.dumps(fields["medications"]),
+        photo_path,
+        encoding_path,
+        timestamp,
+        timestamp,
     )
-
-
-def cleanup_expired_sessions():
-    """Rimuove le sessioni scadute dal database"""
+    save_patient(patient_data, partitions, photo)
+    if photo is not None and os.path.exists(upload_path):
+        os.remove(upload_path)
+    # Versione cambiata proprio ora: il paziente arriva alla nuova gallery con
+    # la ricodifica dei ritardatari di reencode_gallery.py, non con questo encoding
+    if tag == gallery.encoding_tag:
+        gallery.add(patient_id, face_encoding, partitions)
+        hot_set.touch(patient_id, face_encoding)
+
+
+def create_registration_job(job_id, fields, partitions, photo_path, priority):
+    """Inserisce un job di registrazione in stato "queued" """
     conn = sqlite3.connect(DATABASE)
     cursor = conn.cursor()
 
     now = datetime.now().isoformat()
     cursor.execute(
         """
-        DELETE FROM access_sessions 
-        WHERE session_valid_until < ?
+        INSERT INTO registration_jobs (id, status, attempts, priority, fields,
+                                       partitions, photo_path, created_at, updated_at)
+        VALUES (?, 'queued', 0, ?, ?, ?, ?, ?, ?)
     """,
-        (now,),
+        (
+            job_id,
+            priority,
+            json.dumps(fields),
+            json.dumps(partitions),
+            photo_path,
+            now,
+            now,
+        ),
     )
 
     conn.commit()
     conn.close()
 
 
-# --- Riconoscimento facciale ---
-def find_matching_patient(target_encoding):
-    """Trova il paziente corrispondente all'encoding fornito"""
-    best_match = None
-    best_confidence = float("inf")
-
-    # Carica tutti i pazienti
+def get_registration_job(job_id):
+    """Recupera un job di registrazione (None se non esiste)"""
     conn = sqlite3.connect(DATABASE)
+    conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
-    cursor.execute("SELECT id FROM patients")
-    patient_ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT * FROM registration_jobs WHERE id = ?", (job_id,))
+    row = cursor.fetchone()
     conn.close()
 
-    # Confronta con ogni paziente registrato
-    for patient_id in patient_ids:
-        stored_encoding = load_face_encoding(patient_id)
+    if row is None:
+        return None
+    job = dict(row)
+    job["fields"] = json.loads(job["fields"])
+    job["partitions"] = json.loads(job["partitions"])
+    return job
 
-        if stored_encoding is not None:
-            # Calcola la distanza (più bassa = più simile)
-            distance = face_recognition.face_distance(
-                [stored_encoding], target_encoding
-            )[0]
 
-            if distance < best_confidence:
-                best_confidence = distance
-                best_match = patient_id
+def update_registration_job(job_id, status, attempts=None, error=None):
+    """Aggiorna stato, tentativi ed errore di un job"""
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
 
-    # Verifica se il match è abbastanza buono
-    if best_match and best_confidence < SIMILARITY_THRESHOLD:
-        return best_match, 1.0 - best_confidence  # Converte distanza in confidenza
+    cursor.execute(
+        """
+        UPDATE registration_jobs
+        SET status = ?, attempts = COALESCE(?, attempts), error = ?, updated_at = ?
+        WHERE id = ?
+    """,
+        (status, attempts, error, datetime.now().isoformat(), job_id),
+    )
 
-    return None, 0.0
+    conn.commit()
+    conn.close()
 
 
-# --- API Endpoints ---
+def find_duplicate_candidates(face_encoding):
+    """Pazienti già registrati che potrebbero essere la stessa persona"""
+    return gallery.search_candidates(
+        face_encoding, DUPLICATE_MAX_CANDIDATES, DUPLICATE_THRESHOLD
+    )
 
 
-@app.route("/help", methods=["GET"])
-def help_info():
-    """Mostra le informazioni di aiuto per l'API"""
-    return (
-        jsonify(
-            {
-                "message": "Benvenuto nel Secure Face Recognition Server",
-                "version": "2.0.0",
-                "endpoints": {
-                    "/": "Controllo stato del server",
-                    "/register": "Registra un nuovo paziente con foto",
-                    "/recognize": "Riconosce un paziente dalla foto",
+def save_duplicate_review(job_id, candidates, status="pending"):
+    """Salva i candidati di una registrazione sospetta ("confirmed" = nessun controllo)"""
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+
+    cursor.execute(
+        """
+        INSERT OR REPLACE INTO duplicate_reviews
+        (job_id, candidates, status, created_at, resolved_at)
+        VALUES (?, ?, ?, ?, NULL)
+    """,
+        (job_id, json.dumps(candidates), status, datetime.now().isoformat()),
+    )
+
+    conn.commit()
+    conn.close()
+
+
+def get_duplicate_review(job_id):
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT candidates, status FROM duplicate_reviews WHERE job_id = ?", (job_id,)
+    )
+    row = cursor.fetchone()
+    conn.close()
+    if row is None:
+        return None
+    return {"candidates": json.loads(row[0]), "status": row[1]}
+
+
+def resolve_duplicate_review(job_id, status):
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE duplicate_reviews SET status = ?, resolved_at = ? WHERE job_id = ?",
+        (status, datetime.now().isoformat(), job_id),
+    )
+    conn.commit()
+    conn.close()
+
+
+def duplicate_response_body(job_id, candidates):
+    """Risposta per una registrazione sospetta: l'operatore conferma o annulla"""
+    return {
+        "success": False,
+        "status": "duplicate_suspected",
+        "job_id": job_id,
+        "message": "Possibile paziente già registrato: confermare o annullare",
+        "candidates": [
+            {"id": patient_id, "confidence": round(1.0 - distance, 4)}
+            for patient_id, distance in candidates
+        ],
+        "confirm_url": f"/register-confirm/{job_id}",
+    }
+
+
+def get_patient(patient_id):
+    """Recupera i dati di un paziente"""
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+
+    cursor.execute("SELECT * FROM patients WHERE id = ?", (patient_id,))
+    result = cursor.fetchone()
+    conn.close()
+
+    if result:
+        # Parse JSON stored as text for lists
+        diseases = json.loads(result[8]) if result[8] else []
+        medications = json.loads(result[9]) if result[9] else []
+
+        return {
+            "id": result[0],
+            "name": result[1],
+            "surname": result[2],
+            "age": result[3],
+            "weight": result[4],
+            "height": result[5],
+            "blood_type": result[6],
+            "allergies": result[7],
+            "diseases": diseases,
+            "medications": medications,
+            "photo_path": result[10],
+            "face_encoding_path": result[11],
+            "created_at": result[12],
+            "updated_at": result[13],
+        }
+    return None
+
+
+def log_recognition(patient_id, confidence, image_path, success):
+    """Registra un tentativo di riconoscimento"""
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+
+    now = datetime.now()
+
+    insert_recognition_row(
+        cursor, patient_id, now.isoformat(), confidence, image_path, success
+    )
+
+    # Se il riconoscimento è riuscito, crea/aggiorna la sessione di accesso
+    if success and patient_id:
+        valid_until = now + timedelta(seconds=ACCESS_WINDOW_SECONDS)
+        cursor.execute(
+            """
+            INSERT OR REPLACE INTO access_sessions 
+            (patient_id, last_recognition_time, session_valid_until)
+            VALUES (?, ?, ?)
+        """,
+            (patient_id, now.isoformat(), valid_until.isoformat()),
+        )
+
+    conn.commit()
+    conn.close()
+    stats_stream.notify_recognition(now.isoformat(), confidence, success)
+
+    if success and patient_id:
+        hot_set.touch(patient_id)
+
+
+def check_access_permission(patient_id):
+    """Verifica se è possibile accedere ai dati del paziente"""
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+
+    cursor.execute(
+        """
+        SELECT session_valid_until FROM access_sessions 
+        WHERE patient_id = ?
+    """,
+        (patient_id,),
+    )
+
+    result = cursor.fetchone()
+    conn.close()
+
+    if not result:
+        return False, "Nessuna sessione di riconoscimento valida trovata"
+
+    valid_until = datetime.fromisoformat(result[0])
+    now = datetime.now()
+
+    if now > valid_until:
+        return (
+            False,
+            "Sessione di accesso scaduta. Eseguire nuovamente il riconoscimento",
+        )
+
+    remaining_seconds = int((valid_until - now).total_seconds())
+    return (
+        True,
+        f"Accesso autorizzato. Sessione valida per altri {remaining_seconds} secondi",
+    )
+
+
+def cleanup_expired_sessions():
+    """Rimuove le sessioni scadute dal database"""
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+
+    now = datetime.now().isoformat()
+    cursor.execute(
+        """
+        DELETE FROM access_sessions 
+        WHERE session_valid_until < ?
+    """,
+        (now,),
+    )
+
+    conn.commit()
+    conn.close()
+
+
+# --- Riconoscimento facciale ---
+class HotSet:
+    """Pazienti riconosciuti o registrati di recente, in ordine di recency.
+
+    La maggior parte dei riconoscimenti in reparto riguarda pazienti visti da
+    poco: se uno di loro è sotto la soglia stretta di early accept, la scansione
+    completa della gallery viene saltata.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()  # patient_id -> encoding, più recente in fondo
+        self.lock = threading.Lock()
+        self.matrix = None
+        self.matrix_ids = []
+        self.early_accepts = 0
+        self.full_scans = 0
+
+    def seed_from_log(self):
+        """Popola il set dai riconoscimenti riusciti più recenti"""
+        conn = sqlite3.connect(DATABASE)
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT patient_id, MAX(recognition_time) AS last_seen
+            FROM recognition_log
+            WHERE success = 1 AND patient_id IS NOT NULL
+            GROUP BY patient_id
+            ORDER BY last_seen DESC
+            LIMIT ?
+        """,
+            (self.size,),
+        )
+        patient_ids = [row[0] for row in cursor.fetchall()]
+        conn.close()
+
+        for patient_id in reversed(patient_ids):
+            self.touch(patient_id)
+
+    def touch(self, patient_id, encoding=None):
+        """Porta il paziente in cima al set (caricandone l'encoding se serve)"""
+        with self.lock:
+            if patient_id in self.entries:
+                self.entries.move_to_end(patient_id)
+                if encoding is None:
+                    return
+        if encoding is None:
+            encoding = load_face_encoding(patient_id)
+            if encoding is None:
+                return
+
+        with self.lock:
+            self.entries[patient_id] = encoding
+            self.entries.move_to_end(patient_id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+            self.matrix = None
+
+    def discard(self, patient_id):
+        with self.lock:
+            if self.entries.pop(patient_id, None) is not None:
+                self.matrix = None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.matrix = None
+
+    def search(self, target_encoding, allowed=None):
+        """Paziente più vicino nel set caldo: (patient_id, distanza) o (None, inf).
+
+        `allowed` limita la ricerca a un insieme di ID (es. membri di una partizione).
+        """
+        with self.lock:
+            if not self.entries:
+                return None, float("inf")
+            if self.matrix is None:
+                self.matrix_ids = list(self.entries.keys())
+                self.matrix = np.array(list(self.entries.values()))
+            matrix, matrix_ids = self.matrix, self.matrix_ids
+
+        distances = face_engine.distances_to(matrix, target_encoding)
+        if allowed is not None:
+            mask = np.fromiter(
+                (patient_id in allowed for patient_id in matrix_ids),
+                dtype=bool,
+                count=len(matrix_ids),
+            )
+            if not mask.any():
+                return None, float("inf")
+            distances = np.where(mask, distances, np.inf)
+        best = int(np.argmin(distances))
+        return matrix_ids[best], float(distances[best])
+
+    def record(self, early_accept):
+        with self.lock:
+            if early_accept:
+                self.early_accepts += 1
+            else:
+                self.full_scans += 1
+
+    def memory_bytes(self):
+        with self.lock:
+            return sum(encoding.nbytes for encoding in self.entries.values())
+
+    def metrics(self):
+        with self.lock:
+            searches = self.early_accepts + self.full_scans
+            return {
+                "size": len(self.entries),
+                "capacity": self.size,
+                "early_accepts": self.early_accepts,
+                "full_scans": self.full_scans,
+                "early_accept_rate": (
+                    round(self.early_accepts / searches, 4) if searches else 0.0
+                ),
+                "early_accept_threshold": EARLY_ACCEPT_THRESHOLD,
+            }
+
+
+hot_set = HotSet(HOT_SET_SIZE)
+
+
+class GalleryIndex(face_engine.EncodingMatrix):
+    """Encoding di tutti i pazienti in memoria, con le loro partizioni.
+
+    Evita di rileggere i file .npy a ogni riconoscimento: le distanze sono
+    calcolate dal motore condiviso (face_engine) e le modifiche (nuovi
+    pazienti, cambi di partizione) sono applicate in modo incrementale.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.version = 0
+        self.partitions = {}  # partizione -> set di patient_id
+        self.partition_rows = {}  # cache: partizione -> array di righe
+        # Prefiltro PCA: media, componenti e vettori ridotti riga per riga
+        self.projection = None
+        self.reduced = None
+        self.projection_mtime = None
+        self.projection_checked_at = 0.0
+        self.prefilter_min_size = PCA_MIN_GALLERY_SIZE
+        self.prefilter_searches = 0
+        # Versione degli encoding in memoria (cartella e impostazioni del modello)
+        self.encoding_tag = ""
+        self.encoding_settings = dict(DEFAULT_ENCODING_SETTINGS)
+        self.version_checked_at = 0.0
+        self.version_lock = threading.Lock()
+        # Modifiche di altri processi (importazioni, altri server): ultima seq
+        # di gallery_changes applicata e PRAGMA data_version dell'ultimo controllo
+        self.applied_seq = 0
+        self.synced_at = 0.0
+        self.data_version = None
+        self.sync_conn = None
+        self.sync_lock = threading.Lock()
+        self.incremental_syncs = 0
+
+    def ensure_loaded(self):
+        with self.lock:
+            if not self.loaded:
+                self.load()
+                return
+        if time.time() - self.synced_at > GALLERY_SYNC_CHECK_SECONDS:
+            self.sync_changes()
+        if time.time() - self.version_checked_at > ENCODING_VERSION_CHECK_SECONDS:
+            self.check_encoding_version()
+
+    def check_encoding_version(self):
+        """Passa alla versione di encoding attivata da reencode_gallery.py"""
+        with self.version_lock:
+            self.version_checked_at = time.time()
+            tag, _ = read_active_encoding_version()
+            if tag == self.encoding_tag:
+                return
+            self.reload_all()
+
+    def active_version(self):
+        """Tag e impostazioni della versione attiva, controllata subito e letti insieme"""
+        self.ensure_loaded()
+        self.check_encoding_version()
+        with self.lock:
+            return self.encoding_tag, self.encoding_settings
+
+    def reload_all(self):
+        self.load()
+        # Encoding calcolati con il modello precedente: non più confrontabili
+        hot_set.clear()
+        result_cache.clear()
+
+    def sync_changes(self):
+        """Applica le modifiche della gallery committate da altri processi.
+
+        PRAGMA data_version cambia solo quando un'altra connessione scrive nel
+        database: finché resta uguale il controllo costa una query. Altrimenti
+        si leggono da gallery_changes solo le modifiche successive a
+        applied_seq e si caricano i soli encoding aggiunti.
+        """
+        if not self.sync_lock.acquire(blocking=False):
+            return  # Un'altra richiesta sta già sincronizzando
+        try:
+            self.synced_at = time.time()
+            if self.sync_conn is None:
+                self.sync_conn = sqlite3.connect(DATABASE, check_same_thread=False)
+            data_version = self.sync_conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self.data_version:
+                return
+            self.data_version = data_version
+
+            while True:
+                changes, memberships, _, more = gallery_changes_since(
+                    self.applied_seq, GALLERY_SYNC_PAGE_SIZE
+                )
+                if not changes:
+                    return
+                if any(op == "reset" for _, op, _ in changes):
+                    # Nuova versione di encoding: si ricarica tutto
+                    self.reload_all()
+                    return
+                self.apply_changes(changes, memberships)
+                if not more:
+                    return
+        finally:
+            self.sync_lock.release()
+
+    def apply_changes(self, changes, memberships):
+        # I file si leggono fuori dal lock, come in load()
+        encodings = {
+            patient_id: load_face_encoding(patient_id, self.encoding_tag)
+            for patient_id, op, _ in changes
+            if op == "add"
+        }
+        with self.lock:
+            for patient_id, op, _ in changes:
+                encoding = encodings.get(patient_id)
+                if encoding is None:
+                    self.remove(patient_id)
+                    hot_set.discard(patient_id)
+                    continue
+                previous = super().encoding_of(patient_id)
+                if previous is not None and not np.array_equal(previous, encoding):
+                    hot_set.discard(patient_id)
+                self._append(patient_id, encoding)
+                # Le partizioni arrivano complete: si sostituiscono quelle note
+                current = set(memberships.get(patient_id, ()))
+                for partition, members in self.partitions.items():
+                    if partition not in current:
+                        members.discard(patient_id)
+                for partition in current:
+                    self.partitions.setdefault(partition, set()).add(patient_id)
+            self.partition_rows = {}
+            self.applied_seq = changes[-1][2]
+            self.incremental_syncs += 1
+            self.version += 1
+
+    def load(self):
+        """Carica (o ricarica) tutta la gallery da database e file.
+
+        La nuova gallery è costruita fuori dal lock e sostituita in un colpo
+        solo: le ricerche in corso vedono la versione vecchia o quella nuova,
+        mai un misto delle due.
+        """
+        tag, settings = read_active_encoding_version()
+        conn = sqlite3.connect(DATABASE)
+        cursor = conn.cursor()
+        # Letta per prima: le modifiche durante il caricamento saranno riapplicate
+        cursor.execute("SELECT COALESCE(MAX(seq), 0) FROM gallery_changes")
+        applied_seq = cursor.fetchone()[0]
+        cursor.execute("SELECT id FROM patients")
+        patient_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT patient_id, partition FROM patient_partitions")
+        memberships = cursor.fetchall()
+        conn.close()
+
+        fresh = GalleryIndex()
+        for patient_id in patient_ids:
+            encoding = load_face_encoding(patient_id, tag)
+            if encoding is not None:
+                fresh._append(patient_id, encoding)
+        partitions = {}
+        for patient_id, partition in memberships:
+            partitions.setdefault(partition, set()).add(patient_id)
+
+        with self.lock:
+            self.ids = fresh.ids
+            self.positions = fresh.positions
+            self.buffer = fresh.buffer
+            self.partitions = partitions
+            self.partition_rows = {}
+            if tag != self.encoding_tag:
+                # La proiezione PCA dipende dal modello: si ricarica quella della versione
+                self.projection = None
+                self.projection_mtime = None
+                self.projection_checked_at = 0.0
+            self.set_projection(self.projection)
+            self.encoding_tag = tag
+            self.encoding_settings = settings
+            self.version_checked_at = time.time()
+            self.applied_seq = applied_seq
+            self.loaded = True
+            self.version += 1
+
+    def projection_path(self):
+        return os.path.join(encodings_folder(self.encoding_tag), "pca_projection.npz")
+
+    def load_projection(self):
+        """Carica la proiezione PCA salvata accanto agli encoding (se esiste)"""
+        self.projection_checked_at = time.time()
+        try:
+            mtime = os.path.getmtime(self.projection_path())
+        except OSError:
+            if self.projection is not None:
+                self.set_projection(None)
+            return
+        if mtime == self.projection_mtime:
+            return
+
+        with np.load(self.projection_path()) as data:
+            projection = {"mean": data["mean"], "components": data["components"]}
+        with self.lock:
+            self.set_projection(projection)
+            self.projection_mtime = mtime
+
+    def set_projection(self, projection):
+        """Imposta la proiezione e ricalcola i vettori ridotti di tutta la gallery"""
+        with self.lock:
+            self.projection = projection
+            self.reduced = None
+            if projection is None or self.buffer is None:
+                return
+            self.reduced = np.empty((len(self.buffer), len(projection["components"])))
+            count = len(self.ids)
+            self.reduced[:count] = self.project(self.buffer[:count])
+
+    def project(self, encodings):
+        return (encodings - self.projection["mean"]) @ self.projection["components"].T
+
+    def _append(self, patient_id, encoding):
+        row = super()._append(patient_id, encoding)
+        if self.projection is not None:
+            if self.reduced is None or len(self.reduced) < len(self.buffer):
+                grown = np.empty((len(self.buffer), len(self.projection["components"])))
+                if self.reduced is not None:
+                    grown[:row] = self.reduced[:row]
+                self.reduced = grown
+            self.reduced[row] = self.project(encoding)
+
+    def add(self, patient_id, encoding, partitions=()):
+        with self.lock:
+            if not self.loaded:
+                return  # Sarà letto dal database al primo caricamento
+            self._append(patient_id, encoding)
+            for partition in partitions:
+                self.partitions.setdefault(partition, set()).add(patient_id)
+                self.partition_rows.pop(partition, None)
+            self.version += 1
+
+    def remove(self, patient_id):
+        with self.lock:
+            moved = self._remove(patient_id)
+            if moved is None:
+                return
+            # I vettori ridotti seguono lo stesso spostamento di righe
+            position, last = moved
+            if self.reduced is not None and position != last:
+                self.reduced[position] = self.reduced[last]
+            for members in self.partitions.values():
+                members.discard(patient_id)
+            self.partition_rows = {}
+            self.version += 1
+
+    def update_partitions(self, patient_id, add=(), remove=()):
+        with self.lock:
+            if not self.loaded:
+                return
+            for partition in add:
+                self.partitions.setdefault(partition, set()).add(patient_id)
+                self.partition_rows.pop(partition, None)
+            for partition in remove:
+                self.partitions.get(partition, set()).discard(patient_id)
+                self.partition_rows.pop(partition, None)
+            self.version += 1
+
+    def encoding_of(self, patient_id):
+        self.ensure_loaded()
+        with self.lock:
+            return super().encoding_of(patient_id)
+
+    def partitions_of(self, patient_id):
+        self.ensure_loaded()
+        with self.lock:
+            return sorted(
+                partition
+                for partition, members in self.partitions.items()
+                if patient_id in members
+            )
+
+    def partition_members(self, partitions):
+        self.ensure_loaded()
+        with self.lock:
+            members = set()
+            for partition in partitions:
+                members |= self.partitions.get(partition, set())
+            return members
+
+    def _rows(self, partitions):
+        arrays = []
+        for partition in partitions:
+            rows = self.partition_rows.get(partition)
+            if rows is None:
+                rows = np.array(
+                    sorted(
+                        self.positions[patient_id]
+                        for patient_id in self.partitions.get(partition, ())
+                        if patient_id in self.positions
+                    ),
+                    dtype=np.intp,
+                )
+                self.partition_rows[partition] = rows
+            arrays.append(rows)
+        return np.unique(np.concatenate(arrays)) if arrays else np.empty(0, np.intp)
+
+    def _search_rows(self, target_encoding, partitions):
+        """Righe in cui cercare: quelle delle partizioni, ristrette dal prefiltro PCA.
+
+        None indica tutta la gallery. Va chiamata con il lock acquisito.
+        """
+        if partitions:
+            rows = self._rows(partitions)
+            if len(rows) == 0:
+                return rows
+        else:
+            rows = np.arange(len(self.ids))
+
+        # Prima fase: distanze approssimate sui vettori ridotti
+        all_rows = partitions is None
+        if self.reduced is not None and len(rows) >= self.prefilter_min_size:
+            self.prefilter_searches += 1
+            reduced = self.reduced[: len(self.ids)] if all_rows else self.reduced[rows]
+            approximate = face_engine.distances_to(
+                reduced, self.project(target_encoding)
+            )
+            rows = rows[face_engine.shortlist(approximate, PCA_SHORTLIST_SIZE)]
+            all_rows = False
+        return None if all_rows else rows
+
+    def search(self, target_encoding, partitions=None):
+        """Paziente più vicino: (patient_id, distanza) o (None, inf)"""
+        self.ensure_loaded()
+        if time.time() - self.projection_checked_at > PCA_RELOAD_CHECK_SECONDS:
+            self.load_projection()
+
+        with self.lock:
+            if not self.ids:
+                return None, float("inf")
+            # Distanze esatte (sulla shortlist o su tutti i candidati)
+            rows = self._search_rows(target_encoding, partitions)
+            return self.nearest(target_encoding, rows)
+
+    def search_candidates(self, target_encoding, k, max_distance):
+        """Fino a `k` pazienti entro `max_distance`, i più vicini per primi"""
+        self.ensure_loaded()
+        if time.time() - self.projection_checked_at > PCA_RELOAD_CHECK_SECONDS:
+            self.load_projection()
+
+        with self.lock:
+            rows = self._search_rows(target_encoding, None)
+            return [
+                (patient_id, distance)
+                for patient_id, distance in self.nearest_k(target_encoding, k, rows)
+                if distance < max_distance
+            ]
+
+    def search_batch(self, target_encodings, partitions=None):
+        """Paziente più vicino per ciascun encoding, con un'unica matrice di distanze"""
+        self.ensure_loaded()
+        with self.lock:
+            rows = self._rows(partitions) if partitions else None
+            return self.nearest_batch(target_encodings, rows)
+
+    def memory_bytes(self):
+        with self.lock:
+            return self.nbytes() + (
+                self.reduced.nbytes if self.reduced is not None else 0
+            )
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "loaded": self.loaded,
+                "patients": len(self.ids),
+                "partitions": {
+                    partition: len(members)
+                    for partition, members in sorted(self.partitions.items())
+                },
+                "version": self.version,
+                "encoding_version": self.encoding_tag,
+                "applied_seq": self.applied_seq,
+                "incremental_syncs": self.incremental_syncs,
+                "pca_dimensions": (
+                    len(self.projection["components"])
+                    if self.projection is not None
+                    else None
+                ),
+                "pca_prefilter_searches": self.prefilter_searches,
+            }
+
+
+gallery = GalleryIndex()
+
+
+def find_matching_patient(target_encoding, partitions=None):
+    """Trova il paziente corrispondente all'encoding fornito"""
+    allowed = gallery.partition_members(partitions) if partitions else None
+
+    # Prima i pazienti visti di recente, con soglia più stretta
+    hot_match, hot_distance = hot_set.search(target_encoding, allowed)
+    if hot_match and hot_distance < EARLY_ACCEPT_THRESHOLD:
+        hot_set.record(early_accept=True)
+        return hot_match, 1.0 - hot_distance
+    hot_set.record(early_accept=False)
+
+    # Confronta con tutti i pazienti registrati (della partizione, se indicata)
+    best_match, best_distance = gallery.search(target_encoding, partitions)
+
+    # Verifica se il match è abbastanza buono
+    if best_match and best_distance < SIMILARITY_THRESHOLD:
+        return best_match, 1.0 - best_distance  # Converte distanza in confidenza
+
+    return None, 0.0
+
+
+def match_in_partitions(target_encoding, partitions=None, fallback_global=True):
+    """Cerca nelle partizioni del chiamante e, se non trova, nella gallery globale.
+
+    Restituisce (patient_id, confidenza, ambito) con ambito "partition" o "global".
+    """
+    if partitions:
+        patient_id, confidence = find_matching_patient(target_encoding, partitions)
+        if patient_id or not fallback_global:
+            return patient_id, confidence, "partition"
+    patient_id, confidence = find_matching_patient(target_encoding)
+    return patient_id, confidence, "global"
+
+
+def match_faces(target_encodings, partitions=None, fallback_global=True):
+    """Match di più volti della stessa foto contro la gallery.
+
+    Restituisce per ogni volto (patient_id, confidenza, ambito). Uno stesso
+    paziente non può comparire due volte: lo tiene il volto più vicino.
+    """
+    results = [(None, float("inf"), "global")] * len(target_encodings)
+    if partitions:
+        for face, (patient_id, distance) in enumerate(
+            gallery.search_batch(target_encodings, partitions)
+        ):
+            results[face] = (patient_id, distance, "partition")
+
+    if not partitions or fallback_global:
+        missing = [
+            face
+            for face, (patient_id, distance, _) in enumerate(results)
+            if distance >= SIMILARITY_THRESHOLD
+        ]
+        if missing:
+            found = gallery.search_batch([target_encodings[f] for f in missing])
+            for face, (patient_id, distance) in zip(missing, found):
+                results[face] = (patient_id, distance, "global")
+
+    matches = [(None, 0.0, scope) for _, _, scope in results]
+    assigned = set()
+    for face in sorted(range(len(results)), key=lambda f: results[f][1]):
+        patient_id, distance, scope = results[face]
+        if distance < SIMILARITY_THRESHOLD and patient_id not in assigned:
+            assigned.add(patient_id)
+            matches[face] = (patient_id, 1.0 - distance, scope)
+    return matches
+
+
+# --- Cache dei risultati di riconoscimento ---
+def perceptual_hash(image_bytes):
+    """dHash a 64 bit dell'immagine (None se non decodificabile)"""
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            # Decodifica JPEG a risoluzione ridotta: molto più veloce del decode pieno
+            image.draft("L", (64, 64))
+            small = image.convert("L").resize((9, 8), Image.Resampling.LANCZOS)
+    except Exception:
+        return None
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+class CachedRecognition:
+    """Encoding di una foto e ultimo match calcolato"""
+
+    def __init__(self, content_hash, image_hash, encoding, cpu_seconds):
+        self.content_hash = content_hash
+        self.image_hash = image_hash
+        self.encoding = encoding
+        self.cpu_seconds = cpu_seconds
+        self.created_at = time.time()
+        self.matches = {}  # (partizioni, fallback) -> (versione gallery, risultato)
+
+
+class RecognitionCache:
+    """Cache a breve scadenza di /recognize, per hash esatto o percettivo.
+
+    Con lo stesso contenuto restituisce l'encoding già calcolato senza passare
+    da dlib; il match viene ricalcolato solo se nel frattempo la gallery è
+    cambiata. L'hash percettivo da solo non basta a identificare: una foto
+    simile riusa il match solo dopo aver confrontato il suo encoding.
+
+    Gli errori non si salvano: un "nessun volto" dovuto alla modalità
+    degradata non deve ripetersi a carico finito.
+    """
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.exact_hits = 0
+        self.perceptual_hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.cpu_seconds_saved = 0.0
+
+    def _purge_expired(self, now):
+        while self.entries:
+            oldest = next(iter(self.entries.values()))
+            if now - oldest.created_at <= self.ttl:
+                break
+            self.entries.popitem(last=False)
+
+    def lookup(self, content_hash):
+        """Voce con lo stesso contenuto (hash esatto), o None"""
+        with self.lock:
+            self._purge_expired(time.time())
+            entry = self.entries.get(content_hash)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.exact_hits += 1
+            self.cpu_seconds_saved += entry.cpu_seconds
+            return entry
+
+    def similar(self, image_hash, encoding):
+        """Voce di una foto percettivamente uguale e con encoding entro la tolleranza"""
+        if image_hash is None:
+            return None
+        with self.lock:
+            self._purge_expired(time.time())
+            for candidate in self.entries.values():
+                if (
+                    candidate.image_hash is not None
+                    and bin(candidate.image_hash ^ image_hash).count("1")
+                    <= PHASH_MAX_DISTANCE
+                    and np.linalg.norm(candidate.encoding - encoding)
+                    <= RESULT_CACHE_ENCODING_TOLERANCE
+                ):
+                    self.perceptual_hits += 1
+                    return candidate
+            return None
+
+    def store(self, content_hash, image_hash, encoding, cpu_seconds, similar=None):
+        """Salva l'encoding; da una voce `similar` verificata eredita i match"""
+        entry = CachedRecognition(content_hash, image_hash, encoding, cpu_seconds)
+        with self.lock:
+            if similar is not None:
+                entry.matches = dict(similar.matches)
+            self.entries[content_hash] = entry
+            self.entries.move_to_end(content_hash)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        """Svuota la cache (es. encoding calcolati con un modello non più attivo)"""
+        with self.lock:
+            self.entries.clear()
+
+    def match(self, entry, partitions=(), fallback_global=True):
+        """Match dell'encoding in cache, ricalcolato se la gallery è cambiata"""
+        key = (tuple(sorted(partitions)), fallback_global)
+        with self.lock:
+            previous = entry.matches.get(key)
+            if previous is not None and previous[0] == gallery.version:
+                return previous[1]
+
+        version = gallery.version
+        result = match_in_partitions(entry.encoding, partitions, fallback_global)
+        with self.lock:
+            entry.matches[key] = (version, result)
+            if previous is not None:
+                self.revalidations += 1
+        return result
+
+    def memory_bytes(self):
+        with self.lock:
+            return sum(
+                entry.encoding.nbytes if entry.encoding is not None else 0
+                for entry in self.entries.values()
+            )
+
+    def metrics(self):
+        with self.lock:
+            # I match percettivi arrivano dopo l'encoding: non fanno risparmiare dlib
+            lookups = self.exact_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "exact_hits": self.exact_hits,
+                "perceptual_hits": self.perceptual_hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.exact_hits / lookups, 4) if lookups else 0.0,
+                "revalidations": self.revalidations,
+                "cpu_seconds_saved": round(self.cpu_seconds_saved, 3),
+            }
+
+
+result_cache = RecognitionCache(RESULT_CACHE_TTL_SECONDS, RESULT_CACHE_MAX_ENTRIES)
+
+
+def component_memory_usage():
+    """Memoria occupata dalle strutture in memoria del server (byte)"""
+    return {
+        "result_cache": result_cache.memory_bytes(),
+        "hot_set": hot_set.memory_bytes(),
+        "gallery": gallery.memory_bytes(),
+    }
+
+
+# --- Trace delle richieste ---
+class RequestTraceRecorder:
+    """Scrive un trace anonimizzato delle richieste (JSON Lines)"""
+
+    def __init__(self, folder, save_photos=False):
+        self.folder = folder
+        self.save_photos = save_photos
+        self.photos_folder = os.path.join(folder, "photos")
+        self.started_at = time.time()
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(folder, exist_ok=True)
+        if save_photos:
+            os.makedirs(self.photos_folder, exist_ok=True)
+
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.path = os.path.join(folder, f"trace_{stamp}.jsonl")
+
+    def next_sequence(self):
+        with self.lock:
+            self.sequence += 1
+            return self.sequence
+
+    def save_photo(self, file_storage, sequence):
+        """Copia la foto caricata nella cartella del trace"""
+        filename = f"{sequence:08d}.jpg"
+        file_storage.stream.seek(0)
+        file_storage.save(os.path.join(self.photos_folder, filename))
+        return os.path.join("photos", filename)
+
+    def record(self, entry):
+        line = json.dumps(entry, separators=(",", ":"))
+        with self.lock:
+            with open(self.path, "a") as trace_file:
+                trace_file.write(line + "\n")
+
+
+def uploaded_file_size(file_storage):
+    """Dimensione in byte di un file caricato, senza consumarne lo stream"""
+    stream = file_storage.stream
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+
+trace_recorder = (
+    RequestTraceRecorder(TRACE_FOLDER, TRACE_SAVE_PHOTOS) if TRACE_ENABLED else None
+)
+
+
+@app.before_request
+def start_request_trace():
+    if trace_recorder is not None:
+        g.trace_started_at = time.time()
+
+
+@app.after_request
+def record_request_trace(response):
+    """Registra la richiesta nel trace: mai valori dei campi né ID pazienti"""
+    if trace_recorder is None or "trace_started_at" not in g:
+        return response
+
+    try:
+        sequence = trace_recorder.next_sequence()
+        # La regola di routing (es. /session-status/<patient_id>) non contiene l'ID
+        endpoint = request.url_rule.rule if request.url_rule else "<unknown>"
+
+        files = {}
+        photo = None
+        for field, file_storage in request.files.items():
+            files[field] = uploaded_file_size(file_storage)
+            if trace_recorder.save_photos and photo is None:
+                photo = trace_recorder.save_photo(file_storage, sequence)
+
+        entry = {
+            "seq": sequence,
+            "offset": round(g.trace_started_at - trace_recorder.started_at, 4),
+            "method": request.method,
+            "endpoint": endpoint,
+            "request_bytes": request.content_length or 0,
+            "form_fields": {
+                field: len(request.form.getlist(field)) for field in request.form
+            },
+            "files": files,
+            "headers": {
+                header: request.headers[header]
+                for header in TRACE_HEADERS
+                if header in request.headers
+            },
+            "photo": photo,
+            "status": response.status_code,
+            "response_bytes": response.calculate_content_length() or 0,
+            "duration_ms": round((time.time() - g.trace_started_at) * 1000, 2),
+        }
+        trace_recorder.record(entry)
+    except Exception as e:
+        print(f"Errore nella registrazione del trace: {e}")
+
+    return response
+
+
+# --- Profilazione on-demand ---
+class LiveProfiler:
+    """Profilazione del server in esecuzione, senza riavvio.
+
+    Due modalità: "requests" profila con cProfile una frazione delle richieste
+    per N secondi e salva un file .pstats; "sampler" campiona periodicamente gli
+    stack di tutti i thread e salva gli stack collassati (formato flamegraph).
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.lock = threading.Lock()
+        # cProfile non supporta più profili attivi contemporaneamente
+        self.request_slot = threading.Lock()
+        self.mode = None
+        self.fraction = 0.0
+        self.until = 0.0
+        self.max_requests = 0
+        self.stats = None
+        self.profiled_requests = 0
+        self.skipped_requests = 0
+        self.last_output = None
+        self.last_snapshot = None
+
+    def is_active(self):
+        with self.lock:
+            return self.mode is not None
+
+    def status(self):
+        with self.lock:
+            return {
+                "active": self.mode is not None,
+                "mode": self.mode,
+                "fraction": self.fraction,
+                "seconds_left": (
+                    max(0, round(self.until - time.time(), 1)) if self.mode else 0
+                ),
+                "profiled_requests": self.profiled_requests,
+                "skipped_requests": self.skipped_requests,
+                "last_output": self.last_output,
+            }
+
+    def output_path(self, prefix, extension):
+        os.makedirs(self.folder, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        return os.path.join(self.folder, f"{prefix}_{stamp}.{extension}")
+
+    # Modalità "requests" (cProfile)
+    def start_requests(self, seconds, fraction, max_requests=0):
+        with self.lock:
+            if self.mode is not None:
+                return False
+            self.mode = "requests"
+            self.fraction = fraction
+            self.until = time.time() + seconds
+            self.max_requests = max_requests
+            self.stats = None
+            self.profiled_requests = 0
+            self.skipped_requests = 0
+        return True
+
+    def begin_request(self):
+        """Avvia cProfile per la richiesta corrente se estratta nel campione"""
+        with self.lock:
+            if self.mode != "requests" or random.random() >= self.fraction:
+                return None
+        if not self.request_slot.acquire(blocking=False):
+            with self.lock:
+                self.skipped_requests += 1
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def end_request(self, profile):
+        profile.disable()
+        self.request_slot.release()
+        with self.lock:
+            if self.mode != "requests":
+                return
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.profiled_requests += 1
+        self.finish_requests_if_due()
+
+    def finish_requests_if_due(self, force=False):
+        with self.lock:
+            if self.mode != "requests":
+                return
+            expired = time.time() >= self.until
+            full = self.max_requests and self.profiled_requests >= self.max_requests
+            if not (force or expired or full):
+                return
+            stats = self.stats
+            self.mode = None
+            self.stats = None
+
+        if stats is None:
+            return
+        path = self.output_path("profile", "pstats")
+        stats.dump_stats(path)
+        # Riepilogo leggibile accanto al file binario
+        with open(path.replace(".pstats", ".txt"), "w") as summary:
+            pstats.Stats(path, stream=summary).sort_stats("cumulative").print_stats(40)
+        with self.lock:
+            self.last_output = path
+        print(f"Profilo delle richieste salvato in {path}")
+
+    # Modalità "sampler" (stack collassati)
+    def start_sampler(self, seconds, interval_ms=SAMPLER_INTERVAL_MS):
+        with self.lock:
+            if self.mode is not None:
+                return False
+            self.mode = "sampler"
+            self.until = time.time() + seconds
+        threading.Thread(
+            target=self._run_sampler, args=(interval_ms / 1000.0,), daemon=True
+        ).start()
+        return True
+
+    def _run_sampler(self, interval):
+        own_thread = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+
+        while time.time() < self.until:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stacks[";".join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(interval)
+
+        path = self.output_path("sample", "collapsed")
+        with open(path, "w") as output:
+            for stack, count in stacks.most_common():
+                output.write(f"{stack} {count}\n")
+        with self.lock:
+            self.mode = None
+            self.last_output = path
+        print(f"Campionamento ({samples} campioni) salvato in {path}")
+
+    # Snapshot della memoria (tracemalloc)
+    def memory_snapshot(self, top=15):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            self.last_snapshot = tracemalloc.take_snapshot()
+            return {"tracing_started": True, "message": "tracemalloc avviato"}
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        path = self.output_path("memory", "tracemalloc")
+        snapshot.dump(path)
+
+        current, peak = tracemalloc.get_traced_memory()
+        result = {
+            "tracing_started": False,
+            "snapshot_path": path,
+            "traced_current_bytes": current,
+            "traced_peak_bytes": peak,
+            "top_allocations": [
+                {"location": str(stat.traceback[0]), "bytes": stat.size}
+                for stat in snapshot.statistics("lineno")[:top]
+            ],
+        }
+        if self.last_snapshot is not None:
+            result["growth_since_last"] = [
+                {"location": str(stat.traceback[0]), "bytes_diff": stat.size_diff}
+                for stat in snapshot.compare_to(self.last_snapshot, "lineno")[:top]
+            ]
+        self.last_snapshot = snapshot
+        return result
+
+
+profiler = LiveProfiler(PROFILE_FOLDER)
+
+
+def require_admin():
+    """Restituisce una risposta di errore se la richiesta non è amministrativa"""
+    if not ADMIN_TOKEN:
+        return jsonify({"error": "Endpoint amministrativi disabilitati"}), 403
+    token = request.headers.get("X-Admin-Token", "")
+    if not hmac.compare_digest(token, ADMIN_TOKEN):
+        return jsonify({"error": "Token amministrativo non valido"}), 403
+    return None
+
+
+def gateway_signature(key, method, path, query, timestamp, body):
+    """Firma HMAC-SHA256 di una richiesta di un gateway (stessa formula sul client)"""
+    message = f"{method}\n{path}\n{query}\n{timestamp}\n".encode("utf-8") + body
+    return hmac.new(key.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+
+def require_gateway():
+    """Verifica la firma del gateway. Restituisce (gateway_id, risposta di errore)"""
+    if not GATEWAY_KEYS:
+        return None, (jsonify({"error": "Endpoint gateway disabilitati"}), 403)
+
+    gateway_id = request.headers.get("X-Gateway-Id", "")
+    key = GATEWAY_KEYS.get(gateway_id)
+    try:
+        timestamp = int(request.headers.get("X-Timestamp", ""))
+    except ValueError:
+        timestamp = None
+    if key is None or timestamp is None:
+        return None, (jsonify({"error": "Gateway non autorizzato"}), 401)
+
+    if abs(time.time() - timestamp) > GATEWAY_MAX_CLOCK_SKEW_SECONDS:
+        return None, (jsonify({"error": "Firma scaduta"}), 401)
+
+    expected = gateway_signature(
+        key,
+        request.method,
+        request.path,
+        request.query_string.decode("utf-8"),
+        timestamp,
+        request.get_data(),
+    )
+    if not hmac.compare_digest(request.headers.get("X-Signature", ""), expected):
+        return None, (jsonify({"error": "Firma non valida"}), 401)
+    return gateway_id, None
+
+
+def shard_of(patient_id, shard_count=None):
+    """Shard proprietario di un ID: intervalli contigui dei primi 32 bit di SHA-1"""
+    shard_count = shard_count or SHARD_COUNT
+    digest = hashlib.sha1(patient_id.encode("utf-8")).digest()
+    return (int.from_bytes(digest[:4], "big") * shard_count) >> 32
+
+
+def new_patient_id():
+    """Nuovo ID paziente che cade nell'intervallo di hash di questo nodo"""
+    while True:
+        patient_id = str(uuid.uuid4())
+        if shard_of(patient_id) == SHARD_INDEX:
+            return patient_id
+
+
+def require_shard_token():
+    """Restituisce una risposta di errore se la richiesta non viene dal coordinatore"""
+    if not SHARD_TOKEN:
+        return jsonify({"error": "Endpoint di shard disabilitati"}), 403
+    token = request.headers.get("X-Shard-Token", "")
+    if not hmac.compare_digest(token, SHARD_TOKEN):
+        return jsonify({"error": "Token di shard non valido"}), 403
+    return None
+
+
+def assigned_patient_id():
+    """ID del nuovo paziente: generato qui o assegnato dal coordinatore (X-Patient-Id)"""
+    requested = request.headers.get("X-Patient-Id", "").strip()
+    if not requested:
+        return new_patient_id(), None
+
+    denied = require_shard_token()
+    if denied:
+        return None, denied
+    try:
+        requested = str(uuid.UUID(requested))
+    except ValueError:
+        return None, (jsonify({"error": "ID paziente non valido"}), 400)
+    if shard_of(requested) != SHARD_INDEX:
+        return None, (jsonify({"error": "ID paziente di un altro shard"}), 421)
+    return requested, None
+
+
+def shard_encoding_conflict(payload):
+    """409 se il coordinatore ha codificato con un'altra versione di encoding"""
+    gallery.ensure_loaded()
+    encoding_version = payload.get("encoding_version")
+    if encoding_version is None or encoding_version == gallery.encoding_tag:
+        return None
+    return (
+        jsonify(
+            {
+                "error": "Versione di encoding non più attiva",
+                "encoding_version": gallery.encoding_tag,
+                "encoding_settings": gallery.encoding_settings,
+            }
+        ),
+        409,
+    )
+
+
+def screened_candidates():
+    """Candidati duplicati trovati dal coordinatore su tutti gli shard.
+
+    None se la registrazione non arriva dal coordinatore (header assente o
+    token non valido): in quel caso vale solo il controllo locale.
+    """
+    header = request.headers.get("X-Duplicate-Candidates")
+    if header is None or require_shard_token() is not None:
+        return None
+    try:
+        return [(entry["id"], float(entry["distance"])) for entry in json.loads(header)]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def decode_encoding(value):
+    """Encoding da JSON: base64 di float32 little-endian oppure lista di numeri"""
+    if isinstance(value, str):
+        encoding = np.frombuffer(base64.b64decode(value, validate=True), dtype="<f4")
+    else:
+        encoding = np.asarray(value, dtype=np.float64)
+    if encoding.shape != (ENCODING_DIMENSIONS,) or not np.all(np.isfinite(encoding)):
+        raise ValueError(
+            f"L'encoding deve contenere {ENCODING_DIMENSIONS} valori finiti"
+        )
+    return encoding.astype(np.float64)
+
+
+@app.before_request
+def start_request_profile():
+    if profiler.is_active():
+        profile = profiler.begin_request()
+        if profile is not None:
+            g.profile = profile
+
+
+@app.teardown_request
+def stop_request_profile(exception=None):
+    # teardown_request viene eseguito anche in caso di eccezione non gestita
+    profile = g.pop("profile", None)
+    if profile is not None:
+        profiler.end_request(profile)
+    else:
+        profiler.finish_requests_if_due()
+
+
+# --- Controllo di ammissione ---
+class AdmissionTicket:
+    """Richiesta in attesa di uno slot di encoding"""
+
+    def __init__(self, priority):
+        self.priority = priority
+        self.rank = PRIORITY_CLASSES.index(priority)
+        self.enqueued_at = time.time()
+        self.granted = False
+
+    def effective_rank(self, now):
+        # Invecchiamento: chi attende da tempo sale di classe (anti-starvation)
+        return self.rank - (now - self.enqueued_at) / PRIORITY_AGING_SECONDS
+
+
+class AdmissionController:
+    """Coda limitata e con priorità davanti all'encoding.
+
+    Oltre la profondità massima si rifiuta subito con 503 invece di accumulare
+    richieste destinate al timeout; gli slot liberi vanno alla classe più alta,
+    con invecchiamento per non affamare le classi basse.
+    """
+
+    def __init__(self, concurrency, max_waiting):
+        self.concurrency = max(1, concurrency)
+        self.max_waiting = max_waiting
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiters = []
+        self.service_seconds = 1.0  # Media mobile del tempo di servizio
+        self.degraded = 0
+        self.class_stats = {
+            priority: {
+                "admitted": 0,
+                "rejected": 0,
+                "expired": 0,
+                "total_wait": 0.0,
+                "max_wait": 0.0,
+                "recent_waits": deque(maxlen=500),
+            }
+            for priority in PRIORITY_CLASSES
+        }
+
+    def queue_limit(self, priority):
+        if priority == PRIORITY_CLASSES[0]:
+            return self.max_waiting + EMERGENCY_RESERVED_SLOTS
+        return self.max_waiting
+
+    def acquire(self, priority=DEFAULT_PRIORITY, deadline=None):
+        """Attende uno slot, al massimo fino alla deadline del client.
+
+        Restituisce (ammesso, richieste in coda all'arrivo); solleva
+        DeadlineExceeded se la deadline scade prima che lo slot sia libero.
+        """
+        pipeline.check_deadline(deadline, "decode")
+        stats = self.class_stats[priority]
+        with self.condition:
+            if self.active < self.concurrency and not self.waiters:
+                self.active += 1
+                stats["admitted"] += 1
+                self._record_wait(stats, 0.0)
+                return True, 0
+
+            if len(self.waiters) >= self.queue_limit(priority):
+                stats["rejected"] += 1
+                return False, len(self.waiters)
+
+            ticket = AdmissionTicket(priority)
+            self.waiters.append(ticket)
+            queue_depth = len(self.waiters)
+            while not ticket.granted:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    # Il client ha già rinunciato: il posto in coda va agli altri
+                    self.waiters.remove(ticket)
+                    stats["expired"] += 1
+                    break
+                self.condition.wait(remaining)
+            else:
+                stats["admitted"] += 1
+                self._record_wait(stats, time.time() - ticket.enqueued_at)
+                return True, queue_depth
+        pipeline.abort("decode")
+
+    def release(self, service_seconds):
+        with self.condition:
+            self.active -= 1
+            self.service_seconds = 0.8 * self.service_seconds + 0.2 * service_seconds
+            if self.waiters and self.active < self.concurrency:
+                now = time.time()
+                ticket = min(
+                    self.waiters,
+                    key=lambda t: (t.effective_rank(now), t.enqueued_at),
+                )
+                self.waiters.remove(ticket)
+                ticket.granted = True
+                self.active += 1
+                self.condition.notify_all()
+
+    def _record_wait(self, stats, wait_seconds):
+        stats["total_wait"] += wait_seconds
+        stats["max_wait"] = max(stats["max_wait"], wait_seconds)
+        stats["recent_waits"].append(wait_seconds)
+
+    def should_degrade(self, queue_depth):
+        if DEGRADED_MODE_ENABLED and queue_depth >= DEGRADED_QUEUE_THRESHOLD:
+            with self.condition:
+                self.degraded += 1
+            return True
+        return False
+
+    def retry_after(self):
+        """Secondi stimati per smaltire la coda attuale"""
+        with self.condition:
+            backlog = len(self.waiters) + self.active
+            return max(1, math.ceil(backlog * self.service_seconds / self.concurrency))
+
+    def metrics(self):
+        with self.condition:
+            classes = {}
+            for priority, stats in self.class_stats.items():
+                recent = sorted(stats["recent_waits"])
+                classes[priority] = {
+                    "admitted": stats["admitted"],
+                    "rejected": stats["rejected"],
+                    "expired": stats["expired"],
+                    "waiting": sum(1 for t in self.waiters if t.priority == priority),
+                    "mean_wait_seconds": (
+                        round(stats["total_wait"] / stats["admitted"], 4)
+                        if stats["admitted"]
+                        else 0.0
+                    ),
+                    "p95_wait_seconds": (
+                        round(recent[max(0, math.ceil(0.95 * len(recent)) - 1)], 4)
+                        if recent
+                        else 0.0
+                    ),
+                    "max_wait_seconds": round(stats["max_wait"], 4),
+                }
+
+            return {
+                "concurrency": self.concurrency,
+                "max_queue_depth": self.max_waiting,
+                "active": self.active,
+                "waiting": len(self.waiters),
+                "admitted": sum(c["admitted"] for c in classes.values()),
+                "rejected": sum(c["rejected"] for c in classes.values()),
+                "expired": sum(c["expired"] for c in classes.values()),
+                "degraded": self.degraded,
+                "mean_service_seconds": round(self.service_seconds, 3),
+                "classes": classes,
+            }
+
+
+admission = AdmissionController(ENCODING_CONCURRENCY, RECOGNITION_QUEUE_DEPTH)
+
+
+# --- Registrazione asincrona ---
+# Stati in cui il job non avanza da solo (duplicate_suspected attende /register-confirm)
+REGISTRATION_FINAL_STATUSES = ("done", "failed", "duplicate_suspected")
+
+
+class RegistrationQueue:
+    """Worker in background che completano le registrazioni messe in coda.
+
+    Lo stato dei job è nel database, così un riavvio riprende quelli rimasti a
+    metà; la coda in memoria contiene solo gli ID. Le foto senza volto falliscono
+    subito, gli errori imprevisti (es. database bloccato) vengono ritentati con
+    attesa crescente fino a REGISTRATION_MAX_ATTEMPTS.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.jobs = queue.Queue()
+        self.condition = threading.Condition()
+        self.started = False
+        self.in_progress = set()
+        self.rerun = set()  # Job rimessi in coda mentre un worker li stava elaborando
+        self.finished = 0  # Job conclusi finora: wait_for non perde le notifiche
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.duplicates_suspected = 0
+        self.total_seconds = 0.0
+
+    def ensure_started(self):
+        """Avvia i worker (una sola volta). True se sono appena partiti"""
+        with self.condition:
+            if self.started:
+                return False
+            self.started = True
+        for index in range(self.workers):
+            threading.Thread(
+                target=self.worker, name=f"registration-{index}", daemon=True
+            ).start()
+        self.resume_pending()
+        return True
+
+    def resume_pending(self):
+        """Rimette in coda i job interrotti da un riavvio"""
+        conn = sqlite3.connect(DATABASE)
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT id FROM registration_jobs
+            WHERE status IN ('queued', 'processing')
+            ORDER BY created_at
+        """
+        )
+        pending = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        for job_id in pending:
+            self.jobs.put(job_id)
+
+    def submit(self, job_id):
+        # Al primo avvio il job è già stato ripreso dal database insieme agli altri
+        if not self.ensure_started():
+            self.jobs.put(job_id)
+
+    def retry_later(self, job_id, delay):
+        timer = threading.Timer(delay, self.jobs.put, (job_id,))
+        timer.daemon = True
+        timer.start()
+
+    def finish(self, job_id, status, error=None, seconds=0.0):
+        update_registration_job(job_id, status, error=error)
+        with self.condition:
+            if status == "done":
+                self.completed += 1
+                self.total_seconds += seconds
+            elif status == "duplicate_suspected":
+                self.duplicates_suspected += 1
+            else:
+                self.failed += 1
+            self.finished += 1
+            self.condition.notify_all()
+
+    def worker(self):
+        while True:
+            job_id = self.jobs.get()
+            with self.condition:
+                if job_id in self.in_progress:
+                    # Lo rielabora chi lo ha in mano, appena finisce (es. /register-confirm)
+                    self.rerun.add(job_id)
+                    continue
+                self.in_progress.add(job_id)
+            try:
+                self.process(job_id)
+            except Exception as e:
+                print(f"Errore nel worker di registrazione ({job_id}): {e}")
+            finally:
+                with self.condition:
+                    self.in_progress.discard(job_id)
+                    if job_id in self.rerun:
+                        self.rerun.discard(job_id)
+                        self.jobs.put(job_id)
+
+    def process(self, job_id):
+        job = get_registration_job(job_id)
+        if job is None or job["status"] in REGISTRATION_FINAL_STATUSES:
+            return
+        # Tentativo precedente interrotto dopo il salvataggio del paziente
+        if get_patient(job_id) is not None:
+            self.finish(job_id, "done")
+            return
+
+        admitted, _ = admission.acquire(job["priority"] or DEFAULT_PRIORITY)
+        if not admitted:
+            self.retry_later(job_id, admission.retry_after())
+            return
+
+        attempts = job["attempts"] + 1
+        update_registration_job(job_id, "processing", attempts=attempts)
+        started_at = time.time()
+        try:
+            try:
+                face_encoding, face_location, error, tag = encode_for_registration(
+                    job["photo_path"]
+                )
+            finally:
+                admission.release(time.time() - started_at)
+
+            if error:
+                # Foto senza volto o con più volti: ritentare non serve
+                self.discard_photo(job["photo_path"])
+                self.finish(job_id, "failed", error)
+                return
+
+            # Stessa persona già in gallery? Si ferma finché l'operatore non decide
+            review = get_duplicate_review(job_id)
+            if review is None or review["status"] != "confirmed":
+                candidates = find_duplicate_candidates(face_encoding)
+                if candidates:
+                    save_duplicate_review(job_id, candidates)
+                    self.finish(job_id, "duplicate_suspected")
+                    return
+
+            store_registered_patient(
+                job_id,
+                job["fields"],
+                job["partitions"],
+                job["photo_path"],
+                face_encoding,
+                face_location,
+                tag,
+            )
+            self.finish(job_id, "done", seconds=time.time() - started_at)
+
+        except Exception as e:
+            error = f"Errore interno del server: {str(e)}"
+            if attempts >= REGISTRATION_MAX_ATTEMPTS:
+                self.discard_photo(job["photo_path"])
+                self.finish(job_id, "failed", error)
+                return
+            update_registration_job(job_id, "queued", error=error)
+            with self.condition:
+                self.retried += 1
+            self.retry_later(job_id, REGISTRATION_RETRY_SECONDS * 2 ** (attempts - 1))
+
+    def discard_photo(self, photo_path):
+        if photo_path and os.path.exists(photo_path):
+            os.remove(photo_path)
+
+    def wait_for(self, job_id, timeout):
+        """Attende (fino a `timeout` secondi) che il job sia concluso"""
+        deadline = time.time() + timeout
+        while True:
+            with self.condition:
+                finished = self.finished
+            # Lettura dal database fuori dal lock, che serve ai worker in finish()
+            job = get_registration_job(job_id)
+            remaining = deadline - time.time()
+            if (
+                job is None
+                or job["status"] in REGISTRATION_FINAL_STATUSES
+                or remaining <= 0
+            ):
+                return job
+            with self.condition:
+                # Se un job è finito dopo la lettura si ricontrolla subito
+                if self.finished == finished:
+                    self.condition.wait(remaining)
+
+    def metrics(self):
+        with self.condition:
+            return {
+                "workers": self.workers if self.started else 0,
+                "queued": self.jobs.qsize(),
+                "completed": self.completed,
+                "failed": self.failed,
+                "retried": self.retried,
+                "duplicates_suspected": self.duplicates_suspected,
+                "avg_job_ms": (
+                    round(self.total_seconds / self.completed * 1000, 2)
+                    if self.completed
+                    else None
+                ),
+            }
+
+
+registration_queue = RegistrationQueue(REGISTRATION_WORKERS)
+
+
+# --- Statistiche in diretta ---
+def compute_statistics():
+    """Statistiche aggregate del sistema, per /stats e /stats/stream"""
+    conn = sqlite3.connect(DATABASE)
+    cursor = conn.cursor()
+
+    # Conta pazienti totali
+    cursor.execute("SELECT COUNT(*) FROM patients")
+    total_patients = cursor.fetchone()[0]
+
+    # Conta riconoscimenti totali
+    cursor.execute("SELECT COUNT(*) FROM recognition_log")
+    total_recognitions = cursor.fetchone()[0]
+
+    # Conta riconoscimenti riusciti
+    cursor.execute("SELECT COUNT(*) FROM recognition_log WHERE success = 1")
+    successful_recognitions = cursor.fetchone()[0]
+
+    # Conta sessioni attive
+    cursor.execute(
+        """
+        SELECT COUNT(*) FROM access_sessions 
+        WHERE session_valid_until > ?
+    """,
+        (datetime.now().isoformat(),),
+    )
+    active_sessions = cursor.fetchone()[0]
+
+    conn.close()
+
+    success_rate = 0
+    if total_recognitions > 0:
+        success_rate = (successful_recognitions / total_recognitions) * 100
+
+    return {
+        "total_patients": total_patients,
+        "total_recognitions": total_recognitions,
+        "successful_recognitions": successful_recognitions,
+        "success_rate": round(success_rate, 2),
+        "active_sessions": active_sessions,
+        "access_window_seconds": ACCESS_WINDOW_SECONDS,
+        "threshold": SIMILARITY_THRESHOLD,
+        "hot_set": hot_set.metrics(),
+    }
+
+
+def sse_message(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class StatsBroadcaster:
+    """Un solo produttore per tutti i client di /stats/stream.
+
+    Il thread ricalcola le statistiche solo se il database è cambiato (PRAGMA
+    data_version, anche per scritture di altri processi) e al più una volta
+    per intervallo: una raffica di riconoscimenti diventa un solo messaggio
+    "stats" e un solo "recognitions". Ogni client ha una coda limitata; se
+    resta indietro perde i messaggi più vecchi invece di far crescere la
+    memoria o rallentare gli altri.
+    """
+
+    def __init__(self, interval, refresh_seconds, queue_size, max_subscribers):
+        self.interval = interval
+        self.refresh_seconds = refresh_seconds
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.condition = threading.Condition()
+        self.subscribers = set()
+        self.pending_events = []
+        self.omitted_events = 0
+        self.thread = None
+        self.latest = None  # Ultimo messaggio "stats", inviato subito ai nuovi client
+        self.last_stats = None
+        self.computed_at = 0.0
+        self.conn = None
+        self.data_version = None
+        self.computations = 0
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self):
+        """Nuova coda di messaggi, None se i client sono già troppi"""
+        with self.condition:
+            if len(self.subscribers) >= self.max_subscribers:
+                return None
+            subscriber = queue.Queue(maxsize=self.queue_size)
+            if self.latest is not None:
+                subscriber.put_nowait(self.latest)
+            self.subscribers.add(subscriber)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.condition:
+            self.subscribers.discard(subscriber)
+
+    def notify_recognition(self, recognition_time, confidence, success):
+        """Riconoscimento anonimo (come in /log), senza ID del paziente"""
+        with self.condition:
+            if not self.subscribers:
+                return
+            if len(self.pending_events) < STATS_STREAM_MAX_EVENTS:
+                self.pending_events.append(
+                    {
+                        "time": recognition_time,
+                        "confidence": confidence if confidence else 0,
+                        "success": bool(success),
+                    }
+                )
+            else:
+                self.omitted_events += 1
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.subscribers:
+                    # Nessun client: niente query finché non se ne collega uno
+                    self.latest = None
+                    self.last_stats = None
+                    self.condition.wait()
+            time.sleep(self.interval)
+            try:
+                self.publish_changes()
+            except Exception as e:
+                print(f"Errore nelle statistiche in diretta: {e}")
+
+    def publish_changes(self):
+        with self.condition:
+            events, self.pending_events = self.pending_events, []
+            omitted, self.omitted_events = self.omitted_events, 0
+
+        if self.conn is None:
+            self.conn = sqlite3.connect(DATABASE)
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        messages = []
+        if (
+            self.last_stats is None
+            or data_version != self.data_version
+            or time.time() - self.computed_at > self.refresh_seconds
+        ):
+            self.data_version = data_version
+            self.computed_at = time.time()
+            self.computations += 1
+            stats = compute_statistics()
+            if stats != self.last_stats:
+                self.last_stats = stats
+                messages.append(sse_message("stats", stats))
+        if events or omitted:
+            messages.append(
+                sse_message("recognitions", {"events": events, "omitted": omitted})
+            )
+
+        with self.condition:
+            if messages and messages[0].startswith("event: stats"):
+                self.latest = messages[0]
+            for message in messages:
+                for subscriber in self.subscribers:
+                    self.offer(subscriber, message)
+                self.published += 1
+
+    def offer(self, subscriber, message):
+        """Accoda senza bloccare: con la coda piena si scarta il messaggio più vecchio"""
+        while True:
+            try:
+                subscriber.put_nowait(message)
+                return
+            except queue.Full:
+                try:
+                    subscriber.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def metrics(self):
+        with self.condition:
+            return {
+                "subscribers": len(self.subscribers),
+                "computations": self.computations,
+                "published": self.published,
+                "dropped": self.dropped,
+            }
+
+
+stats_stream = StatsBroadcaster(
+    STATS_STREAM_INTERVAL_SECONDS,
+    STATS_STREAM_REFRESH_SECONDS,
+    STATS_STREAM_QUEUE_SIZE,
+    STATS_STREAM_MAX_SUBSCRIBERS,
+)
+
+
+# --- Avvio e prontezza ---
+class StartupState:
+    """Fasi dell'avvio con la loro durata.
+
+    "/" risponde appena il processo è in ascolto; /ready solo quando tutte le
+    fasi sono concluse, così il bilanciatore non manda traffico a un'istanza
+    fredda durante i riavvii.
+    """
+
+    def __init__(self, phases, started_at):
+        self.phases = phases
+        self.lock = threading.Lock()
+        self.started_at = started_at
+        self.phase_seconds = {}
+        self.current = None
+        self.error = None
+        self.ready_at = None
+        self.thread = None
+
+    def start(self, target):
+        """Avvia target in background una sola volta per processo"""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=target, daemon=True)
+        self.thread.start()
+
+    def record(self, phase, seconds):
+        with self.lock:
+            self.phase_seconds[phase] = round(seconds, 3)
+        print(f"Avvio: fase '{phase}' completata in {seconds:.2f}s")
+
+    def run(self, phase, function):
+        with self.lock:
+            self.current = phase
+        started_at = time.time()
+        function()
+        self.record(phase, time.time() - started_at)
+
+    def run_all(self, steps):
+        """Esegue le fasi in ordine; un errore lascia il server non pronto"""
+        try:
+            for phase, function in steps:
+                self.run(phase, function)
+        except Exception as e:
+            with self.lock:
+                self.error = f"{self.current}: {str(e)}"
+            print(f"Avvio fallito nella fase {self.error}")
+            return
+        with self.lock:
+            self.current = None
+            self.ready_at = time.time()
+        print(f"Server pronto in {self.ready_at - self.started_at:.2f}s")
+
+    def is_ready(self):
+        with self.lock:
+            return self.ready_at is not None
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "ready": self.ready_at is not None,
+                "current_phase": self.current,
+                "error": self.error,
+                "phase_seconds": dict(self.phase_seconds),
+                "startup_seconds": (
+                    round(self.ready_at - self.started_at, 3)
+                    if self.ready_at is not None
+                    else None
+                ),
+            }
+
+
+startup = StartupState(STARTUP_PHASES, MODELS_IMPORT_STARTED_AT)
+
+
+def load_gallery_for_startup():
+    gallery.load()
+    gallery.load_projection()
+    hot_set.seed_from_log()
+    print(f"Gallery caricata: {len(gallery.ids)} encoding in memoria.")
+
+
+def warm_up():
+    """Riconoscimento sintetico completo, con le impostazioni della versione attiva.
+
+    Il primo riconoscimento reale non paga così l'inizializzazione di dlib, dei
+    decoder di PIL e di numpy. L'immagine non contiene volti: il rilevamento
+    non trova nulla, quindi landmark ed encoding girano su un volto fittizio
+    al centro.
+    """
+    settings = gallery.encoding_settings
+    pixels = np.random.default_rng(0).integers(
+        0, 256, (WARMUP_IMAGE_SIZE, WARMUP_IMAGE_SIZE, 3), dtype=np.uint8
+    )
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="JPEG")
+    buffer.seek(0)
+    image = face_recognition.load_image_file(buffer)
+
+    face_recognition.face_locations(
+        image,
+        number_of_times_to_upsample=settings["upsample"],
+        model=settings["detection_model"],
+    )
+    side = WARMUP_IMAGE_SIZE // 2
+    face_box = (side // 2, side // 2 + side, side // 2 + side, side // 2)
+    encodings = face_recognition.face_encodings(
+        image,
+        [face_box],
+        num_jitters=settings["jitters"],
+        model=settings["encoding_model"],
+    )
+    if encodings:
+        gallery.search(np.asarray(encodings[0]))
+
+
+def run_startup():
+    """Fasi dell'avvio; i worker della registrazione partono a database pronto"""
+    startup.record("models", MODELS_LOAD_SECONDS)
+    startup.run_all(
+        [
+            ("database", init_database),
+            ("gallery", load_gallery_for_startup),
+            ("warmup", warm_up),
+        ]
+    )
+    if startup.error is None:
+        registration_queue.ensure_started()
+
+
+@app.before_request
+def ensure_startup():
+    """Avvio alla prima richiesta: sotto un server WSGI __main__ non viene eseguito.
+
+    Finché l'avvio non è concluso (schema del database compreso) le richieste
+    ricevono 503 con Retry-After invece di fallire a metà.
+    """
+    startup.start(run_startup)
+    if startup.is_ready() or request.path in STARTUP_OPEN_PATHS:
+        return None
+    response = jsonify(
+        {
+            "error": "Server in avvio, riprovare tra poco",
+            "startup": startup.metrics(),
+        }
+    )
+    response.headers["Retry-After"] = str(STARTUP_RETRY_AFTER_SECONDS)
+    return response, 503
+
+
+def request_deadline():
+    """Istante entro cui il client attende la risposta (header X-Request-Deadline-Ms).
+
+    L'header contiene il tempo residuo in millisecondi e non un orario assoluto,
+    così gli orologi non sincronizzati dei telefoni non contano.
+    """
+    try:
+        budget_ms = float(request.headers["X-Request-Deadline-Ms"])
+    except (KeyError, ValueError):
+        return None
+    return time.time() + budget_ms / 1000.0
+
+
+def deadline_response(error):
+    """Risposta per le richieste abbandonate perché il client ha già rinunciato"""
+    return (
+        jsonify(
+            {
+                "error": "Deadline della richiesta superata",
+                "deadline_exceeded": True,
+                "aborted_before": error.stage,
+                "match": False,
+            }
+        ),
+        504,
+    )
+
+
+def request_partitions():
+    """Partizioni del chiamante (campi partitions[] o header X-Partitions)"""
+    partitions = request.form.getlist("partitions[]")
+    partitions += request.headers.get("X-Partitions", "").split(",")
+    return sorted({partition.strip() for partition in partitions if partition.strip()})
+
+
+def request_priority():
+    """Classe di priorità della richiesta (header X-Priority o campo priority)"""
+    priority = (
+        (request.headers.get("X-Priority") or request.form.get("priority") or "")
+        .strip()
+        .lower()
+    )
+    return priority if priority in PRIORITY_CLASSES else DEFAULT_PRIORITY
+
+
+def overloaded_response():
+    """Risposta 503 con Retry-After quando la coda di encoding è piena"""
+    response = jsonify(
+        {
+            "error": "Server sovraccarico, riprovare tra poco",
+            "match": False,
+        }
+    )
+    response.headers["Retry-After"] = str(admission.retry_after())
+    return response, 503
+
+
+# --- API Endpoints ---
+
+
+@app.route("/help", methods=["GET"])
+def help_info():
+    """Mostra le informazioni di aiuto per l'API"""
+    return (
+        jsonify(
+            {
+                "message": "Benvenuto nel Secure Face Recognition Server",
+                "version": "2.0.0",
+                "endpoints": {
+                    "/": "Controllo stato del server",
+                    "/ready": "Server pronto a ricevere traffico (503 durante l'avvio)",
+                    "/register": "Registra un nuovo paziente con foto (in coda; sync=1 per attendere)",
+                    "/register-status/<job_id>": "Stato di una registrazione in coda (wait=N per long-poll)",
+                    "/register-confirm/<job_id>": "Conferma o annulla una registrazione sospetta di duplicato",
+                    "/recognize": "Riconosce un paziente dalla foto (multi=1 per foto di gruppo)",
+                    "/recognize-encoding": "Riconosce un paziente da un encoding calcolato dal gateway (firmato)",
+                    "/gallery/changes": "Encoding aggiunti o rimossi dopo una sequenza (replica dei gateway, firmato)",
+                    "/gallery/access-log": "Riconcilia i riconoscimenti fatti offline dai gateway (firmato)",
                     "/dati": "Recupera i dati di un paziente (solo dopo riconoscimento)",
                     "/patients": "Non più disponibile per sicurezza",
                     "/patient-count": "Ottieni il numero totale di pazienti registrati",
                     "/log": "Recupera il log dei riconoscimenti (statistiche anonime)",
                     "/stats": "Statistiche aggregate del sistema",
+                    "/stats/stream": "Statistiche e riconoscimenti anonimi in diretta (Server-Sent Events)",
+                    "/stats/timeseries": "Riconoscimenti, successi e confidenza media per ora o giorno (granularity, from, to)",
                     "/session-status/<patient_id>": "Verifica lo stato della sessione per un paziente specifico",
+                    "/partitions": "Aggiunge o rimuove un paziente da partizioni (struttura/reparto)",
+                    "/metrics": "Metriche di esercizio del server (coda di encoding, fasi, deadline, cache)",
+                    "/admin/profile": "Avvia o consulta la profilazione del server (solo admin)",
+                    "/admin/memory-snapshot": "Snapshot tracemalloc della memoria (solo admin)",
+                    "/admin/patients/<patient_id>": "Elimina un paziente e il suo encoding (solo admin)",
+                    "/shard/search": "Distanza minima nella gallery di questo shard (solo coordinatore)",
+                    "/shard/duplicates": "Possibili duplicati di un nuovo paziente in questo shard (solo coordinatore)",
+                    "/shard/log": "Registra un riconoscimento deciso dal coordinatore (solo coordinatore)",
                 },
             }
         ),
@@ -345,6 +3095,7 @@ def health_check():
                 "service": "Secure Face Recognition Server",
                 "version": "2.0.0",
                 "access_window_seconds": ACCESS_WINDOW_SECONDS,
+                "shard": {"index": SHARD_INDEX, "count": SHARD_COUNT},
                 "timestamp": datetime.now().isoformat(),
             }
         ),
@@ -352,6 +3103,13 @@ def health_check():
     )
 
 
+@app.route("/ready", methods=["GET"])
+def readiness_check():
+    """Pronto solo dopo database, gallery e warm-up (per il bilanciatore)"""
+    state = startup.metrics()
+    return jsonify(state), 200 if state["ready"] else 503
+
+
 @app.route("/register", methods=["POST"])
 def register_patient():
     """Registra un nuovo paziente con la sua foto"""
@@ -386,57 +3144,234 @@ def register_patient():
         # Handle diseases and medications as arrays
         diseases = request.form.getlist("diseases[]") or []
         medications = request.form.getlist("medications[]") or []
+        partitions = request_partitions()
 
         if not name:
             return jsonify({"error": "Nome è obbligatorio"}), 400
 
-        # Genera ID univoco per il paziente
-        patient_id = str(uuid.uuid4())
+        deadline = request_deadline()
+        fields = {
+            "name": name,
+            "surname": surname,
+            "age": age,
+            "weight": weight,
+            "height": height,
+            "blood_type": blood_type,
+            "allergies": allergies,
+            "diseases": diseases,
+            "medications": medications,
+        }
+
+        # Genera ID univoco per il paziente (o usa quello assegnato dal coordinatore)
+        patient_id, error_response = assigned_patient_id()
+        if error_response:
+            return error_response
 
         # Salva l'immagine
         photo_file = request.files["foto"]
         photo_filename = f"{patient_id}.jpg"
         photo_path = save_image(photo_file, UPLOAD_FOLDER, photo_filename)
 
-        # Processa l'immagine per estrarre l'encoding del volto
-        face_encoding, error = load_and_process_image(photo_path)
+        # L'operatore ha già confermato che non è un paziente registrato
+        allow_duplicate = request.values.get("allow_duplicate", "0") == "1"
+
+        # Con più shard il coordinatore controlla i duplicati su tutta la gallery
+        screened = None if allow_duplicate else screened_candidates()
+        if screened:
+            return suspend_registration(
+                patient_id, fields, partitions, photo_path, screened
+            )
+
+        # Modalità asincrona: encoding e salvataggio avvengono nei worker
+        run_async = (
+            request.values.get("sync", "0" if REGISTRATION_ASYNC else "1") != "1"
+        )
+        if run_async:
+            create_registration_job(
+                patient_id, fields, partitions, photo_path, request_priority()
+            )
+            if allow_duplicate:
+                save_duplicate_review(patient_id, [], status="confirmed")
+            registration_queue.submit(patient_id)
+            return (
+                jsonify(
+                    {
+                        "success": True,
+                        "job_id": patient_id,
+                        "status": "queued",
+                        "status_url": f"/register-status/{patient_id}",
+                        "message": "Registrazione in coda",
+                    }
+                ),
+                202,
+            )
+
+        # Processa l'immagine per estrarre l'encoding del volto
+        try:
+            admitted, _ = admission.acquire(request_priority(), deadline)
+        except DeadlineExceeded:
+            os.remove(photo_path)
+            raise
+        if not admitted:
+            os.remove(photo_path)
+            return overloaded_response()
+
+        started_at = time.time()
+        try:
+            face_encoding, face_location, error, tag = encode_for_registration(
+                photo_path, deadline
+            )
+        except DeadlineExceeded:
+            os.remove(photo_path)
+            raise
+        finally:
+            admission.release(time.time() - started_at)
+
+        if error:
+            os.remove(photo_path)
+            return jsonify({"error": error}), 400
+
+        # Possibile duplicato: la foto resta in attesa della conferma dell'operatore
+        if not allow_duplicate:
+            candidates = find_duplicate_candidates(face_encoding)
+            if candidates:
+                return suspend_registration(
+                    patient_id, fields, partitions, photo_path, candidates
+                )
+
+        # Salva encoding, dati del paziente e foto in archivio
+        store_registered_patient(
+            patient_id,
+            fields,
+            partitions,
+            photo_path,
+            face_encoding,
+            face_location,
+            tag,
+        )
+
+        return (
+            jsonify(
+                {
+                    "success": True,
+                    "message": "Paziente registrato con successo",
+                    "id": patient_id,
+                    "name": name,
+                    "partitions": partitions,
+                }
+            ),
+            200,
+        )
+
+    except DeadlineExceeded as e:
+        return deadline_response(e)
+    except Exception as e:
+        return jsonify({"error": f"Errore interno del server: {str(e)}"}), 500
+
+
+def suspend_registration(patient_id, fields, partitions, photo_path, candidates):
+    """Job fermo in "duplicate_suspected" finché l'operatore non decide (409)"""
+    create_registration_job(
+        patient_id, fields, partitions, photo_path, request_priority()
+    )
+    update_registration_job(patient_id, "duplicate_suspected")
+    save_duplicate_review(patient_id, candidates)
+    return jsonify(duplicate_response_body(patient_id, candidates)), 409
+
+
+@app.route("/register-status/<job_id>", methods=["GET"])
+def registration_status(job_id):
+    """Stato di una registrazione in coda (?wait=N per attendere fino a N secondi)"""
+    try:
+        try:
+            wait = float(request.args.get("wait", 0))
+        except ValueError:
+            return jsonify({"error": "Parametro wait non valido"}), 400
+        wait = min(max(wait, 0.0), REGISTRATION_LONG_POLL_MAX_SECONDS)
+
+        if wait > 0:
+            job = registration_queue.wait_for(job_id, wait)
+        else:
+            job = get_registration_job(job_id)
+        if job is None:
+            return jsonify({"error": "Job di registrazione non trovato"}), 404
+
+        result = {
+            "job_id": job_id,
+            "status": job["status"],
+            "attempts": job["attempts"],
+        }
+        if job["status"] == "done":
+            result.update(
+                {
+                    "success": True,
+                    "message": "Paziente registrato con successo",
+                    "id": job_id,
+                    "name": job["fields"]["name"],
+                    "partitions": job["partitions"],
+                }
+            )
+        elif job["status"] == "failed":
+            result.update({"success": False, "error": job["error"]})
+        elif job["status"] == "duplicate_suspected":
+            review = get_duplicate_review(job_id)
+            result.update(duplicate_response_body(job_id, review["candidates"]))
+
+        return jsonify(result), 200
 
-        if error:
-            return jsonify({"error": error}), 400
+    except Exception as e:
+        return jsonify({"error": f"Errore interno del server: {str(e)}"}), 500
 
-        # Salva l'encoding del volto
-        encoding_path = save_face_encoding(face_encoding, patient_id)
 
-        # Salva i dati nel database
-        timestamp = datetime.now().isoformat()
-        patient_data = (
-            patient_id,
-            name,
-            surname,
-            age,
-            weight,
-            height,
-            blood_type,
-            allergies,
-            json.dumps(diseases),
-            json.dumps(medications),
-            photo_path,
-            encoding_path,
-            timestamp,
-            timestamp,
-        )
-        save_patient(patient_data)
+@app.route("/register-confirm/<job_id>", methods=["POST"])
+def confirm_registration(job_id):
+    """Decisione dell'operatore su una registrazione sospetta (action=register|discard)"""
+    try:
+        action = request.values.get("action") or (
+            request.get_json(silent=True) or {}
+        ).get("action")
+        if action not in ("register", "discard"):
+            return jsonify({"error": "Azione non valida (register o discard)"}), 400
+
+        job = get_registration_job(job_id)
+        if job is None:
+            return jsonify({"error": "Job di registrazione non trovato"}), 404
+        if job["status"] != "duplicate_suspected":
+            return (
+                jsonify(
+                    {
+                        "error": "La registrazione non è in attesa di conferma",
+                        "status": job["status"],
+                    }
+                ),
+                409,
+            )
+
+        if action == "discard":
+            resolve_duplicate_review(job_id, "discarded")
+            registration_queue.discard_photo(job["photo_path"])
+            update_registration_job(
+                job_id,
+                "failed",
+                error="Registrazione annullata: paziente già registrato",
+            )
+            return jsonify({"success": True, "job_id": job_id, "status": "failed"}), 200
 
+        # Confermato come paziente nuovo: il worker lo registra senza ripetere il controllo
+        resolve_duplicate_review(job_id, "confirmed")
+        update_registration_job(job_id, "queued")
+        registration_queue.submit(job_id)
         return (
             jsonify(
                 {
                     "success": True,
-                    "message": "Paziente registrato con successo",
-                    "id": patient_id,
-                    "name": name,
+                    "job_id": job_id,
+                    "status": "queued",
+                    "status_url": f"/register-status/{job_id}",
+                    "message": "Registrazione confermata, in coda",
                 }
             ),
-            200,
+            202,
         )
 
     except Exception as e:
@@ -454,20 +3389,70 @@ def recognize_patient():
         if "foto" not in request.files:
             return jsonify({"error": "Nessuna foto ricevuta"}), 400
 
-        # Salva l'immagine temporaneamente
-        photo_file = request.files["foto"]
+        deadline = request_deadline()
+        partitions = request_partitions()
+        fallback_global = request.form.get("fallback_global", "1") != "0"
+        photo_bytes = request.files["foto"].read()
+
+        # Foto di gruppo (giro visite): tutti i volti in una sola richiesta
+        if request.values.get("multi") == "1":
+            return recognize_group_photo(
+                photo_bytes, partitions, fallback_global, deadline
+            )
+
+        # Foto già vista di recente (retry, doppio tocco): niente dlib
+        content_hash = hashlib.sha256(photo_bytes).hexdigest()
+        cached = result_cache.lookup(content_hash)
+
         temp_filename = f"temp_{uuid.uuid4().hex}.jpg"
-        temp_path = save_image(photo_file, UPLOAD_FOLDER, temp_filename)
+        temp_path = os.path.join(UPLOAD_FOLDER, temp_filename)
 
         try:
-            # Processa l'immagine
-            face_encoding, error = load_and_process_image(temp_path)
-
-            if error:
-                return jsonify({"error": error, "match": False}), 400
+            if cached is None:
+                # Ammissione nella coda di encoding (503 immediato se piena)
+                admitted, queue_depth = admission.acquire(request_priority(), deadline)
+                if not admitted:
+                    return overloaded_response()
+
+                started_at = time.time()
+                cpu_started_at = time.thread_time()
+                try:
+                    # Salva l'immagine temporaneamente
+                    with open(temp_path, "wb") as temp_file:
+                        temp_file.write(photo_bytes)
+
+                    # Processa l'immagine (a risoluzione ridotta se la coda è lunga)
+                    max_dimension = (
+                        DEGRADED_MAX_DIMENSION
+                        if admission.should_degrade(queue_depth)
+                        else None
+                    )
+                    face_encoding, error = load_and_process_image(
+                        temp_path, max_dimension, deadline
+                    )
+                finally:
+                    admission.release(time.time() - started_at)
+
+                if error:
+                    return jsonify({"error": error, "match": False}), 400
+                # Foto quasi uguale a una recente: il suo match vale solo se
+                # anche l'encoding appena calcolato coincide
+                image_hash = perceptual_hash(photo_bytes)
+                cached = result_cache.store(
+                    content_hash,
+                    image_hash,
+                    face_encoding,
+                    time.thread_time() - cpu_started_at,
+                    result_cache.similar(image_hash, face_encoding),
+                )
 
             # Cerca il paziente corrispondente
-            patient_id, confidence = find_matching_patient(face_encoding)
+            pipeline.check_deadline(deadline, "match")
+            match_started_at = time.time()
+            patient_id, confidence, search_scope = result_cache.match(
+                cached, partitions, fallback_global
+            )
+            pipeline.record("match", time.time() - match_started_at)
 
             if patient_id:
                 # Log del riconoscimento riuscito (crea anche la sessione di accesso)
@@ -479,6 +3464,7 @@ def recognize_patient():
                             "match": True,
                             "id": patient_id,
                             "confidence": round(confidence, 3),
+                            "search_scope": search_scope,
                             "access_valid_until": (
                                 datetime.now()
                                 + timedelta(seconds=ACCESS_WINDOW_SECONDS)
@@ -496,6 +3482,7 @@ def recognize_patient():
                     jsonify(
                         {
                             "match": False,
+                            "search_scope": search_scope,
                             "message": "Nessun paziente corrispondente trovato",
                         }
                     ),
@@ -507,6 +3494,329 @@ def recognize_patient():
             if os.path.exists(temp_path):
                 os.remove(temp_path)
 
+    except DeadlineExceeded as e:
+        return deadline_response(e)
+    except Exception as e:
+        return jsonify({"error": f"Errore interno del server: {str(e)}"}), 500
+
+
+def recognize_group_photo(photo_bytes, partitions, fallback_global, deadline):
+    """Riconosce tutti i volti di una foto di gruppo (modalità multi=1)"""
+    admitted, queue_depth = admission.acquire(request_priority(), deadline)
+    if not admitted:
+        return overloaded_response()
+
+    temp_filename = f"temp_{uuid.uuid4().hex}.jpg"
+    temp_path = os.path.join(UPLOAD_FOLDER, temp_filename)
+    started_at = time.time()
+    try:
+        try:
+            with open(temp_path, "wb") as temp_file:
+                temp_file.write(photo_bytes)
+            max_dimension = (
+                DEGRADED_MAX_DIMENSION
+                if admission.should_degrade(queue_depth)
+                else None
+            )
+            face_encodings, locations, error = load_and_process_faces(
+                temp_path, max_dimension, deadline
+            )
+        finally:
+            admission.release(time.time() - started_at)
+
+        if error:
+            return jsonify({"error": error, "match": False}), 400
+
+        pipeline.check_deadline(deadline, "match")
+        match_started_at = time.time()
+        matches = match_faces(face_encodings, partitions, fallback_global)
+        pipeline.record("match", time.time() - match_started_at)
+
+        faces = []
+        for (top, right, bottom, left), (patient_id, confidence, scope) in zip(
+            locations, matches
+        ):
+            face = {
+                "box": {"top": top, "right": right, "bottom": bottom, "left": left},
+                "match": patient_id is not None,
+                "search_scope": scope,
+            }
+            if patient_id:
+                log_recognition(patient_id, confidence, temp_filename, 1)
+                face["id"] = patient_id
+                face["confidence"] = round(confidence, 3)
+            else:
+                log_recognition(None, 0.0, temp_filename, 0)
+            faces.append(face)
+
+        matched = sum(1 for face in faces if face["match"])
+        return (
+            jsonify(
+                {
+                    "multi": True,
+                    "match": matched > 0,
+                    "faces": faces,
+                    "count": len(faces),
+                    "matched": matched,
+                    "access_valid_until": (
+                        datetime.now() + timedelta(seconds=ACCESS_WINDOW_SECONDS)
+                    ).isoformat(),
+                    "message": f"Riconosciuti {matched} pazienti su {len(faces)} volti rilevati.",
+                }
+            ),
+            200,
+        )
+
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+@app.route("/recognize-encoding", methods=["POST"])
+def recognize_encoding():
+    """Riconosce un paziente dall'encoding già calcolato da un gateway"""
+    try:
+        gateway_id, error_response = require_gateway()
+        if error_response:
+            return error_response
+
+        cleanup_expired_sessions()
+
+        payload = request.get_json(silent=True) or {}
+        if "encoding" not in payload:
+            return jsonify({"error": "Nessun encoding ricevuto"}), 400
+        try:
+            target_encoding = decode_encoding(payload["encoding"])
+        except (ValueError, TypeError) as e:
+            return jsonify({"error": f"Encoding non valido: {str(e)}"}), 400
+
+        # Un encoding di un altro modello darebbe distanze senza senso
+        gallery.ensure_loaded()
+        encoding_version = payload.get("encoding_version")
+        if encoding_version is not None and encoding_version != gallery.encoding_tag:
+            return (
+                jsonify(
+                    {
+                        "error": "Versione di encoding non più attiva",
+                        "encoding_version": gallery.encoding_tag,
+                    }
+                ),
+                409,
+            )
+
+        deadline = request_deadline()
+        partitions = sorted(
+            set(request_partitions())
+            | {str(p).strip() for p in payload.get("partitions", []) if str(p).strip()}
+        )
+        fallback_global = bool(payload.get("fallback_global", True))
+
+        # Niente decode/detect/encode: si va direttamente al match
+        pipeline.check_deadline(deadline, "match")
+        match_started_at = time.time()
+        patient_id, confidence, search_scope = match_in_partitions(
+            target_encoding, partitions, fallback_global
+        )
+        pipeline.record("match", time.time() - match_started_at)
+
+        source = f"gateway:{gateway_id}"
+        if patient_id:
+            log_recognition(patient_id, confidence, source, 1)
+
+            return (
+                jsonify(
+                    {
+                        "match": True,
+                        "id": patient_id,
+                        "confidence": round(confidence, 3),
+                        "search_scope": search_scope,
+                        "access_valid_until": (
+                            datetime.now() + timedelta(seconds=ACCESS_WINDOW_SECONDS)
+                        ).isoformat(),
+                        "message": f"Paziente riconosciuto con confidenza {round(confidence * 100, 1)}%. Accesso ai dati autorizzato per {ACCESS_WINDOW_SECONDS} secondi.",
+                    }
+                ),
+                200,
+            )
+
+        log_recognition(None, 0.0, source, 0)
+        return (
+            jsonify(
+                {
+                    "match": False,
+                    "search_scope": search_scope,
+                    "message": "Nessun paziente corrispondente trovato",
+                }
+            ),
+            200,
+        )
+
+    except DeadlineExceeded as e:
+        return deadline_response(e)
+    except Exception as e:
+        return jsonify({"error": f"Errore interno del server: {str(e)}"}), 500
+
+
+@app.route("/gallery/changes", methods=["GET"])
+def get_gallery_changes():
+    """Modifiche della gallery dopo la sequenza `since` (solo encoding, niente anagrafica)"""
+    try:
+        _, error_response = require_gateway()
+        if error_response:
+            return error_response
+
+        try:
+            since = int(request.args.get("since", 0))
+            limit = min(
+                int(request.args.get("limit", GALLERY_SYNC_PAGE_SIZE)),
+                GALLERY_SYNC_PAGE_SIZE,
+            )
+        except ValueError:
+            return jsonify({"error": "Parametri since/limit non validi"}), 400
+        if since < 0 or limit <= 0:
+            return jsonify({"error": "Parametri since/limit non validi"}), 400
+
+        # Mai servire encoding della versione precedente dopo un "reset"
+        gallery.ensure_loaded()
+        gallery.check_encoding_version()
+        changes, memberships, current_seq, more = gallery_changes_since(since, limit)
+
+        result = []
+        for patient_id, op, seq in changes:
+            if op == "reset":
+                # Nuova versione di encoding: la replica va svuotata e ripopolata
+                result.append({"seq": seq, "op": "reset"})
+                continue
+            encoding = None
+            if op == "add":
+                # Il file precede l'inserimento in gallery (registrazione in corso)
+                encoding = gallery.encoding_of(patient_id)
+                if encoding is None:
+                    encoding = load_face_encoding(patient_id)
+            if encoding is None:
+                # Rimosso o senza encoding: per la replica è comunque assente
+                result.append({"seq": seq, "id": patient_id, "op": "remove"})
+                continue
+            result.append(
+                {
+                    "seq": seq,
+                    "id": patient_id,
+                    "op": "add",
+                    "encoding": base64.b64encode(
+                        np.asarray(encoding, dtype="<f4").tobytes()
+                    ).decode("ascii"),
+                    "partitions": sorted(memberships.get(patient_id, [])),
+                }
+            )
+
+        return (
+            jsonify(
+                {
+                    "changes": result,
+                    "next_since": (
+                        changes[-1][2] if changes else max(since, current_seq)
+                    ),
+                    "current_seq": current_seq,
+                    "more": more,
+                    "encoding_version": gallery.encoding_tag,
+                    "encoding_settings": gallery.encoding_settings,
+                }
+            ),
+            200,
+        )
+
+    except Exception as e:
+        return jsonify({"error": f"Errore interno del server: {str(e)}"}), 500
+
+
+@app.route("/gallery/access-log", methods=["POST"])
+def reconcile_gateway_access_log():
+    """Registra i riconoscimenti fatti da un gateway mentre era offline"""
+    try:
+        gateway_id, error_response = require_gateway()
+        if error_response:
+            return error_response
+
+        payload = request.get_json(silent=True) or {}
+        entries = payload.get("entries")
+        if not isinstance(entries, list):
+            return jsonify({"error": "Campo entries mancante"}), 400
+        if len(entries) > ACCESS_LOG_MAX_BATCH:
+            return (
+                jsonify({"error": f"Massimo {ACCESS_LOG_MAX_BATCH} voci per invio"}),
+                413,
+            )
+
+        conn = sqlite3.connect(DATABASE)
+        cursor = conn.cursor()
+        received_at = datetime.now().isoformat()
+        duplicates = 0
+        acknowledged = []
+        rejected = []
+        accepted = []  # (recognized_at, confidence, success) per /stats/stream
+
+        try:
+            for entry in entries:
+                if not isinstance(entry, dict):
+                    continue
+                entry_id = str(entry.get("entry_id", ""))
+                if not entry_id:
+                    continue
+                acknowledged.append(entry_id)
+
+                # Una voce malformata non deve bloccare il resto del lotto: viene
+                # confermata (il gateway la scarta) e segnalata in "rejected"
+                try:
+                    recognized_at = local_datetime(entry["recognized_at"]).isoformat()
+                    confidence = float(entry.get("confidence") or 0.0)
+                except (KeyError, TypeError, ValueError):
+                    rejected.append(entry_id)
+                    continue
+
+                cursor.execute(
+                    """
+                    INSERT OR IGNORE INTO gateway_log_receipts
+                    (gateway_id, entry_id, received_at) VALUES (?, ?, ?)
+                """,
+                    (gateway_id, entry_id, received_at),
+                )
+                if cursor.rowcount == 0:
+                    duplicates += 1
+                    continue
+
+                # Niente sessione di accesso: il riconoscimento è nel passato
+                success = 1 if entry.get("success") and entry.get("patient_id") else 0
+                insert_recognition_row(
+                    cursor,
+                    entry.get("patient_id") if success else None,
+                    recognized_at,
+                    confidence,
+                    f"gateway:{gateway_id}:offline",
+                    success,
+                )
+                accepted.append((recognized_at, confidence, success))
+            conn.commit()
+        finally:
+            conn.close()
+
+        # Come per i riconoscimenti online, dopo il commit: /stats/stream resta
+        # allineato a /stats anche quando un gateway torna in linea
+        for recognized_at, confidence, success in accepted:
+            stats_stream.notify_recognition(recognized_at, confidence, success)
+
+        return (
+            jsonify(
+                {
+                    "success": True,
+                    "accepted": len(accepted),
+                    "duplicates": duplicates,
+                    "acknowledged": acknowledged,
+                    "rejected": rejected,
+                }
+            ),
+            200,
+        )
+
     except Exception as e:
         return jsonify({"error": f"Errore interno del server: {str(e)}"}), 500
 
@@ -655,47 +3965,79 @@ def get_recognition_log():
 def get_statistics():
     """Recupera statistiche aggregate del sistema (senza dati sensibili)"""
     try:
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
+        return jsonify(compute_statistics()), 200
 
-        # Conta pazienti totali
-        cursor.execute("SELECT COUNT(*) FROM patients")
-        total_patients = cursor.fetchone()[0]
+    except Exception as e:
+        return jsonify({"error": f"Errore interno del server: {str(e)}"}), 500
 
-        # Conta riconoscimenti totali
-        cursor.execute("SELECT COUNT(*) FROM recognition_log")
-        total_recognitions = cursor.fetchone()[0]
 
-        # Conta riconoscimenti riusciti
-        cursor.execute("SELECT COUNT(*) FROM recognition_log WHERE success = 1")
-        successful_recognitions = cursor.fetchone()[0]
+@app.route("/stats/stream", methods=["GET"])
+def stream_statistics():
+    """Statistiche e riconoscimenti anonimi in diretta (Server-Sent Events)"""
+    subscriber = stats_stream.subscribe()
+    if subscriber is None:
+        response = jsonify({"error": "Troppi client collegati, riprovare tra poco"})
+        response.headers["Retry-After"] = str(STATS_STREAM_KEEPALIVE_SECONDS)
+        return response, 503
 
-        # Conta sessioni attive
-        cursor.execute(
-            """
-            SELECT COUNT(*) FROM access_sessions 
-            WHERE session_valid_until > ?
-        """,
-            (datetime.now().isoformat(),),
-        )
-        active_sessions = cursor.fetchone()[0]
+    def events():
+        try:
+            while True:
+                try:
+                    message = subscriber.get(timeout=STATS_STREAM_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    # Commento SSE: tiene aperta la connessione e rileva i client chiusi
+                    message = ": keepalive\n\n"
+                yield message
+        finally:
+            stats_stream.unsubscribe(subscriber)
+
+    return Response(
+        events(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-        conn.close()
 
-        success_rate = 0
-        if total_recognitions > 0:
-            success_rate = (successful_recognitions / total_recognitions) * 100
+@app.route("/stats/timeseries", methods=["GET"])
+def get_statistics_timeseries():
+    """Serie temporale dei riconoscimenti dagli aggregati per ora o per giorno"""
+    try:
+        granularity = request.args.get("granularity", "hour")
+        if granularity not in ROLLUP_STEPS:
+            return jsonify({"error": "Granularità non valida (hour|day)"}), 400
+        step = ROLLUP_STEPS[granularity]
+
+        try:
+            if "to" in request.args:
+                end = local_datetime(request.args["to"])
+            else:
+                end = rollup_floor(granularity, datetime.now()) + step
+            if "from" in request.args:
+                start = local_datetime(request.args["from"])
+            else:
+                start = end - step * ROLLUP_DEFAULT_BUCKETS[granularity]
+        except ValueError:
+            return jsonify({"error": "Date non valide (formato ISO)"}), 400
+
+        # Bucket interi: l'inizio si allinea all'ora o al giorno
+        start = rollup_floor(granularity, start)
+        if end <= start:
+            return jsonify({"error": "Intervallo vuoto"}), 400
+        if (end - start) / step > TIMESERIES_MAX_BUCKETS:
+            return (
+                jsonify({"error": f"Massimo {TIMESERIES_MAX_BUCKETS} bucket"}),
+                400,
+            )
 
+        series = recognition_timeseries(granularity, start, end)
         return (
             jsonify(
                 {
-                    "total_patients": total_patients,
-                    "total_recognitions": total_recognitions,
-                    "successful_recognitions": successful_recognitions,
-                    "success_rate": round(success_rate, 2),
-                    "active_sessions": active_sessions,
-                    "access_window_seconds": ACCESS_WINDOW_SECONDS,
-                    "threshold": SIMILARITY_THRESHOLD,
+                    "granularity": granularity,
+                    "from": start.isoformat(),
+                    "to": end.isoformat(),
+                    "buckets": series,
                 }
             ),
             200,
@@ -727,15 +4069,265 @@ def check_session_status(patient_id):
         return jsonify({"error": f"Errore interno del server: {str(e)}"}), 500
 
 
+@app.route("/partitions", methods=["POST"])
+def update_patient_partitions():
+    """Aggiunge o rimuove un paziente da partizioni (es. ricovero in un reparto)"""
+    try:
+        patient_id = request.form.get("id", "").strip()
+        action = request.form.get("action", "add")
+        partitions = request_partitions()
+
+        if not patient_id:
+            return jsonify({"error": "ID paziente mancante"}), 400
+        if not partitions:
+            return jsonify({"error": "Nessuna partizione indicata"}), 400
+        if action not in ("add", "remove"):
+            return jsonify({"error": "Azione non valida (add|remove)"}), 400
+        if not get_patient(patient_id):
+            return jsonify({"error": "Paziente non trovato"}), 404
+
+        if action == "add":
+            update_partitions(patient_id, add=partitions)
+            gallery.update_partitions(patient_id, add=partitions)
+        else:
+            update_partitions(patient_id, remove=partitions)
+            gallery.update_partitions(patient_id, remove=partitions)
+
+        return (
+            jsonify(
+                {
+                    "success": True,
+                    "id": patient_id,
+                    "partitions": gallery.partitions_of(patient_id),
+                }
+            ),
+            200,
+        )
+
+    except Exception as e:
+        return jsonify({"error": f"Errore interno del server: {str(e)}"}), 500
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Metriche di esercizio in memoria (senza dati sensibili)"""
+    return (
+        jsonify(
+            {
+                "admission": admission.metrics(),
+                "pipeline": pipeline.metrics(),
+                "result_cache": result_cache.metrics(),
+                "hot_set": hot_set.metrics(),
+                "gallery": gallery.metrics(),
+                "registration": registration_queue.metrics(),
+                "startup": startup.metrics(),
+                "stats_stream": stats_stream.metrics(),
+            }
+        ),
+        200,
+    )
+
+
+@app.route("/admin/profile", methods=["GET", "POST"])
+def admin_profile():
+    """Avvia una profilazione (POST) o ne restituisce lo stato (GET)"""
+    denied = require_admin()
+    if denied:
+        return denied
+
+    if request.method == "GET":
+        return jsonify(profiler.status()), 200
+
+    try:
+        mode = request.values.get("mode", "requests")
+        seconds = float(request.values.get("seconds", PROFILE_DEFAULT_SECONDS))
+        if seconds <= 0:
+            return jsonify({"error": "Durata non valida"}), 400
+
+        if mode == "requests":
+            fraction = float(request.values.get("fraction", 0.1))
+            max_requests = int(request.values.get("max_requests", 0))
+            if not 0 < fraction <= 1:
+                return jsonify({"error": "Frazione deve essere in (0, 1]"}), 400
+            started = profiler.start_requests(seconds, fraction, max_requests)
+        elif mode == "sampler":
+            interval_ms = float(request.values.get("interval_ms", SAMPLER_INTERVAL_MS))
+            started = profiler.start_sampler(seconds, interval_ms)
+        else:
+            return jsonify({"error": "Modalità non valida (requests|sampler)"}), 400
+
+        if not started:
+            return (
+                jsonify({"error": "Profilazione già in corso", **profiler.status()}),
+                409,
+            )
+        return jsonify({"success": True, **profiler.status()}), 200
+
+    except ValueError:
+        return jsonify({"error": "Parametri di profilazione non validi"}), 400
+    except Exception as e:
+        return jsonify({"error": f"Errore interno del server: {str(e)}"}), 500
+
+
+@app.route("/admin/memory-snapshot", methods=["POST"])
+def admin_memory_snapshot():
+    """Snapshot tracemalloc (la prima chiamata avvia il tracciamento)"""
+    denied = require_admin()
+    if denied:
+        return denied
+
+    try:
+        top = int(request.values.get("top", 15))
+        snapshot = profiler.memory_snapshot(top)
+        snapshot["components_bytes"] = component_memory_usage()
+        return jsonify(snapshot), 200
+    except Exception as e:
+        return jsonify({"error": f"Errore interno del server: {str(e)}"}), 500
+
+
+@app.route("/admin/patients/<patient_id>", methods=["DELETE"])
+def admin_delete_patient(patient_id):
+    """Elimina un paziente: la rimozione arriva ai gateway con la sincronizzazione"""
+    denied = require_admin()
+    if denied:
+        return denied
+
+    try:
+        if not delete_patient(patient_id):
+            return jsonify({"error": "Paziente non trovato"}), 404
+        gallery.remove(patient_id)
+        hot_set.discard(patient_id)
+        return jsonify({"success": True, "id": patient_id}), 200
+    except Exception as e:
+        return jsonify({"error": f"Errore interno del server: {str(e)}"}), 500
+
+
+@app.route("/shard/search", methods=["POST"])
+def shard_search():
+    """Paziente più vicino in questo shard per ciascun encoding (senza soglia né log)"""
+    denied = require_shard_token()
+    if denied:
+        return denied
+
+    try:
+        payload = request.get_json(silent=True) or {}
+        try:
+            encodings = [decode_encoding(value) for value in payload["encodings"]]
+        except (KeyError, ValueError, TypeError) as e:
+            return jsonify({"error": f"Encoding non valido: {str(e)}"}), 400
+        partitions = sorted(set(payload.get("partitions", [])))
+
+        # Il coordinatore deve codificare con il modello della versione attiva
+        conflict = shard_encoding_conflict(payload)
+        if conflict:
+            return conflict
+
+        pipeline.check_deadline(request_deadline(), "match")
+        match_started_at = time.time()
+        results = []
+        for encoding in encodings:
+            patient_id, distance = gallery.search(encoding, partitions or None)
+            results.append(
+                {
+                    "id": patient_id,
+                    "distance": distance if patient_id else None,
+                }
+            )
+        pipeline.record("match", time.time() - match_started_at)
+
+        return (
+            jsonify(
+                {
+                    "shard": SHARD_INDEX,
+                    "gallery_size": len(gallery.ids),
+                    "encoding_version": gallery.encoding_tag,
+                    "results": results,
+                }
+            ),
+            200,
+        )
+
+    except DeadlineExceeded as e:
+        return deadline_response(e)
+    except Exception as e:
+        return jsonify({"error": f"Errore interno del server: {str(e)}"}), 500
+
+
+@app.route("/shard/duplicates", methods=["POST"])
+def shard_duplicates():
+    """Pazienti di questo shard simili a un nuovo paziente (controllo dei duplicati)"""
+    denied = require_shard_token()
+    if denied:
+        return denied
+
+    try:
+        payload = request.get_json(silent=True) or {}
+        try:
+            encoding = decode_encoding(payload["encoding"])
+        except (KeyError, ValueError, TypeError) as e:
+            return jsonify({"error": f"Encoding non valido: {str(e)}"}), 400
+        conflict = shard_encoding_conflict(payload)
+        if conflict:
+            return conflict
+
+        candidates = find_duplicate_candidates(encoding)
+        return (
+            jsonify(
+                {
+                    "shard": SHARD_INDEX,
+                    "candidates": [
+                        {"id": patient_id, "distance": distance}
+                        for patient_id, distance in candidates
+                    ],
+                }
+            ),
+            200,
+        )
+
+    except Exception as e:
+        return jsonify({"error": f"Errore interno del server: {str(e)}"}), 500
+
+
+@app.route("/shard/log", methods=["POST"])
+def shard_log():
+    """Registra un riconoscimento deciso dal coordinatore (crea la sessione di accesso)"""
+    denied = require_shard_token()
+    if denied:
+        return denied
+
+    try:
+        payload = request.get_json(silent=True) or {}
+        patient_id = payload.get("patient_id")
+        if patient_id and shard_of(patient_id) != SHARD_INDEX:
+            return jsonify({"error": "ID paziente di un altro shard"}), 421
+
+        confidence = float(payload.get("confidence", 0.0))
+        log_recognition(patient_id, confidence, "coordinator", 1 if patient_id else 0)
+        return jsonify({"success": True}), 200
+    except Exception as e:
+        return jsonify({"error": f"Errore interno del server: {str(e)}"}), 500
+
+
 # --- Avvio del server ---
 if __name__ == "__main__":
     print("Inizializzazione Secure Face Recognition Server...")
-    init_database()
-    print("Database inizializzato.")
-    print(f"Server in ascolto su http://0.0.0.0:5000")
+    # Con il reloader di debug l'avvio serve solo nel processo che gestisce le
+    # richieste. Gira in background: "/" risponde subito, /ready a fine avvio
+    if not DEBUG_MODE or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        startup.start(run_startup)
+    if SHARD_COUNT > 1:
+        print(f"Shard {SHARD_INDEX + 1}/{SHARD_COUNT} della gallery")
+    print(f"Server in ascolto su http://0.0.0.0:{SERVER_PORT}")
     print(f"Soglia di riconoscimento: {SIMILARITY_THRESHOLD}")
     print(f"Finestra di accesso: {ACCESS_WINDOW_SECONDS} secondi dopo riconoscimento")
+    if trace_recorder is not None:
+        print(f"Trace delle richieste attivo: {trace_recorder.path}")
+    # kill -USR1 <pid> avvia un campionamento anche senza token amministrativo
+    signal.signal(
+        signal.SIGUSR1,
+        lambda signum, frame: profiler.start_sampler(PROFILE_DEFAULT_SECONDS),
+    )
     print(
         "⚠️  Sicurezza: Accesso ai dati pazienti solo dopo riconoscimento facciale recente"
     )
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    app.run(host="0.0.0.0", port=SERVER_PORT, debug=DEBUG_MODE)
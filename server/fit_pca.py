@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Calcola (o aggiorna) la proiezione PCA usata come prefiltro della gallery.
+
+La proiezione viene salvata come pca_projection.npz nella cartella della
+versione di encoding attiva: i server in esecuzione la ricaricano da soli entro
+PCA_RELOAD_CHECK_SECONDS. Va rieseguito quando la gallery cresce molto o dopo
+aver attivato una nuova versione con reencode_gallery.py.
+
+    python fit_pca.py --dims 32
+"""
+
+import argparse
+import os
+from datetime import datetime
+
+import numpy as np
+
+import face_server
+
+
+def fit_pca_projection(encodings, dims):
+    """Media e prime `dims` componenti principali degli encoding"""
+    mean = encodings.mean(axis=0)
+    _, singular_values, components = np.linalg.svd(
+        encodings - mean, full_matrices=False
+    )
+    variance = singular_values**2
+    explained = variance[:dims].sum() / variance.sum()
+    return mean, components[:dims], float(explained)
+
+
+def save_projection(path, mean, components, n_samples):
+    """Scrive la proiezione in modo atomico (i server non leggono file a metà)"""
+    temp_path = f"{path}.tmp.npz"
+    np.savez(
+        temp_path,
+        mean=mean,
+        components=components,
+        n_samples=n_samples,
+        fitted_at=datetime.now().isoformat(),
+    )
+    os.replace(temp_path, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit della proiezione PCA")
+    parser.add_argument("--dims", type=int, default=32, help="Dimensioni ridotte")
+    parser.add_argument(
+        "--sample",
+        type=int,
+        default=100000,
+        help="Numero massimo di encoding usati per il fit",
+    )
+    parser.add_argument(
+        "--output",
+        help="File di destinazione (default: cartella della versione attiva)",
+    )
+    args = parser.parse_args()
+
+    gallery = face_server.GalleryIndex()
+    gallery.load()
+    count = len(gallery.ids)
+    if count <= args.dims:
+        print(f"Servono più di {args.dims} encoding per il fit (trovati {count}).")
+        return
+
+    encodings = gallery.buffer[:count]
+    if count > args.sample:
+        rows = np.random.default_rng().choice(count, args.sample, replace=False)
+        encodings = encodings[rows]
+
+    mean, components, explained = fit_pca_projection(encodings, args.dims)
+    output = args.output or gallery.projection_path()
+    save_projection(output, mean, components, len(encodings))
+
+    print(
+        f"Proiezione a {args.dims} dimensioni calcolata su {len(encodings)} encoding "
+        f"({explained * 100:.1f}% della varianza) e salvata in {output}"
+    )
+
+
+if __name__ == "__main__":
+    main()
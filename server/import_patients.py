@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""Importazione massiva di pazienti da un CSV e una cartella di foto.
+
+Il CSV ha gli stessi campi di /register, più la colonna `foto` con il nome del
+file nella cartella delle foto. Le liste (diseases, medications, partitions)
+sono separate da ";":
+
+    foto,nome,surname,age,weight,height,gruppo,allergie,diseases,medications,partitions
+    rossi.jpg,Mario,Rossi,71,80,175,A+,,Ipertensione;Diabete,Metformina,ospedale-a/cardio
+
+L'encoding avviene in parallelo su tutti i core; pazienti, partizioni ed
+encoding sono scritti in transazioni da --batch righe. Ogni riga importata è
+registrata in import_log nella stessa transazione, quindi rieseguire il comando
+sullo stesso CSV riprende da dove si era interrotto (le righe fallite vengono
+ritentate). Gli errori per riga finiscono in un CSV e non fermano l'import.
+Un server già avviato carica i nuovi pazienti da solo, entro
+GALLERY_SYNC_CHECK_SECONDS dal commit di ogni transazione.
+
+    python import_patients.py pazienti.csv foto/ --workers 8 --batch 500
+"""
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime
+from multiprocessing import Pool
+
+import face_server
+import photo_store
+
+LIST_SEPARATOR = ";"
+
+
+def init_import_log(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS import_log (
+            source TEXT NOT NULL,
+            row_key TEXT NOT NULL,
+            patient_id TEXT,
+            status TEXT NOT NULL,
+            error TEXT,
+            imported_at TEXT,
+            PRIMARY KEY (source, row_key)
+        )
+    """
+    )
+    conn.commit()
+
+
+def split_list(value):
+    return [
+        item.strip() for item in (value or "").split(LIST_SEPARATOR) if item.strip()
+    ]
+
+
+def parse_number(value, cast, default):
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_record(row):
+    """Campi del paziente da una riga del CSV (stesse regole di /register)"""
+    return {
+        "name": (row.get("nome") or "").strip(),
+        "surname": (row.get("surname") or "").strip(),
+        "age": parse_number(row.get("age"), int, 0),
+        "weight": parse_number(row.get("weight"), float, 0.0),
+        "height": parse_number(row.get("height"), float, 0.0),
+        "blood_type": (row.get("gruppo") or "").strip(),
+        "allergies": (row.get("allergie") or "").strip(),
+        "diseases": split_list(row.get("diseases")),
+        "medications": split_list(row.get("medications")),
+        "partitions": sorted(set(split_list(row.get("partitions")))),
+    }
+
+
+def encode_record(task):
+    """Eseguito nei processi del pool: encoding della foto e copia nell'archivio foto"""
+    row_key, photo_path, settings = task
+    face_encoding, face_location, error = face_server.load_face_with_location(
+        photo_path, settings=settings
+    )
+    if error:
+        return row_key, None, None, None, error
+
+    patient_id = face_server.new_patient_id()
+    photo = photo_store.store_photo(
+        photo_path, face_location, datetime.now().isoformat()
+    )
+    return row_key, patient_id, photo, face_encoding, None
+
+
+def write_batch(conn, source, batch, tag):
+    """Scrive encoding, pazienti, partizioni e import_log in un'unica transazione"""
+    now = datetime.now().isoformat()
+    cursor = conn.cursor()
+    for row_key, patient_id, photo, face_encoding, record in batch:
+        encoding_path = face_server.save_face_encoding(
+            face_encoding, patient_id, tag=tag
+        )
+        cursor.execute(
+            """
+            INSERT INTO patients (id, name, surname, age, weight, height, blood_type,
+                                  allergies, diseases, medications, photo_path,
+                                  face_encoding_path, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+            (
+                patient_id,
+                record["name"],
+                record["surname"],
+                record["age"],
+                record["weight"],
+                record["height"],
+                record["blood_type"],
+                record["allergies"],
+                json.dumps(record["diseases"]),
+                json.dumps(record["medications"]),
+                photo["crop_path"],
+                encoding_path,
+                now,
+                now,
+            ),
+        )
+        cursor.executemany(
+            "INSERT OR IGNORE INTO patient_partitions (patient_id, partition) VALUES (?, ?)",
+            [(patient_id, partition) for partition in record["partitions"]],
+        )
+        photo_store.record_photo(cursor, photo, patient_id)
+        face_server.record_gallery_change(cursor, patient_id, "add")
+        cursor.execute(
+            """
+            INSERT OR REPLACE INTO import_log
+            (source, row_key, patient_id, status, error, imported_at)
+            VALUES (?, ?, ?, 'imported', NULL, ?)
+        """,
+            (source, row_key, patient_id, now),
+        )
+    conn.commit()
+
+
+def record_failure(conn, source, row_key, error, failures_writer):
+    conn.execute(
+        """
+        INSERT OR REPLACE INTO import_log
+        (source, row_key, patient_id, status, error, imported_at)
+        VALUES (?, ?, NULL, 'failed', ?, ?)
+    """,
+        (source, row_key, error, datetime.now().isoformat()),
+    )
+    failures_writer.writerow([row_key, error])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Importazione massiva di pazienti")
+    parser.add_argument("csv", help="CSV con i campi di /register e la colonna foto")
+    parser.add_argument("photos", help="Cartella delle foto")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="Processi di encoding"
+    )
+    parser.add_argument("--batch", type=int, default=500, help="Righe per transazione")
+    parser.add_argument(
+        "--failures",
+        default=f"import_failures_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+        help="CSV in cui scrivere le righe non importate",
+    )
+    args = parser.parse_args()
+
+    face_server.init_database()
+    # Questo processo non carica la gallery: modello e cartella della versione
+    # attiva si leggono qui e si passano esplicitamente a encoding e salvataggio
+    tag, settings = face_server.read_active_encoding_version()
+    os.makedirs(face_server.encodings_folder(tag), exist_ok=True)
+    conn = sqlite3.connect(face_server.DATABASE)
+    init_import_log(conn)
+    source = os.path.abspath(args.csv)
+
+    imported_keys = {
+        row[0]
+        for row in conn.execute(
+            "SELECT row_key FROM import_log WHERE source = ? AND status = 'imported'",
+            (source,),
+        )
+    }
+
+    with open(args.failures, "w", newline="") as failures_file:
+        failures = csv.writer(failures_file)
+        failures.writerow(["row", "error"])
+
+        # Le righe già importate (esecuzioni precedenti) vengono saltate
+        tasks, records = [], {}
+        skipped = failed = 0
+        with open(args.csv, newline="", encoding="utf-8-sig") as csv_file:
+            for line_number, row in enumerate(csv.DictReader(csv_file), start=2):
+                photo = (row.get("foto") or "").strip()
+                row_key = f"{line_number}:{photo}"
+                if row_key in imported_keys:
+                    skipped += 1
+                    continue
+
+                record = parse_record(row)
+                photo_path = os.path.join(args.photos, photo)
+                if not record["name"]:
+                    error = "Nome è obbligatorio"
+                elif not photo or not os.path.exists(photo_path):
+                    error = f"Foto non trovata: {photo}"
+                else:
+                    records[row_key] = record
+                    tasks.append((row_key, photo_path, settings))
+                    continue
+                record_failure(conn, source, row_key, error, failures)
+                failed += 1
+        conn.commit()
+
+        print(
+            f"{len(tasks)} righe da importare ({skipped} già importate, "
+            f"{failed} non valide), {args.workers} processi, "
+            f"encoding {tag or 'originale'}"
+        )
+
+        started_at = time.time()
+        imported = 0
+        batch = []
+        with Pool(args.workers) as pool:
+            results = pool.imap_unordered(encode_record, tasks, chunksize=8)
+            for row_key, patient_id, photo, face_encoding, error in results:
+                if error:
+                    record_failure(conn, source, row_key, error, failures)
+                    failed += 1
+                    continue
+
+                batch.append(
+                    (row_key, patient_id, photo, face_encoding, records[row_key])
+                )
+                if len(batch) >= args.batch:
+                    write_batch(conn, source, batch, tag)
+                    imported += len(batch)
+                    batch = []
+                    elapsed = time.time() - started_at
+                    print(
+                        f"  {imported} pazienti importati, {failed} errori "
+                        f"({imported / elapsed:.1f} pazienti/s)"
+                    )
+
+        if batch:
+            write_batch(conn, source, batch, tag)
+            imported += len(batch)
+        conn.commit()
+
+    conn.close()
+    elapsed = time.time() - started_at
+    print(
+        f"Import completato in {elapsed:.1f}s: {imported} pazienti importati, "
+        f"{failed} righe non importate (dettagli in {args.failures})"
+    )
+
+
+if __name__ == "__main__":
+    main()
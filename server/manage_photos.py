@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""Gestione dell'archivio foto (photo_store.py).
+
+    python manage_photos.py migrate --workers 8
+        Sposta nell'archivio le foto dei pazienti registrati prima
+        dell'archivio (face_uploads/<id>.jpg). Le foto identiche vengono
+        salvate una volta sola, e per ciascuna si crea il ritaglio del volto.
+
+    python manage_photos.py archive --older-than-days 90
+        Passa al livello di archivio gli originali più vecchi: vengono
+        ridimensionati e ricompressi. Riconoscimento e ricodifica usano solo i
+        ritagli.
+
+    python manage_photos.py report
+        Spazio occupato per livello, ritagli e risparmio dalla deduplicazione.
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+
+import face_server
+import photo_store
+
+
+def locate_and_store(task):
+    """Eseguito nei processi del pool: posizione del volto e copia nell'archivio"""
+    patient_id, photo_path, settings = task
+    if not photo_path or not os.path.exists(photo_path):
+        return patient_id, None, f"Foto non trovata: {photo_path}"
+    _, face_location, error = face_server.load_face_with_location(
+        photo_path, settings=settings
+    )
+    if error:
+        return patient_id, None, error
+    photo = photo_store.store_photo(
+        photo_path, face_location, datetime.now().isoformat()
+    )
+    return patient_id, photo, None
+
+
+def write_migrated(conn, migrated):
+    cursor = conn.cursor()
+    for patient_id, photo, _ in migrated:
+        photo_store.record_photo(cursor, photo, patient_id)
+        cursor.execute(
+            "UPDATE patients SET photo_path = ? WHERE id = ?",
+            (photo["crop_path"], patient_id),
+        )
+    conn.commit()
+    for _, _, old_path in migrated:
+        if os.path.exists(old_path):
+            os.remove(old_path)
+
+
+def migrate(conn, args):
+    pending = conn.execute(
+        """
+        SELECT id, photo_path FROM patients
+        WHERE id NOT IN (SELECT patient_id FROM patient_photos)
+    """
+    ).fetchall()
+    print(f"{len(pending)} pazienti con foto fuori dall'archivio")
+    old_paths = dict(pending)
+    # Stesso rilevatore della versione attiva: il ritaglio inquadra lo stesso volto
+    _, settings = face_server.read_active_encoding_version()
+    tasks = [(patient_id, photo_path, settings) for patient_id, photo_path in pending]
+
+    started_at = time.time()
+    done = failed = 0
+    batch = []
+    with Pool(args.workers) as pool:
+        for patient_id, photo, error in pool.imap_unordered(
+            locate_and_store, tasks, chunksize=8
+        ):
+            if error:
+                print(f"  {patient_id}: {error}")
+                failed += 1
+                continue
+            batch.append((patient_id, photo, old_paths[patient_id]))
+            if len(batch) >= args.batch:
+                write_migrated(conn, batch)
+                done += len(batch)
+                batch = []
+                print(f"  {done} foto migrate")
+    write_migrated(conn, batch)
+    done += len(batch)
+    print(
+        f"Migrazione completata in {time.time() - started_at:.1f}s: "
+        f"{done} foto migrate, {failed} lasciate dove sono"
+    )
+
+
+def archive(conn, args):
+    cutoff = (datetime.now() - timedelta(days=args.older_than_days)).isoformat()
+    rows = conn.execute(
+        "SELECT hash, original_path, original_bytes FROM photos WHERE tier = ? AND created_at < ?",
+        (photo_store.TIER_ORIGINAL, cutoff),
+    ).fetchall()
+
+    before = after = archived = 0
+    for photo_hash, original_path, original_bytes in rows:
+        if not os.path.exists(original_path):
+            print(f"  {photo_hash}: originale mancante")
+            continue
+        archive_path, archive_bytes = photo_store.archive_original(
+            original_path, photo_hash
+        )
+        with conn:
+            conn.execute(
+                """
+                UPDATE photos SET original_path = ?, original_bytes = ?, tier = ?
+                WHERE hash = ?
+            """,
+                (archive_path, archive_bytes, photo_store.TIER_ARCHIVE, photo_hash),
+            )
+        os.remove(original_path)
+        before += original_bytes or 0
+        after += archive_bytes
+        archived += 1
+    print(
+        f"{archived} originali archiviati: {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB"
+    )
+
+
+def folder_bytes(folder):
+    total = 0
+    for root, _, files in os.walk(folder):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in files)
+    return total
+
+
+def report(conn, args):
+    print(f"{'livello':<12}{'foto':>8}{'MB':>10}")
+    for tier, count, size in conn.execute(
+        "SELECT tier, COUNT(*), SUM(original_bytes) FROM photos GROUP BY tier"
+    ):
+        print(f"{tier:<12}{count:>8}{(size or 0) / 1e6:>10.1f}")
+    count, size = conn.execute(
+        "SELECT COUNT(*), SUM(crop_bytes) FROM photos"
+    ).fetchone()
+    print(f"{'ritagli':<12}{count:>8}{(size or 0) / 1e6:>10.1f}")
+
+    # Ogni paziente oltre il primo sulla stessa foto è spazio risparmiato
+    saved = conn.execute(
+        """
+        SELECT COALESCE(SUM((links - 1) * (original_bytes + crop_bytes)), 0),
+               COALESCE(SUM(links - 1), 0)
+        FROM photos JOIN (
+            SELECT photo_hash, COUNT(*) AS links FROM patient_photos GROUP BY photo_hash
+        ) ON photo_hash = hash
+    """
+    ).fetchone()
+    print(f"Deduplicazione: {saved[1]} copie evitate, {saved[0] / 1e6:.1f} MB")
+    print(
+        f"Foto non ancora migrate in {face_server.UPLOAD_FOLDER}: "
+        f"{folder_bytes(face_server.UPLOAD_FOLDER) / 1e6:.1f} MB"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gestione dell'archivio foto")
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = commands.add_parser("migrate", help="Sposta le foto nell'archivio")
+    migrate_parser.add_argument("--workers", type=int, default=os.cpu_count())
+    migrate_parser.add_argument("--batch", type=int, default=200)
+    archive_parser = commands.add_parser("archive", help="Archivia gli originali")
+    archive_parser.add_argument("--older-than-days", type=int, default=90)
+    commands.add_parser("report", help="Spazio occupato")
+    args = parser.parse_args()
+
+    face_server.init_database()
+    conn = sqlite3.connect(face_server.DATABASE)
+    {"migrate": migrate, "archive": archive, "report": report}[args.command](conn, args)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
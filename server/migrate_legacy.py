@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""Migrazione dei dati di server.py (pazienti.db) nello schema di face_server.py.
+
+Importa in blocco la tabella pazienti, il log log_accessi, gli encoding .npy
+della cartella encodings/ e le foto di uploads/. Gli ID dei pazienti restano
+gli stessi. I timestamp del log (UTC in server.py) diventano ora locale, come
+in face_server.py. Gli accessi "nessun_volto" e "sconosciuto" diventano
+riconoscimenti non riusciti.
+
+La migrazione si può ripetere: i pazienti già presenti vengono saltati, e del
+log si importano solo le righe successive all'ultima migrata (salvata in
+gallery_meta). Va eseguita dalla cartella di face_server.py; un server già
+avviato carica i pazienti importati senza riavvio.
+
+    python migrate_legacy.py /percorso/vecchio_server --batch 1000
+"""
+
+import argparse
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+import face_server
+
+LEGACY_DATABASE = "pazienti.db"
+LEGACY_ENCODINGS = "encodings"
+LEGACY_UNMATCHED = ("nessun_volto", "sconosciuto")
+
+
+def local_time(utc_timestamp):
+    """Timestamp UTC di server.py -> ora locale senza fuso, come face_server.py"""
+    try:
+        parsed = datetime.fromisoformat(utc_timestamp)
+    except (TypeError, ValueError):
+        return utc_timestamp
+    return (
+        parsed.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+    ).isoformat()
+
+
+def load_legacy_encoding(legacy_dir, patient_id):
+    path = os.path.join(legacy_dir, LEGACY_ENCODINGS, f"{patient_id}.npy")
+    try:
+        encoding = np.load(path)
+    except (OSError, ValueError):
+        return None
+    if encoding.shape != (face_server.ENCODING_DIMENSIONS,):
+        return None
+    return encoding
+
+
+def copy_photo(legacy_dir, patient_id, legacy_path):
+    """Copia la foto in face_uploads; None se non si trova"""
+    if not legacy_path:
+        return None
+    source = (
+        legacy_path
+        if os.path.isabs(legacy_path)
+        else os.path.join(legacy_dir, legacy_path)
+    )
+    if not os.path.exists(source):
+        return None
+    target = os.path.join(face_server.UPLOAD_FOLDER, f"{patient_id}.jpg")
+    shutil.copyfile(source, target)
+    return target
+
+
+def legacy_tables(legacy):
+    """Tabelle presenti nel database di server.py (installazioni parziali o vecchie)"""
+    return {
+        row[0]
+        for row in legacy.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    }
+
+
+def migrate_patients(conn, legacy, legacy_dir, batch_size):
+    """Pazienti ed encoding. Restituisce (importati, già presenti, senza encoding)"""
+    if "pazienti" not in legacy_tables(legacy):
+        print("  Tabella pazienti assente nel database di server.py: nessun paziente")
+        return 0, 0, 0
+
+    existing = {row[0] for row in conn.execute("SELECT id FROM patients")}
+    rows = legacy.execute(
+        "SELECT id, nome, gruppo, allergie, path_foto FROM pazienti"
+    ).fetchall()
+
+    imported = skipped = missing = 0
+    now = datetime.now().isoformat()
+    cursor = conn.cursor()
+    for patient_id, nome, gruppo, allergie, path_foto in rows:
+        if patient_id in existing:
+            skipped += 1
+            continue
+        encoding = load_legacy_encoding(legacy_dir, patient_id)
+        if encoding is None:
+            print(f"  {patient_id}: encoding mancante o non valido, saltato")
+            missing += 1
+            continue
+
+        encoding_path = face_server.save_face_encoding(encoding, patient_id, tag="")
+        photo_path = copy_photo(legacy_dir, patient_id, path_foto)
+        cursor.execute(
+            """
+            INSERT INTO patients (id, name, blood_type, allergies, diseases,
+                                  medications, photo_path, face_encoding_path,
+                                  created_at, updated_at)
+            VALUES (?, ?, ?, ?, '[]', '[]', ?, ?, ?, ?)
+        """,
+            (
+                patient_id,
+                nome or "",
+                gruppo or "",
+                allergie or "",
+                photo_path,
+                encoding_path,
+                now,
+                now,
+            ),
+        )
+        face_server.record_gallery_change(cursor, patient_id, "add")
+        imported += 1
+        if imported % batch_size == 0:
+            conn.commit()
+            print(f"  {imported} pazienti importati")
+    conn.commit()
+    return imported, skipped, missing
+
+
+def migrate_log(conn, legacy, source, batch_size):
+    """Righe di log_accessi successive all'ultima migrata. Restituisce quante"""
+    if "log_accessi" not in legacy_tables(legacy):
+        return 0
+
+    key = f"legacy_log_migrated:{source}"
+    row = conn.execute(
+        "SELECT value FROM gallery_meta WHERE key = ?", (key,)
+    ).fetchone()
+    last_id = int(row[0]) if row else 0
+
+    migrated = 0
+    while True:
+        rows = legacy.execute(
+            """
+            SELECT id, timestamp, id_paziente, file_img FROM log_accessi
+            WHERE id > ? ORDER BY id LIMIT ?
+        """,
+            (last_id, batch_size),
+        ).fetchall()
+        if not rows:
+            return migrated
+
+        cursor = conn.cursor()
+        for _, timestamp, id_paziente, file_img in rows:
+            success = id_paziente not in LEGACY_UNMATCHED
+            face_server.insert_recognition_row(
+                cursor,
+                id_paziente if success else None,
+                local_time(timestamp),
+                None,
+                file_img,
+                1 if success else 0,
+            )
+        last_id = rows[-1][0]
+        # Il punto di ripresa avanza nella stessa transazione delle righe
+        cursor.execute(
+            "INSERT OR REPLACE INTO gallery_meta (key, value) VALUES (?, ?)",
+            (key, str(last_id)),
+        )
+        conn.commit()
+        migrated += len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrazione da server.py")
+    parser.add_argument(
+        "legacy_dir", help="Cartella di server.py (pazienti.db, encodings/, uploads/)"
+    )
+    parser.add_argument("--batch", type=int, default=1000, help="Righe per transazione")
+    args = parser.parse_args()
+
+    legacy_path = os.path.join(args.legacy_dir, LEGACY_DATABASE)
+    if not os.path.exists(legacy_path):
+        raise SystemExit(f"Database non trovato: {legacy_path}")
+
+    face_server.init_database()
+    active_tag, _ = face_server.read_active_encoding_version()
+    if active_tag:
+        # Gli encoding di server.py sono della versione originale
+        raise SystemExit(
+            f"È attiva la versione di encoding {active_tag}: la migrazione va "
+            f"fatta prima di attivare una nuova versione con reencode_gallery.py"
+        )
+
+    started_at = time.time()
+    legacy = sqlite3.connect(legacy_path)
+    conn = sqlite3.connect(face_server.DATABASE)
+
+    imported, skipped, missing = migrate_patients(
+        conn, legacy, args.legacy_dir, args.batch
+    )
+    log_rows = migrate_log(conn, legacy, os.path.abspath(legacy_path), args.batch)
+
+    legacy.close()
+    conn.close()
+    print(
+        f"Migrazione completata in {time.time() - started_at:.1f}s: "
+        f"{imported} pazienti importati, {skipped} già presenti, "
+        f"{missing} senza encoding, {log_rows} righe di log"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""Archivio delle foto dei pazienti indirizzato per contenuto.
+
+Ogni foto caricata è salvata una sola volta con il suo SHA-256 come nome
+(originals/ab/abcdef....jpg): due caricamenti identici occupano lo spazio di
+uno. Accanto all'originale si tiene un ritaglio normalizzato del volto
+(crops/), piccolo e compresso: lo usano l'interfaccia e la ricodifica della
+gallery, che quindi non rilegge mai gli originali. Gli originali possono
+passare al livello di archivio (archive/), ridimensionati e ricompressi
+(manage_photos.py).
+
+I file sono scritti prima delle righe nel database; le funzioni che toccano il
+database ricevono un cursore, così chi le chiama le include nella propria
+transazione.
+"""
+
+import hashlib
+import os
+import shutil
+import uuid
+
+from PIL import Image
+
+PHOTO_STORE_FOLDER = os.environ.get("FACE_PHOTO_STORE", "photo_store")
+CROP_SIZE = 320  # Lato massimo del ritaglio in pixel
+CROP_MARGIN = 0.5  # Margine attorno al volto, in frazioni del lato del volto
+CROP_QUALITY = 85
+ARCHIVE_MAX_DIMENSION = 1600
+ARCHIVE_QUALITY = 75
+
+TIER_ORIGINAL = "original"
+TIER_ARCHIVE = "archive"
+
+
+def init_tables(cursor):
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS photos (
+            hash TEXT PRIMARY KEY,
+            original_path TEXT NOT NULL,
+            original_bytes INTEGER,
+            crop_path TEXT NOT NULL,
+            crop_bytes INTEGER,
+            tier TEXT NOT NULL DEFAULT 'original',
+            created_at TEXT
+        )
+    """
+    )
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS patient_photos (
+            patient_id TEXT PRIMARY KEY,
+            photo_hash TEXT NOT NULL
+        )
+    """
+    )
+    cursor.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_patient_photos_hash
+        ON patient_photos (photo_hash)
+    """
+    )
+
+
+def content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as photo_file:
+        for block in iter(lambda: photo_file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def store_path(kind, photo_hash):
+    """Percorso di un file dell'archivio, con una sottocartella per i primi due caratteri"""
+    return os.path.join(PHOTO_STORE_FOLDER, kind, photo_hash[:2], f"{photo_hash}.jpg")
+
+
+def write_atomically(path, writer):
+    """Scrive tramite un file temporaneo: nell'archivio non ci sono mai file a metà"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        writer(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def face_crop(image, location):
+    """Ritaglio quadrato attorno al volto (top, right, bottom, left), al più CROP_SIZE"""
+    top, right, bottom, left = location
+    side = max(bottom - top, right - left) * (1 + 2 * CROP_MARGIN)
+    center_y, center_x = (top + bottom) / 2, (left + right) / 2
+    box = (
+        max(0, int(center_x - side / 2)),
+        max(0, int(center_y - side / 2)),
+        min(image.width, int(center_x + side / 2)),
+        min(image.height, int(center_y + side / 2)),
+    )
+    crop = image.crop(box)
+    crop.thumbnail((CROP_SIZE, CROP_SIZE))
+    return crop
+
+
+def store_photo(source_path, location, created_at):
+    """Salva originale e ritaglio di una foto (se non ci sono già).
+
+    `location` è la posizione del volto nelle coordinate dell'originale. Il
+    file sorgente non viene toccato. Restituisce la riga per record_photo.
+    """
+    photo_hash = content_hash(source_path)
+    original_path = store_path("originals", photo_hash)
+    crop_path = store_path("crops", photo_hash)
+
+    if os.path.exists(store_path("archive", photo_hash)):
+        # Stesso contenuto già passato al livello di archivio
+        original_path = store_path("archive", photo_hash)
+    elif not os.path.exists(original_path):
+        write_atomically(original_path, lambda path: shutil.copyfile(source_path, path))
+    if not os.path.exists(crop_path):
+        # Stesso orientamento dell'immagine usata per il rilevamento (niente EXIF)
+        with Image.open(source_path) as image:
+            crop = face_crop(image.convert("RGB"), location)
+        write_atomically(
+            crop_path,
+            lambda path: crop.save(
+                path, format="JPEG", quality=CROP_QUALITY, optimize=True
+            ),
+        )
+
+    return {
+        "hash": photo_hash,
+        "original_path": original_path,
+        "original_bytes": os.path.getsize(original_path),
+        "crop_path": crop_path,
+        "crop_bytes": os.path.getsize(crop_path),
+        "created_at": created_at,
+    }
+
+
+def record_photo(cursor, photo, patient_id):
+    """Registra la foto (una volta per contenuto) e la collega al paziente"""
+    cursor.execute(
+        """
+        INSERT OR IGNORE INTO photos
+        (hash, original_path, original_bytes, crop_path, crop_bytes, tier, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """,
+        (
+            photo["hash"],
+            photo["original_path"],
+            photo["original_bytes"],
+            photo["crop_path"],
+            photo["crop_bytes"],
+            TIER_ORIGINAL,
+            photo["created_at"],
+        ),
+    )
+    cursor.execute(
+        "INSERT OR REPLACE INTO patient_photos (patient_id, photo_hash) VALUES (?, ?)",
+        (patient_id, photo["hash"]),
+    )
+
+
+def release_patient(cursor, patient_id):
+    """Scollega la foto del paziente.
+
+    Restituisce i file da cancellare dopo il commit (vuoto se la foto serve
+    ancora ad altri pazienti), None se il paziente non ha foto in archivio.
+    """
+    cursor.execute(
+        "SELECT photo_hash FROM patient_photos WHERE patient_id = ?", (patient_id,)
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    photo_hash = row[0]
+    cursor.execute("DELETE FROM patient_photos WHERE patient_id = ?", (patient_id,))
+
+    cursor.execute(
+        "SELECT 1 FROM patient_photos WHERE photo_hash = ? LIMIT 1", (photo_hash,)
+    )
+    if cursor.fetchone() is not None:
+        return []
+    cursor.execute(
+        "SELECT original_path, crop_path FROM photos WHERE hash = ?", (photo_hash,)
+    )
+    paths = cursor.fetchone()
+    cursor.execute("DELETE FROM photos WHERE hash = ?", (photo_hash,))
+    return list(paths) if paths else []
+
+
+def archive_original(original_path, photo_hash):
+    """Ridimensiona e ricomprime un originale nel livello di archivio.
+
+    Restituisce (nuovo percorso, byte). L'originale va cancellato dal chiamante
+    dopo aver aggiornato il database.
+    """
+    archive_path = store_path("archive", photo_hash)
+    with Image.open(original_path) as image:
+        archived = image.convert("RGB")
+    archived.thumbnail((ARCHIVE_MAX_DIMENSION, ARCHIVE_MAX_DIMENSION))
+    write_atomically(
+        archive_path,
+        lambda path: archived.save(
+            path, format="JPEG", quality=ARCHIVE_QUALITY, optimize=True
+        ),
+    )
+    return archive_path, os.path.getsize(archive_path)
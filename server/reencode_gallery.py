@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""Ricalcola gli encoding di tutta la gallery con nuove impostazioni o un nuovo modello.
+
+I nuovi encoding sono calcolati da un pool di processi sui ritagli del volto
+dell'archivio foto (photo_store.py), non sugli originali. Per i pazienti non
+ancora migrati si usa la foto caricata. Vengono scritti in
+face_encodings/<tag>/, accanto a quelli in uso. Il progresso finisce in reencode_progress ogni
+--checkpoint pazienti, quindi rieseguendo con lo stesso tag si riprende da lì.
+Al termine la versione viene attivata in gallery_meta con un'unica
+transazione. I server in esecuzione passano alla nuova gallery entro
+ENCODING_VERSION_CHECK_SECONDS, e i gateway ricevono un "reset" seguito dai
+nuovi encoding. L'attivazione avviene solo se non ci sono errori, oppure con
+--allow-failures.
+
+    python reencode_gallery.py --tag cnn-large-j2 --detection-model cnn \\
+        --encoding-model large --jitters 2 --workers 8
+"""
+
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from multiprocessing import Pool
+
+import numpy as np
+
+import face_server
+
+
+def init_progress(conn):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS reencode_progress (
+            tag TEXT NOT NULL,
+            patient_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            error TEXT,
+            updated_at TEXT,
+            PRIMARY KEY (tag, patient_id)
+        )
+    """
+    )
+    conn.commit()
+
+
+def register_version(conn, tag, settings):
+    """Salva le impostazioni del tag (le stesse a ogni ripresa del job)"""
+    key = f"encoding_settings:{tag}"
+    row = conn.execute(
+        "SELECT value FROM gallery_meta WHERE key = ?", (key,)
+    ).fetchone()
+    if row and json.loads(row[0]) != settings:
+        raise SystemExit(f"Il tag {tag} esiste già con impostazioni diverse")
+    conn.execute(
+        "INSERT OR REPLACE INTO gallery_meta (key, value) VALUES (?, ?)",
+        (key, json.dumps(settings)),
+    )
+    conn.commit()
+
+
+def reencode_one(task):
+    """Eseguito nei processi del pool: nuovo encoding dalla foto del paziente"""
+    patient_id, photo_path, tag, settings = task
+    if not photo_path or not os.path.exists(photo_path):
+        return patient_id, f"Foto non trovata: {photo_path}"
+
+    face_encoding, error = face_server.load_and_process_image(
+        photo_path, settings=settings
+    )
+    if error:
+        return patient_id, error
+
+    # Scrittura atomica: un encoding a metà non finisce mai nella cartella
+    path = os.path.join(face_server.encodings_folder(tag), f"{patient_id}.npy")
+    temp_path = f"{path}.tmp.npy"
+    np.save(temp_path, face_encoding)
+    os.replace(temp_path, path)
+    return patient_id, None
+
+
+def save_progress(conn, tag, rows):
+    conn.executemany(
+        """
+        INSERT OR REPLACE INTO reencode_progress
+        (tag, patient_id, status, error, updated_at) VALUES (?, ?, ?, ?, ?)
+    """,
+        [
+            (tag, patient_id, "failed" if error else "done", error, updated_at)
+            for patient_id, error, updated_at in rows
+        ],
+    )
+    conn.commit()
+
+
+def run_pass(conn, pool, tag, settings, checkpoint, attempted):
+    """Un passaggio sui pazienti non ancora ricodificati. Restituisce quanti ne ha visti"""
+    pending = [
+        (patient_id, photo_path)
+        for patient_id, photo_path in conn.execute(
+            """
+            SELECT id, photo_path FROM patients
+            WHERE id NOT IN (
+                SELECT patient_id FROM reencode_progress
+                WHERE tag = ? AND status = 'done'
+            )
+        """,
+            (tag,),
+        )
+        if patient_id not in attempted
+    ]
+    if not pending:
+        return 0
+
+    attempted.update(patient_id for patient_id, _ in pending)
+    tasks = [(patient_id, photo, tag, settings) for patient_id, photo in pending]
+    started_at = time.time()
+    rows, processed = [], 0
+    for patient_id, error in pool.imap_unordered(reencode_one, tasks, chunksize=8):
+        rows.append((patient_id, error, datetime.now().isoformat()))
+        processed += 1
+        if len(rows) >= checkpoint:
+            save_progress(conn, tag, rows)
+            rows = []
+            print(
+                f"  {processed}/{len(tasks)} "
+                f"({processed / (time.time() - started_at):.1f} encoding/s)"
+            )
+    save_progress(conn, tag, rows)
+    return len(pending)
+
+
+def activate_version(conn, tag):
+    """Attiva il tag e accoda reset + nuovi encoding per i gateway, in una transazione"""
+    folder = face_server.encodings_folder(tag)
+    done = [
+        row[0]
+        for row in conn.execute(
+            "SELECT patient_id FROM reencode_progress WHERE tag = ? AND status = 'done'",
+            (tag,),
+        )
+    ]
+    now = datetime.now().isoformat()
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT OR REPLACE INTO gallery_meta (key, value) VALUES ('active_encoding_version', ?)",
+        (tag,),
+    )
+    cursor.executemany(
+        "UPDATE patients SET face_encoding_path = ? WHERE id = ?",
+        [
+            (os.path.join(folder, f"{patient_id}.npy"), patient_id)
+            for patient_id in done
+        ],
+    )
+    face_server.record_gallery_change(cursor, "*", "reset")
+    cursor.executemany(
+        "INSERT INTO gallery_changes (patient_id, op, changed_at) VALUES (?, 'add', ?)",
+        [(patient_id, now) for patient_id in done],
+    )
+    conn.commit()
+    return len(done)
+
+
+def catch_up_after_switch(conn, pool, tag, settings, checkpoint, attempted):
+    """Pazienti registrati durante il passaggio, ancora con il modello precedente"""
+    time.sleep(face_server.ENCODING_VERSION_CHECK_SECONDS + 1)
+    before = set(attempted)
+    if not run_pass(conn, pool, tag, settings, checkpoint, attempted):
+        return 0
+
+    folder = face_server.encodings_folder(tag)
+    late = [
+        row[0]
+        for row in conn.execute(
+            "SELECT patient_id FROM reencode_progress WHERE tag = ? AND status = 'done'",
+            (tag,),
+        )
+        if row[0] not in before
+    ]
+    cursor = conn.cursor()
+    for patient_id in late:
+        cursor.execute(
+            "UPDATE patients SET face_encoding_path = ? WHERE id = ?",
+            (os.path.join(folder, f"{patient_id}.npy"), patient_id),
+        )
+        face_server.record_gallery_change(cursor, patient_id, "add")
+    conn.commit()
+    return len(late)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ricodifica della gallery")
+    parser.add_argument("--tag", required=True, help="Nome della nuova versione")
+    parser.add_argument("--detection-model", choices=("hog", "cnn"), default="hog")
+    parser.add_argument("--upsample", type=int, default=1)
+    parser.add_argument("--encoding-model", choices=("small", "large"), default="small")
+    parser.add_argument("--jitters", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--checkpoint", type=int, default=200, help="Pazienti tra due checkpoint"
+    )
+    parser.add_argument(
+        "--no-switch", action="store_true", help="Non attivare la nuova versione"
+    )
+    parser.add_argument(
+        "--allow-failures",
+        action="store_true",
+        help="Attiva anche se alcuni pazienti non sono stati ricodificati",
+    )
+    args = parser.parse_args()
+
+    if not re.fullmatch(r"[A-Za-z0-9._-]+", args.tag):
+        parser.error("Il tag può contenere solo lettere, cifre, '.', '_' e '-'")
+    settings = {
+        "detection_model": args.detection_model,
+        "upsample": args.upsample,
+        "encoding_model": args.encoding_model,
+        "jitters": args.jitters,
+    }
+
+    face_server.init_database()
+    active_tag, _ = face_server.read_active_encoding_version()
+    if args.tag == active_tag:
+        raise SystemExit(f"La versione {args.tag} è già attiva")
+
+    conn = sqlite3.connect(face_server.DATABASE)
+    init_progress(conn)
+    register_version(conn, args.tag, settings)
+    os.makedirs(face_server.encodings_folder(args.tag), exist_ok=True)
+
+    started_at = time.time()
+    attempted = set()
+    with Pool(args.workers) as pool:
+        # Si ripete finché ci sono pazienti registrati durante il job
+        while run_pass(conn, pool, args.tag, settings, args.checkpoint, attempted):
+            pass
+
+        failures = conn.execute(
+            """
+            SELECT patient_id, error FROM reencode_progress
+            WHERE tag = ? AND status = 'failed'
+        """,
+            (args.tag,),
+        ).fetchall()
+        print(
+            f"Ricodifica {args.tag} in {time.time() - started_at:.1f}s: "
+            f"{len(attempted) - len(failures)} nuovi encoding, {len(failures)} errori"
+        )
+        for patient_id, error in failures[:20]:
+            print(f"  {patient_id}: {error}")
+
+        if args.no_switch:
+            print("Versione non attivata (--no-switch).")
+            return
+        if failures and not args.allow_failures:
+            print(
+                "Versione non attivata: i pazienti non ricodificati sparirebbero "
+                "dalla gallery. Correggere le foto e rieseguire, o usare --allow-failures."
+            )
+            sys.exit(1)
+
+        activated = activate_version(conn, args.tag)
+        print(f"Versione {args.tag} attiva con {activated} pazienti.")
+
+        late = catch_up_after_switch(
+            conn, pool, args.tag, settings, args.checkpoint, attempted
+        )
+        if late:
+            print(
+                f"{late} pazienti registrati durante il passaggio ricodificati "
+                f"e inviati ai server in esecuzione."
+            )
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
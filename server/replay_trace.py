@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""Replay di un trace registrato da face_server.py contro un server di test.
+
+Il trace si ottiene avviando il server con FACE_TRACE_ENABLED=1 (e
+FACE_TRACE_PHOTOS=1 per salvare anche le foto). Esempio:
+
+    python replay_trace.py face_traces/trace_20261019_080000.jsonl \\
+        --target http://localhost:5001 --speed 5 --report report.json
+"""
+
+import argparse
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Valori sintetici per i campi del form (il trace contiene solo i nomi)
+SYNTHETIC_FORM_VALUES = {
+    "nome": "Replay",
+    "surname": "Trace",
+    "age": "40",
+    "weight": "70",
+    "height": "170",
+    "gruppo": "0+",
+    "allergie": "",
+    "diseases[]": "Nessuna",
+    "medications[]": "Nessuno",
+    # Le stesse foto vengono riusate: il controllo dei duplicati le fermerebbe
+    "allow_duplicate": "1",
+}
+
+
+def load_trace(trace_path):
+    """Carica le voci del trace ordinate per istante di arrivo"""
+    with open(trace_path) as trace_file:
+        entries = [json.loads(line) for line in trace_file if line.strip()]
+    entries.sort(key=lambda entry: entry["offset"])
+    return entries
+
+
+def percentile(values, pct):
+    """Percentile (nearest-rank) di una lista di valori"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, math.ceil(pct / 100.0 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+class TraceReplayer:
+    """Riesegue le richieste del trace rispettando i tempi di arrivo scalati"""
+
+    def __init__(self, entries, trace_dir, target, speed, fallback_photo=None):
+        self.entries = entries
+        self.trace_dir = trace_dir
+        self.target = target.rstrip("/")
+        self.speed = speed
+        self.fallback_photo = fallback_photo
+        self.results = []
+        self.lock = threading.Lock()
+        # Ultimo ID riconosciuto durante il replay, riusato per /dati
+        self.last_patient_id = None
+
+    def build_photo(self, entry, size):
+        """Foto da inviare: quella del trace, quella di fallback o byte sintetici"""
+        candidates = []
+        if entry.get("photo"):
+            candidates.append(os.path.join(self.trace_dir, entry["photo"]))
+        if self.fallback_photo:
+            candidates.append(self.fallback_photo)
+
+        for path in candidates:
+            if os.path.exists(path):
+                with open(path, "rb") as photo_file:
+                    return photo_file.read()
+
+        # Nessuna foto disponibile: si riproduce almeno la dimensione del payload
+        return os.urandom(size)
+
+    def build_request(self, entry):
+        patient_id = self.last_patient_id or uuid.uuid4().hex
+        path = entry["endpoint"].replace("<patient_id>", patient_id)
+
+        data = []
+        for field, count in entry.get("form_fields", {}).items():
+            if field == "id":
+                value = patient_id
+            else:
+                value = SYNTHETIC_FORM_VALUES.get(field, "replay")
+            data.extend((field, value) for _ in range(count))
+
+        files = {}
+        for field, size in entry.get("files", {}).items():
+            files[field] = (
+                f"{field}.jpg",
+                self.build_photo(entry, size),
+                "image/jpeg",
+            )
+
+        return path, data, files, entry.get("headers", {})
+
+    def send(self, entry, scheduled_at):
+        path, data, files, headers = self.build_request(entry)
+        sent_at = time.monotonic()
+        status = None
+        error = None
+
+        try:
+            response = requests.request(
+                entry["method"],
+                f"{self.target}{path}",
+                data=data or None,
+                files=files or None,
+                headers=headers,
+                timeout=60,
+            )
+            status = response.status_code
+            if entry["endpoint"] == "/recognize" and status == 200:
+                patient_id = response.json().get("id")
+                if patient_id:
+                    self.last_patient_id = patient_id
+        except Exception as e:
+            error = str(e)
+
+        finished_at = time.monotonic()
+        with self.lock:
+            self.results.append(
+                {
+                    "endpoint": entry["endpoint"],
+                    "status": status,
+                    "error": error,
+                    "latency_ms": (finished_at - sent_at) * 1000,
+                    "dispatch_lag_ms": (sent_at - scheduled_at) * 1000,
+                    "original_ms": entry.get("duration_ms"),
+                }
+            )
+
+    def run(self, workers):
+        started_at = time.monotonic()
+        first_offset = self.entries[0]["offset"] if self.entries else 0.0
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for entry in self.entries:
+                scheduled_at = (
+                    started_at + (entry["offset"] - first_offset) / self.speed
+                )
+                delay = scheduled_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self.send, entry, scheduled_at)
+
+        return time.monotonic() - started_at
+
+    def report(self, elapsed):
+        """Report di latenza per endpoint"""
+        by_endpoint = defaultdict(list)
+        for result in self.results:
+            by_endpoint[result["endpoint"]].append(result)
+
+        endpoints = {}
+        for endpoint, results in sorted(by_endpoint.items()):
+            latencies = [r["latency_ms"] for r in results if r["error"] is None]
+            originals = [r["original_ms"] for r in results if r["original_ms"]]
+            statuses = defaultdict(int)
+            for r in results:
+                statuses[str(r["status"]) if r["error"] is None else "error"] += 1
+
+            endpoints[endpoint] = {
+                "requests": len(results),
+                "statuses": dict(statuses),
+                "p50_ms": round(percentile(latencies, 50), 1),
+                "p95_ms": round(percentile(latencies, 95), 1),
+                "p99_ms": round(percentile(latencies, 99), 1),
+                "max_ms": round(max(latencies, default=0.0), 1),
+                "original_p95_ms": round(percentile(originals, 95), 1),
+                "max_dispatch_lag_ms": round(
+                    max(r["dispatch_lag_ms"] for r in results), 1
+                ),
+            }
+
+        return {
+            "target": self.target,
+            "speed": self.speed,
+            "requests": len(self.results),
+            "elapsed_seconds": round(elapsed, 2),
+            "throughput_rps": round(len(self.results) / elapsed, 2) if elapsed else 0,
+            "errors": sum(1 for r in self.results if r["error"] is not None),
+            "endpoints": endpoints,
+        }
+
+
+def print_report(report):
+    print(
+        f"Replay a {report['speed']}x su {report['target']}: "
+        f"{report['requests']} richieste in {report['elapsed_seconds']}s "
+        f"({report['throughput_rps']} req/s, {report['errors']} errori)"
+    )
+    print(
+        f"{'endpoint':<32}{'n':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}"
+        f"{'orig p95':>10}  stati"
+    )
+    for endpoint, stats in report["endpoints"].items():
+        print(
+            f"{endpoint:<32}{stats['requests']:>6}{stats['p50_ms']:>9}"
+            f"{stats['p95_ms']:>9}{stats['p99_ms']:>9}{stats['max_ms']:>9}"
+            f"{stats['original_p95_ms']:>10}  {stats['statuses']}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay di un trace di richieste")
+    parser.add_argument("trace", help="File .jsonl prodotto da face_server.py")
+    parser.add_argument(
+        "--target", default="http://localhost:5000", help="URL del server di test"
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Fattore di accelerazione (es. 1, 5, 10)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=64, help="Richieste concorrenti massime"
+    )
+    parser.add_argument(
+        "--photo", help="Foto da usare quando il trace non contiene le immagini"
+    )
+    parser.add_argument("--report", help="Salva il report di latenza in JSON")
+    args = parser.parse_args()
+
+    if args.speed <= 0:
+        parser.error("--speed deve essere positivo")
+
+    entries = load_trace(args.trace)
+    if not entries:
+        print("Trace vuoto, niente da rieseguire.")
+        return
+
+    replayer = TraceReplayer(
+        entries,
+        os.path.dirname(os.path.abspath(args.trace)),
+        args.target,
+        args.speed,
+        fallback_photo=args.photo,
+    )
+    elapsed = replayer.run(args.workers)
+    report = replayer.report(elapsed)
+    print_report(report)
+
+    if args.report:
+        with open(args.report, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+        print(f"Report salvato in {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,14 @@
 import os
 import uuid
 import sqlite3
+import threading
 from datetime import datetime, timedelta
 from flask import Flask, request, jsonify
 import face_recognition
 import numpy as np
 
+import face_engine
+
 app = Flask(__name__)
 
 UPLOAD_FOLDER = "uploads"
@@ -17,10 +20,11 @@ DB = "pazienti.db"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(ENCODING_FOLDER, exist_ok=True)
 
-# --- Funzioni di supporto ---
+# --- Database ---
 
 
-def salva_db(id_paziente, nome, gruppo, allergie, path_foto):
+def init_db():
+    """Crea lo schema una volta all'avvio (non più a ogni richiesta)"""
     conn = sqlite3.connect(DB)
     c = conn.cursor()
     c.execute(
@@ -32,6 +36,50 @@ def salva_db(id_paziente, nome, gruppo, allergie, path_foto):
                     path_foto TEXT
                 )"""
     )
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS log_accessi (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp TEXT,
+                    id_paziente TEXT,
+                    file_img TEXT
+                )"""
+    )
+    c.execute(
+        """CREATE INDEX IF NOT EXISTS idx_log_accessi_paziente
+                    ON log_accessi (id_paziente, timestamp)"""
+    )
+    # Ultimo accesso per paziente, aggiornato insieme al log: /dati legge una riga
+    c.execute(
+        """CREATE TABLE IF NOT EXISTS ultimo_accesso (
+                    id_paziente TEXT PRIMARY KEY,
+                    timestamp TEXT
+                )"""
+    )
+    c.execute("SELECT 1 FROM ultimo_accesso LIMIT 1")
+    if c.fetchone() is None:
+        # Database creato prima di questa tabella: si ricostruisce dal log
+        c.execute(
+            """INSERT INTO ultimo_accesso (id_paziente, timestamp)
+                    SELECT id_paziente, MAX(timestamp) FROM log_accessi
+                    WHERE id_paziente IS NOT NULL
+                    GROUP BY id_paziente"""
+        )
+    conn.commit()
+    conn.close()
+
+
+init_db()
+
+# Encoding di tutti i pazienti in memoria, letti una volta all'avvio
+galleria = face_engine.load_folder(ENCODING_FOLDER)
+galleria_lock = threading.Lock()
+
+# --- Funzioni di supporto ---
+
+
+def salva_db(id_paziente, nome, gruppo, allergie, path_foto):
+    conn = sqlite3.connect(DB)
+    c = conn.cursor()
     c.execute(
         "INSERT INTO pazienti (id, nome, gruppo, allergie, path_foto) VALUES (?, ?, ?, ?, ?)",
         (id_paziente, nome, gruppo, allergie, path_foto),
@@ -43,29 +91,25 @@ def salva_db(id_paziente, nome, gruppo, allergie, path_foto):
 def log_accesso(id_paziente, file_img):
     conn = sqlite3.connect(DB)
     c = conn.cursor()
-    c.execute(
-        """CREATE TABLE IF NOT EXISTS log_accessi (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp TEXT,
-                    id_paziente TEXT,
-                    file_img TEXT
-                )"""
-    )
     timestamp = datetime.utcnow().isoformat()
     c.execute(
         "INSERT INTO log_accessi (timestamp, id_paziente, file_img) VALUES (?, ?, ?)",
         (timestamp, id_paziente, file_img),
     )
+    c.execute(
+        "INSERT OR REPLACE INTO ultimo_accesso (id_paziente, timestamp) VALUES (?, ?)",
+        (id_paziente, timestamp),
+    )
     conn.commit()
     conn.close()
 
 
 def trova_match(nuova_encoding, soglia=0.6):
-    for filename in os.listdir(ENCODING_FOLDER):
-        known_encoding = np.load(os.path.join(ENCODING_FOLDER, filename))
-        distance = face_recognition.face_distance([known_encoding], nuova_encoding)[0]
-        if distance < soglia:
-            return filename.replace(".npy", "")  # ritorna id paziente
+    """ID del paziente più vicino sotto soglia (None se nessuno)"""
+    with galleria_lock:
+        id_paziente, distance = galleria.nearest(nuova_encoding)
+    if distance < soglia:
+        return id_paziente
     return None
 
 
@@ -74,7 +118,7 @@ def ultimo_accesso_valido(id_paziente, window_seconds=60):
     conn = sqlite3.connect(DB)
     c = conn.cursor()
     c.execute(
-        "SELECT timestamp FROM log_accessi WHERE id_paziente = ? ORDER BY timestamp DESC LIMIT 1",
+        "SELECT timestamp FROM ultimo_accesso WHERE id_paziente = ?",
         (id_paziente,),
     )
     row = c.fetchone()
@@ -117,6 +161,8 @@ def register():
     encoding = encodings[0]
     np.save(os.path.join(ENCODING_FOLDER, f"{id_paziente}.npy"), encoding)
     salva_db(id_paziente, nome, gruppo, allergie, path_foto)
+    with galleria_lock:
+        galleria.add(id_paziente, encoding)
 
     return jsonify({"success": f"Paziente registrato", "id": id_paziente}), 200
 
@@ -0,0 +1,103 @@
+"""Fixture comuni dei test del server.
+
+face_server usa percorsi relativi (database, cartelle degli encoding e delle
+foto) e li crea all'import: i test girano in una cartella temporanea, mai
+dentro il repository. dlib non viene usato: gli encoding sono vettori
+costruiti dai test.
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+os.chdir(tempfile.mkdtemp(prefix="face_server_tests_"))
+
+import face_server  # noqa: E402
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """face_server con database nuovo in tmp_path e stato in memoria vuoto"""
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(face_server.UPLOAD_FOLDER)
+    os.makedirs(face_server.ENCODINGS_FOLDER)
+    face_server.init_database()
+    monkeypatch.setattr(face_server, "gallery", face_server.GalleryIndex())
+    monkeypatch.setattr(
+        face_server,
+        "result_cache",
+        face_server.RecognitionCache(
+            face_server.RESULT_CACHE_TTL_SECONDS,
+            face_server.RESULT_CACHE_MAX_ENTRIES,
+        ),
+    )
+    face_server.hot_set.clear()
+    # Avvio già fatto qui sopra: le richieste di test non lo rilanciano in background
+    monkeypatch.setattr(face_server.startup, "thread", threading.current_thread())
+    monkeypatch.setattr(face_server.startup, "ready_at", time.time())
+    return face_server
+
+
+def random_encoding(seed):
+    """Encoding fittizio, deterministico per seed"""
+    rng = np.random.default_rng(seed)
+    return rng.normal(0, 0.1, face_server.ENCODING_DIMENSIONS)
+
+
+@pytest.fixture
+def add_patient(server):
+    """Registra un paziente con encoding già calcolato (nessuna foto)"""
+
+    def add(patient_id, encoding, partitions=(), tag=None, photo_path=None):
+        encoding_path = server.save_face_encoding(encoding, patient_id, tag=tag)
+        now = datetime.now().isoformat()
+        server.save_patient(
+            (
+                patient_id,
+                f"Nome {patient_id}",
+                "Cognome",
+                50,
+                70.0,
+                170.0,
+                "A+",
+                "",
+                "[]",
+                "[]",
+                photo_path,
+                encoding_path,
+                now,
+                now,
+            ),
+            partitions,
+        )
+
+    return add
+
+
+class InlinePool:
+    """Sostituto di multiprocessing.Pool che esegue i task nel processo del test"""
+
+    def __init__(self, processes=None):
+        self.processes = processes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def imap_unordered(self, function, tasks, chunksize=1):
+        return map(function, tasks)
+
+
+@pytest.fixture
+def inline_pool():
+    return InlinePool
@@ -0,0 +1,134 @@
+"""Coda di ammissione all'encoding: priorità, invecchiamento e limiti"""
+
+import io
+import threading
+import time
+
+import pytest
+
+
+def queued(server, controller, priority, waited_seconds=0.0):
+    """Ticket già in coda da `waited_seconds`"""
+    ticket = server.AdmissionTicket(priority)
+    ticket.enqueued_at -= waited_seconds
+    controller.waiters.append(ticket)
+    return ticket
+
+
+@pytest.fixture
+def busy(server):
+    """Controller con l'unico slot occupato"""
+    controller = server.AdmissionController(concurrency=1, max_waiting=10)
+    assert controller.acquire("routine") == (True, 0)
+    return controller
+
+
+def test_free_slot_goes_to_the_highest_class(server, busy):
+    bulk = queued(server, busy, "bulk", 0.5)
+    routine = queued(server, busy, "routine", 0.5)
+    emergency = queued(server, busy, "emergency")
+
+    busy.release(0.1)
+
+    assert emergency.granted
+    assert not routine.granted and not bulk.granted
+    assert busy.waiters == [bulk, routine]
+
+
+def test_same_class_is_first_come_first_served(server, busy):
+    later = queued(server, busy, "routine", 0.1)
+    earlier = queued(server, busy, "routine", 0.2)
+
+    busy.release(0.1)
+
+    assert earlier.granted and not later.granted
+
+
+def test_aged_bulk_request_overtakes_a_fresh_routine_one(server, busy):
+    aging = server.PRIORITY_AGING_SECONDS
+    bulk = queued(server, busy, "bulk", 1.5 * aging)
+    routine = queued(server, busy, "routine")
+
+    busy.release(0.1)
+
+    assert bulk.granted and not routine.granted
+
+
+def test_effective_rank_gains_one_class_per_aging_period(server):
+    ticket = server.AdmissionTicket("bulk")
+    now = ticket.enqueued_at + 2 * server.PRIORITY_AGING_SECONDS
+
+    assert ticket.effective_rank(ticket.enqueued_at) == 2
+    assert ticket.effective_rank(now) == pytest.approx(0)
+
+
+def test_emergency_requests_have_reserved_queue_slots(server):
+    controller = server.AdmissionController(concurrency=1, max_waiting=1)
+    controller.acquire("routine")
+    queued(server, controller, "routine")
+
+    assert controller.acquire("routine") == (False, 1)
+    assert controller.acquire("bulk") == (False, 1)
+    assert controller.queue_limit("emergency") == 1 + server.EMERGENCY_RESERVED_SLOTS
+    assert controller.metrics()["classes"]["routine"]["rejected"] == 1
+
+
+def test_waiting_thread_is_admitted_on_release(server, busy):
+    results = []
+    waiter = threading.Thread(target=lambda: results.append(busy.acquire("bulk")))
+    waiter.start()
+    while not busy.waiters:
+        time.sleep(0.01)
+
+    busy.release(0.1)
+    waiter.join(timeout=2)
+
+    assert results == [(True, 1)]
+    assert busy.metrics()["active"] == 1
+
+
+def test_wait_ends_at_the_request_deadline(server, busy):
+    started_at = time.time()
+
+    with pytest.raises(server.DeadlineExceeded) as error:
+        busy.acquire("routine", deadline=started_at + 0.2)
+
+    assert error.value.stage == "decode"
+    assert 0.2 <= time.time() - started_at < 1.0
+    # Il posto in coda torna libero per gli altri
+    assert busy.waiters == []
+    assert busy.metrics()["classes"]["routine"]["expired"] == 1
+
+
+def test_expired_deadline_is_rejected_without_queueing(server):
+    controller = server.AdmissionController(concurrency=1, max_waiting=10)
+
+    with pytest.raises(server.DeadlineExceeded):
+        controller.acquire("routine", deadline=time.time() - 1)
+
+    assert controller.metrics()["active"] == 0
+
+
+def test_slot_granted_before_the_deadline_is_kept(server, busy):
+    threading.Timer(0.1, busy.release, (0.1,)).start()
+
+    assert busy.acquire("routine", deadline=time.time() + 2) == (True, 1)
+    assert busy.metrics()["expired"] == 0
+
+
+def test_recognize_returns_504_when_the_queue_outlasts_the_deadline(
+    server, monkeypatch
+):
+    controller = server.AdmissionController(concurrency=1, max_waiting=10)
+    controller.acquire("routine")
+    monkeypatch.setattr(server, "admission", controller)
+
+    response = server.app.test_client().post(
+        "/recognize",
+        data={"foto": (io.BytesIO(b"foto"), "foto.jpg")},
+        headers={"X-Request-Deadline-Ms": "100"},
+        content_type="multipart/form-data",
+    )
+
+    assert response.status_code == 504
+    assert response.get_json()["aborted_before"] == "decode"
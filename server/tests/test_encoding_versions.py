@@ -0,0 +1,272 @@
+"""Versioni degli encoding: ricodifica con checkpoint, attivazione e import"""
+
+import csv
+import io
+import os
+import sqlite3
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import import_patients
+import reencode_gallery
+from conftest import random_encoding
+
+V2_SETTINGS = {
+    "detection_model": "hog",
+    "upsample": 1,
+    "encoding_model": "large",
+    "jitters": 2,
+}
+
+
+def encoding_for(path):
+    """Encoding fittizio ricavato dal nome della foto (stesso file, stesso encoding)"""
+    return random_encoding(sum(os.path.basename(path).encode()))
+
+
+class FakeEncoder:
+    """Sostituisce dlib e annota le impostazioni con cui è stato chiamato"""
+
+    def __init__(self):
+        self.calls = []
+        self.fail_at = None
+
+    def load_and_process_image(
+        self, image_path, max_dimension=None, deadline=None, settings=None
+    ):
+        self.calls.append((image_path, settings))
+        if len(self.calls) == self.fail_at:
+            raise RuntimeError("processo interrotto")
+        return encoding_for(image_path), None
+
+    def load_face_with_location(
+        self, image_path, max_dimension=None, deadline=None, settings=None
+    ):
+        face_encoding, error = self.load_and_process_image(
+            image_path, settings=settings
+        )
+        return face_encoding, (10, 50, 50, 10), error
+
+
+@pytest.fixture
+def encoder(server, monkeypatch):
+    fake = FakeEncoder()
+    monkeypatch.setattr(server, "load_and_process_image", fake.load_and_process_image)
+    monkeypatch.setattr(server, "load_face_with_location", fake.load_face_with_location)
+    return fake
+
+
+@pytest.fixture
+def gallery_with_photos(server, add_patient):
+    os.makedirs("foto")
+    for index in range(5):
+        photo_path = os.path.join("foto", f"p{index}.jpg")
+        open(photo_path, "wb").close()
+        add_patient(f"p{index}", random_encoding(index), photo_path=photo_path)
+    return [f"p{index}" for index in range(5)]
+
+
+@pytest.fixture
+def reencode_conn(server):
+    conn = sqlite3.connect(server.DATABASE)
+    reencode_gallery.init_progress(conn)
+    reencode_gallery.register_version(conn, "v2", V2_SETTINGS)
+    os.makedirs(server.encodings_folder("v2"))
+    yield conn
+    conn.close()
+
+
+def progress(conn, status):
+    return {
+        row[0]
+        for row in conn.execute(
+            "SELECT patient_id FROM reencode_progress WHERE tag = 'v2' AND status = ?",
+            (status,),
+        )
+    }
+
+
+def test_interrupted_pass_resumes_from_the_checkpoint(
+    server, gallery_with_photos, reencode_conn, encoder, inline_pool
+):
+    encoder.fail_at = 4
+    with pytest.raises(RuntimeError):
+        reencode_gallery.run_pass(
+            reencode_conn, inline_pool(), "v2", V2_SETTINGS, 2, set()
+        )
+    saved = progress(reencode_conn, "done")
+    assert len(saved) == 2
+
+    encoder.fail_at = None
+    encoder.calls.clear()
+    pending = reencode_gallery.run_pass(
+        reencode_conn, inline_pool(), "v2", V2_SETTINGS, 2, set()
+    )
+
+    # Ripresa: solo i pazienti dopo l'ultimo checkpoint, con le nuove impostazioni
+    assert pending == 3
+    assert progress(reencode_conn, "done") == set(gallery_with_photos)
+    assert all(settings == V2_SETTINGS for _, settings in encoder.calls)
+    resumed = {os.path.basename(path)[:-4] for path, _ in encoder.calls}
+    assert resumed.isdisjoint(saved)
+
+
+def test_missing_photo_is_recorded_as_failed(
+    server, gallery_with_photos, reencode_conn, encoder, inline_pool
+):
+    os.remove(os.path.join("foto", "p3.jpg"))
+
+    reencode_gallery.run_pass(reencode_conn, inline_pool(), "v2", V2_SETTINGS, 2, set())
+
+    assert progress(reencode_conn, "failed") == {"p3"}
+    assert len(progress(reencode_conn, "done")) == 4
+
+
+def test_settings_of_an_existing_tag_cannot_change(server, reencode_conn):
+    with pytest.raises(SystemExit):
+        reencode_gallery.register_version(
+            reencode_conn, "v2", dict(V2_SETTINGS, jitters=1)
+        )
+
+
+def test_activation_switches_the_gallery_to_the_new_encodings(
+    server, gallery_with_photos, reencode_conn, encoder, inline_pool
+):
+    gallery = server.gallery
+    gallery.load()
+    reencode_gallery.run_pass(reencode_conn, inline_pool(), "v2", V2_SETTINGS, 2, set())
+    assert gallery.encoding_tag == ""
+
+    assert reencode_gallery.activate_version(reencode_conn, "v2") == 5
+
+    assert server.read_active_encoding_version() == ("v2", V2_SETTINGS)
+    changes, _, _, _ = server.gallery_changes_since(gallery.applied_seq, 10)
+    assert changes[0][:2] == ("*", "reset")
+    assert sorted(patient_id for patient_id, _, _ in changes[1:]) == (
+        gallery_with_photos
+    )
+
+    gallery.check_encoding_version()
+    assert gallery.encoding_tag == "v2"
+    assert gallery.encoding_settings == V2_SETTINGS
+    for patient_id in gallery_with_photos:
+        photo_path = os.path.join("foto", f"{patient_id}.jpg")
+        assert np.array_equal(gallery.encoding_of(patient_id), encoding_for(photo_path))
+
+
+def test_import_while_a_version_is_active_reaches_the_gallery(
+    server, encoder, inline_pool, monkeypatch
+):
+    conn = sqlite3.connect(server.DATABASE)
+    conn.execute(
+        "INSERT INTO gallery_meta (key, value) VALUES ('active_encoding_version', 'v2')"
+    )
+    conn.commit()
+    reencode_gallery.register_version(conn, "v2", V2_SETTINGS)
+    conn.close()
+    # Gallery del server in esecuzione; quella del modulo resta vuota come nel
+    # processo della CLI, che non la carica
+    running = server.GalleryIndex()
+    running.load()
+    assert running.encoding_tag == "v2"
+
+    os.makedirs("foto")
+    with open("pazienti.csv", "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["foto", "nome", "partitions"])
+        for index in range(3):
+            Image.new("RGB", (64, 64), (index * 80, 40, 40)).save(
+                os.path.join("foto", f"{index}.jpg")
+            )
+            writer.writerow([f"{index}.jpg", f"Paziente {index}", "reparto"])
+    monkeypatch.setattr(import_patients, "Pool", inline_pool)
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["import_patients.py", "pazienti.csv", "foto", "--failures", "errori.csv"],
+    )
+
+    import_patients.main()
+
+    # Encoding con il modello e nella cartella della versione attiva
+    assert [settings for _, settings in encoder.calls] == [V2_SETTINGS] * 3
+    assert len(os.listdir(server.encodings_folder("v2"))) == 3
+    assert not any(name.endswith(".npy") for name in os.listdir("face_encodings"))
+
+    running.sync_changes()
+    assert len(running.ids) == 3
+    assert len(running.partitions["reparto"]) == 3
+
+
+def activate(server, tag, settings):
+    """Attivazione di una versione da parte di un altro processo (reencode_gallery)"""
+    os.makedirs(server.encodings_folder(tag), exist_ok=True)
+    conn = sqlite3.connect(server.DATABASE)
+    reencode_gallery.register_version(conn, tag, settings)
+    conn.execute(
+        "INSERT OR REPLACE INTO gallery_meta (key, value) "
+        "VALUES ('active_encoding_version', ?)",
+        (tag,),
+    )
+    conn.commit()
+    conn.close()
+
+
+def register(server, name, seed):
+    photo = io.BytesIO()
+    Image.new("RGB", (64, 64), (seed * 40, 90, 90)).save(photo, "JPEG")
+    photo.seek(0)
+    response = server.app.test_client().post(
+        "/register",
+        data={"nome": name, "sync": "1", "foto": (photo, "foto.jpg")},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()["id"]
+
+
+def test_registration_after_a_switch_uses_the_new_version(server, encoder):
+    first = register(server, "Prima", 1)
+    activate(server, "v2", V2_SETTINGS)
+    # Il server non ha ancora fatto il controllo periodico della versione
+    server.gallery.version_checked_at = server.time.time()
+
+    second = register(server, "Dopo", 2)
+
+    assert [settings for _, settings in encoder.calls] == [
+        server.DEFAULT_ENCODING_SETTINGS,
+        V2_SETTINGS,
+    ]
+    assert os.path.exists(os.path.join(server.encodings_folder(""), f"{first}.npy"))
+    assert os.listdir(server.encodings_folder("v2")) == [f"{second}.npy"]
+    assert server.gallery.encoding_tag == "v2"
+    assert second in server.gallery.ids
+
+
+def test_switch_during_encoding_re_encodes_with_the_new_version(
+    server, encoder, monkeypatch
+):
+    server.gallery.ensure_loaded()
+    encode = encoder.load_face_with_location
+
+    def switching_encoder(image_path, max_dimension=None, deadline=None, settings=None):
+        result = encode(image_path, settings=settings)
+        if len(encoder.calls) == 1:
+            activate(server, "v2", V2_SETTINGS)
+        return result
+
+    monkeypatch.setattr(server, "load_face_with_location", switching_encoder)
+
+    patient_id = register(server, "Durante", 3)
+
+    assert [settings for _, settings in encoder.calls] == [
+        server.DEFAULT_ENCODING_SETTINGS,
+        V2_SETTINGS,
+    ]
+    assert os.listdir(server.encodings_folder("v2")) == [f"{patient_id}.npy"]
+    assert not os.path.exists(
+        os.path.join(server.encodings_folder(""), f"{patient_id}.npy")
+    )
@@ -0,0 +1,114 @@
+"""Delta della gallery per i gateway: paginazione e ordine dei reset"""
+
+import os
+import sqlite3
+
+import numpy as np
+
+from conftest import random_encoding
+
+
+def change_ops(changes):
+    return [(patient_id, op) for patient_id, op, _ in changes]
+
+
+def test_pages_cover_every_patient_once(server, add_patient):
+    for index in range(5):
+        add_patient(f"p{index}", random_encoding(index))
+
+    seen, since, pages = [], 0, 0
+    while True:
+        changes, _, current_seq, more = server.gallery_changes_since(since, 2)
+        seen += [patient_id for patient_id, _, _ in changes]
+        since = changes[-1][2]
+        pages += 1
+        if not more:
+            break
+
+    assert seen == [f"p{index}" for index in range(5)]
+    assert pages == 3
+    assert since == current_seq
+
+
+def test_last_change_of_a_patient_wins(server, add_patient):
+    add_patient("p0", random_encoding(0))
+    add_patient("p1", random_encoding(1))
+    server.delete_patient("p1")
+    server.update_partitions("p0", add=["ospedale-a/cardio"])
+
+    changes, memberships, _, more = server.gallery_changes_since(0, 10)
+
+    # p0 è cambiato dopo p1: l'ordine segue l'ultima modifica
+    assert change_ops(changes) == [("p1", "remove"), ("p0", "add")]
+    assert memberships == {"p0": ["ospedale-a/cardio"]}
+    assert not more
+
+
+def test_since_skips_changes_already_applied(server, add_patient):
+    add_patient("p0", random_encoding(0))
+    changes, _, _, _ = server.gallery_changes_since(0, 10)
+    add_patient("p1", random_encoding(1))
+
+    later, _, _, _ = server.gallery_changes_since(changes[-1][2], 10)
+
+    assert change_ops(later) == [("p1", "add")]
+
+
+def test_reset_comes_before_the_new_encodings(server, add_patient):
+    add_patient("p0", random_encoding(0))
+    add_patient("p1", random_encoding(1))
+    conn = sqlite3.connect(server.DATABASE)
+    cursor = conn.cursor()
+    server.record_gallery_change(cursor, "*", "reset")
+    for patient_id in ("p0", "p1"):
+        server.record_gallery_change(cursor, patient_id, "add")
+    conn.commit()
+    conn.close()
+
+    changes, _, _, _ = server.gallery_changes_since(0, 10)
+
+    # Una replica che applica in ordine svuota la gallery prima di ripopolarla
+    assert change_ops(changes) == [("*", "reset"), ("p0", "add"), ("p1", "add")]
+
+
+def test_gallery_applies_changes_page_by_page(server, add_patient, monkeypatch):
+    monkeypatch.setattr(server, "GALLERY_SYNC_PAGE_SIZE", 2)
+    add_patient("p0", random_encoding(0))
+    gallery = server.gallery
+    gallery.load()
+    gallery.sync_changes()
+
+    for index in range(1, 6):
+        add_patient(f"p{index}", random_encoding(index), partitions=["reparto"])
+    server.delete_patient("p0")
+    gallery.sync_changes()
+
+    assert sorted(gallery.ids) == [f"p{index}" for index in range(1, 6)]
+    assert gallery.partitions["reparto"] == {f"p{index}" for index in range(1, 6)}
+    assert gallery.incremental_syncs == 3
+    assert gallery.applied_seq == server.gallery_changes_since(0, 1)[2]
+
+
+def test_gallery_reloads_everything_after_a_reset(server, add_patient):
+    add_patient("p0", random_encoding(0))
+    gallery = server.gallery
+    gallery.load()
+    gallery.sync_changes()
+
+    # Un altro processo attiva la versione v2 con gli encoding già ricalcolati
+    os.makedirs(server.encodings_folder("v2"))
+    server.save_face_encoding(random_encoding(10), "p0", tag="v2")
+    conn = sqlite3.connect(server.DATABASE)
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT INTO gallery_meta (key, value) VALUES ('active_encoding_version', 'v2')"
+    )
+    server.record_gallery_change(cursor, "*", "reset")
+    server.record_gallery_change(cursor, "p0", "add")
+    conn.commit()
+    conn.close()
+    gallery.sync_changes()
+
+    assert gallery.encoding_tag == "v2"
+    assert gallery.incremental_syncs == 0
+    assert np.array_equal(gallery.encoding_of("p0"), random_encoding(10))
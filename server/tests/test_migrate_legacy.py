@@ -0,0 +1,64 @@
+"""Migrazione da server.py con database legacy completi o parziali"""
+
+import os
+import sqlite3
+import sys
+
+import numpy as np
+
+import migrate_legacy
+from conftest import random_encoding
+
+
+def legacy_install(with_patients=True):
+    """Cartella di server.py con il log e, se richiesto, la tabella pazienti"""
+    os.makedirs(os.path.join("legacy", migrate_legacy.LEGACY_ENCODINGS))
+    legacy = sqlite3.connect(os.path.join("legacy", migrate_legacy.LEGACY_DATABASE))
+    legacy.execute(
+        "CREATE TABLE log_accessi (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "timestamp TEXT, id_paziente TEXT, file_img TEXT)"
+    )
+    legacy.executemany(
+        "INSERT INTO log_accessi (timestamp, id_paziente, file_img) VALUES (?, ?, ?)",
+        [
+            ("2024-05-01T10:00:00", "p0", "a.jpg"),
+            ("2024-05-01T10:01:00", "sconosciuto", "b.jpg"),
+        ],
+    )
+    if with_patients:
+        legacy.execute(
+            "CREATE TABLE pazienti (id TEXT PRIMARY KEY, nome TEXT, gruppo TEXT, "
+            "allergie TEXT, path_foto TEXT)"
+        )
+        legacy.execute("INSERT INTO pazienti VALUES ('p0', 'Mario', 'A+', '', NULL)")
+        np.save(
+            os.path.join("legacy", migrate_legacy.LEGACY_ENCODINGS, "p0.npy"),
+            random_encoding(0),
+        )
+    legacy.commit()
+    legacy.close()
+
+
+def run_migration(server, monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["migrate_legacy.py", "legacy"])
+    migrate_legacy.main()
+    conn = sqlite3.connect(server.DATABASE)
+    patients = conn.execute("SELECT COUNT(*) FROM patients").fetchone()[0]
+    log_rows = conn.execute("SELECT COUNT(*) FROM recognition_log").fetchone()[0]
+    conn.close()
+    return patients, log_rows
+
+
+def test_full_install_is_migrated(server, monkeypatch):
+    legacy_install()
+
+    assert run_migration(server, monkeypatch) == (1, 2)
+    # Ripetere non duplica nulla
+    assert run_migration(server, monkeypatch) == (1, 2)
+
+
+def test_install_without_patients_table_migrates_the_log(server, monkeypatch, capsys):
+    legacy_install(with_patients=False)
+
+    assert run_migration(server, monkeypatch) == (0, 2)
+    assert "Tabella pazienti assente" in capsys.readouterr().out
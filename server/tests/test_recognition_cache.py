@@ -0,0 +1,167 @@
+"""Cache dei risultati di /recognize: scadenza, limite di voci e hash percettivo"""
+
+import io
+
+import numpy as np
+from PIL import Image
+
+from conftest import random_encoding
+
+
+def jpeg_bytes(pixels, quality=90):
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def gradient_image():
+    x = np.linspace(0, 255, 128)
+    pixels = np.add.outer(x, x) / 2 + 40 * np.sin(np.add.outer(x, -x) / 30)
+    return np.clip(pixels, 0, 255).astype(np.uint8)
+
+
+def test_oldest_entries_are_evicted_over_the_limit(server):
+    cache = server.RecognitionCache(ttl=60, max_entries=2)
+    for index in range(3):
+        cache.store(f"h{index}", None, random_encoding(index), 0.1)
+
+    assert cache.lookup("h0") is None
+    assert cache.lookup("h1") is not None
+    assert cache.lookup("h2") is not None
+
+
+def test_expired_entries_miss(server):
+    cache = server.RecognitionCache(ttl=30, max_entries=10)
+    old = cache.store("old", None, random_encoding(0), 0.1)
+    cache.store("new", None, random_encoding(1), 0.1)
+    old.created_at -= 31
+
+    assert cache.lookup("old") is None
+    assert cache.lookup("new") is not None
+    assert cache.metrics()["entries"] == 1
+
+
+def test_same_content_is_an_exact_hit(server):
+    cache = server.RecognitionCache(ttl=60, max_entries=10)
+    stored = cache.store("a", None, random_encoding(0), 0.5)
+
+    assert cache.lookup("a") is stored
+    metrics = cache.metrics()
+    assert (metrics["exact_hits"], metrics["misses"]) == (1, 0)
+    assert metrics["cpu_seconds_saved"] == 0.5
+
+
+def test_recompressed_photo_with_the_same_encoding_is_a_perceptual_hit(server):
+    cache = server.RecognitionCache(ttl=60, max_entries=10)
+    pixels = gradient_image()
+    original, resent = jpeg_bytes(pixels, 95), jpeg_bytes(pixels, 70)
+    assert original != resent
+    encoding = random_encoding(0)
+    stored = cache.store("a", server.perceptual_hash(original), encoding, 0.5)
+
+    # Un hash percettivo vicino non basta: serve l'encoding della nuova foto
+    assert cache.lookup("b") is None
+    entry = cache.similar(server.perceptual_hash(resent), encoding + 0.001)
+
+    assert entry is stored
+    assert cache.metrics()["perceptual_hits"] == 1
+
+
+def test_similar_frame_of_a_different_face_is_not_a_hit(server):
+    cache = server.RecognitionCache(ttl=60, max_entries=10)
+    pixels = gradient_image()
+    image_hash = server.perceptual_hash(jpeg_bytes(pixels))
+    cache.store("a", image_hash, random_encoding(0), 0.5)
+
+    assert cache.similar(image_hash, random_encoding(1)) is None
+    assert cache.metrics()["perceptual_hits"] == 0
+
+
+def test_different_photo_is_a_miss(server):
+    cache = server.RecognitionCache(ttl=60, max_entries=10)
+    pixels = gradient_image()
+    encoding = random_encoding(0)
+    cache.store("a", server.perceptual_hash(jpeg_bytes(pixels)), encoding, 0.5)
+
+    flipped = jpeg_bytes(np.ascontiguousarray(pixels[:, ::-1]))
+
+    assert cache.similar(server.perceptual_hash(flipped), encoding) is None
+
+
+def test_undecodable_bytes_have_no_perceptual_hash(server):
+    assert server.perceptual_hash(b"non un'immagine") is None
+
+
+def test_match_is_recomputed_when_the_gallery_changes(server, monkeypatch):
+    calls = []
+
+    def fake_match(encoding, partitions, fallback_global):
+        calls.append(partitions)
+        return ("p0", 0.2)
+
+    monkeypatch.setattr(server, "match_in_partitions", fake_match)
+    cache = server.RecognitionCache(ttl=60, max_entries=10)
+    entry = cache.store("a", None, random_encoding(0), 0.1)
+
+    cache.match(entry)
+    cache.match(entry)
+    server.gallery.version += 1
+    cache.match(entry)
+
+    assert len(calls) == 2
+    assert cache.metrics()["revalidations"] == 1
+
+
+def test_photo_without_a_face_is_not_cached(server, monkeypatch):
+    calls = []
+
+    def no_face(image_path, max_dimension=None, deadline=None, settings=None):
+        calls.append(image_path)
+        return None, "Nessun volto rilevato nell'immagine"
+
+    monkeypatch.setattr(server, "load_and_process_image", no_face)
+    client = server.app.test_client()
+    photo = jpeg_bytes(gradient_image())
+
+    for _ in range(2):
+        response = client.post(
+            "/recognize",
+            data={"foto": (io.BytesIO(photo), "foto.jpg")},
+            content_type="multipart/form-data",
+        )
+        assert response.status_code == 400
+
+    assert len(calls) == 2
+    assert server.result_cache.metrics()["entries"] == 0
+
+
+def test_kiosk_frames_of_two_patients_are_not_confused(
+    server, add_patient, monkeypatch
+):
+    add_patient("paziente-a", random_encoding(0))
+    add_patient("paziente-b", random_encoding(1))
+    server.gallery.load()
+    # Stessa inquadratura, volti diversi: hash percettivo uguale, contenuto no
+    pixels = gradient_image()
+    first, second = jpeg_bytes(pixels, 95), jpeg_bytes(pixels, 90)
+    distance = server.perceptual_hash(first) ^ server.perceptual_hash(second)
+    assert bin(distance).count("1") <= server.PHASH_MAX_DISTANCE
+    encodings = {first: random_encoding(0), second: random_encoding(1)}
+
+    def encode(image_path, max_dimension=None, deadline=None, settings=None):
+        with open(image_path, "rb") as photo_file:
+            return encodings[photo_file.read()], None
+
+    monkeypatch.setattr(server, "load_and_process_image", encode)
+    client = server.app.test_client()
+
+    identities = []
+    for photo in (first, second):
+        response = client.post(
+            "/recognize",
+            data={"foto": (io.BytesIO(photo), "foto.jpg")},
+            content_type="multipart/form-data",
+        )
+        identities.append(response.get_json()["id"])
+
+    assert identities == ["paziente-a", "paziente-b"]
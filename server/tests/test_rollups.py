@@ -0,0 +1,118 @@
+"""Aggregati orari e giornalieri dei riconoscimenti"""
+
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+import backfill_rollups
+
+LOG = [
+    ("p0", "2024-05-01T13:05:00", 0.9, True),
+    ("p1", "2024-05-01T13:59:59.999999", 0.7, True),
+    (None, "2024-05-01T14:00:00", 0.0, False),
+    ("p0", "2024-05-02T00:10:00", 0.8, True),
+    # Righe vecchie scritte con uno spazio al posto della "T"
+    ("p2", "2024-05-01 14:30:00", 0.6, True),
+]
+
+
+def write_log(server, rows):
+    conn = sqlite3.connect(server.DATABASE)
+    cursor = conn.cursor()
+    for patient_id, recognition_time, confidence, success in rows:
+        server.insert_recognition_row(
+            cursor, patient_id, recognition_time, confidence, None, success
+        )
+    conn.commit()
+    conn.close()
+
+
+def read_rollups(server):
+    conn = sqlite3.connect(server.DATABASE)
+    rows = conn.execute(
+        """
+        SELECT granularity, bucket, recognitions, successes,
+               confidence_sum, confidence_count
+        FROM recognition_rollups ORDER BY granularity, bucket
+    """
+    ).fetchall()
+    conn.close()
+    return [row[:4] + (round(row[4], 6), row[5]) for row in rows]
+
+
+@pytest.mark.parametrize(
+    "granularity, recognition_time, bucket",
+    [
+        ("hour", "2024-05-01T13:05:00", "2024-05-01T13:00:00"),
+        ("hour", "2024-05-01T13:59:59.999999", "2024-05-01T13:00:00"),
+        ("hour", "2024-05-01 14:30:00", "2024-05-01T14:00:00"),
+        ("day", "2024-05-01T23:59:59", "2024-05-01"),
+        ("day", "2024-05-02T00:00:00", "2024-05-02"),
+    ],
+)
+def test_rollup_bucket(server, granularity, recognition_time, bucket):
+    assert server.rollup_bucket(granularity, recognition_time) == bucket
+
+
+def test_sql_buckets_match_python_buckets(server):
+    conn = sqlite3.connect(":memory:")
+    for granularity, bucket_sql in server.ROLLUP_BUCKET_SQL.items():
+        for _, recognition_time, _, _ in LOG:
+            sql_bucket = conn.execute(
+                f"SELECT {bucket_sql} FROM (SELECT ? AS recognition_time)",
+                (recognition_time,),
+            ).fetchone()[0]
+            assert sql_bucket == server.rollup_bucket(granularity, recognition_time)
+    conn.close()
+
+
+def test_rollups_follow_the_log(server):
+    write_log(server, LOG)
+
+    assert read_rollups(server) == [
+        ("day", "2024-05-01", 4, 3, 2.2, 3),
+        ("day", "2024-05-02", 1, 1, 0.8, 1),
+        ("hour", "2024-05-01T13:00:00", 2, 2, 1.6, 2),
+        ("hour", "2024-05-01T14:00:00", 2, 1, 0.6, 1),
+        ("hour", "2024-05-02T00:00:00", 1, 1, 0.8, 1),
+    ]
+
+
+def test_backfill_rebuilds_the_same_rollups(server):
+    write_log(server, LOG)
+    expected = read_rollups(server)
+
+    conn = sqlite3.connect(server.DATABASE, isolation_level=None)
+    conn.execute("DELETE FROM recognition_rollups")
+    # Un bucket sbagliato deve sparire, non sommarsi
+    conn.execute(
+        """
+        INSERT INTO recognition_rollups (granularity, bucket, recognitions,
+                                         successes, confidence_sum, confidence_count)
+        VALUES ('hour', '2024-05-01T13:00:00', 9, 9, 9.0, 9)
+    """
+    )
+    assert backfill_rollups.rebuild_day(conn, "2024-05-01") == 4
+    assert backfill_rollups.rebuild_day(conn, "2024-05-02") == 1
+    conn.close()
+
+    assert read_rollups(server) == expected
+
+
+def test_timeseries_fills_empty_buckets(server):
+    write_log(server, LOG)
+
+    series = server.recognition_timeseries(
+        "hour", datetime(2024, 5, 1, 12), datetime(2024, 5, 1, 15)
+    )
+
+    assert [point["bucket"] for point in series] == [
+        "2024-05-01T12:00:00",
+        "2024-05-01T13:00:00",
+        "2024-05-01T14:00:00",
+    ]
+    assert [point["recognitions"] for point in series] == [0, 2, 2]
+    assert series[0]["success_rate"] is None
+    assert series[1]["mean_confidence"] == 0.8
+    assert series[2]["success_rate"] == 50.0
@@ -0,0 +1,48 @@
+"""Richieste che arrivano prima della fine dell'avvio"""
+
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def starting(server, monkeypatch):
+    """Server con l'avvio ancora in corso (nessun thread reale in background)"""
+    state = server.StartupState(server.STARTUP_PHASES, 0.0)
+    state.thread = threading.current_thread()
+    monkeypatch.setattr(server, "startup", state)
+    return state
+
+
+def test_requests_before_readiness_get_503(server, starting):
+    client = server.app.test_client()
+
+    response = client.post("/register", data={"nome": "Mario"})
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(server.STARTUP_RETRY_AFTER_SECONDS)
+    assert client.get("/").status_code == 200
+    assert client.get("/ready").status_code == 503
+
+
+def test_requests_pass_once_ready(server, starting):
+    client = server.app.test_client()
+    starting.run_all([("database", server.init_database)])
+
+    assert client.get("/ready").status_code == 200
+    # Nessuna foto: la richiesta arriva all'endpoint
+    assert client.post("/register", data={"nome": "Mario"}).status_code == 400
+
+
+def test_first_request_starts_the_startup_once(server, monkeypatch):
+    state = server.StartupState(server.STARTUP_PHASES, 0.0)
+    monkeypatch.setattr(server, "startup", state)
+    runs = []
+    monkeypatch.setattr(server, "run_startup", lambda: runs.append(1))
+    client = server.app.test_client()
+
+    client.get("/")
+    client.get("/ready")
+    state.thread.join(timeout=2)
+
+    assert runs == [1]
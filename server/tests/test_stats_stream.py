@@ -0,0 +1,74 @@
+"""Eventi di /stats/stream per i riconoscimenti online e offline"""
+
+import json
+import time
+
+import pytest
+
+
+@pytest.fixture
+def stream(server, monkeypatch):
+    """Broadcaster nuovo con un client iscritto (senza thread di pubblicazione)"""
+    broadcaster = server.StatsBroadcaster(
+        server.STATS_STREAM_INTERVAL_SECONDS,
+        server.STATS_STREAM_REFRESH_SECONDS,
+        server.STATS_STREAM_QUEUE_SIZE,
+        server.STATS_STREAM_MAX_SUBSCRIBERS,
+    )
+    broadcaster.thread = object()
+    broadcaster.subscribe()
+    monkeypatch.setattr(server, "stats_stream", broadcaster)
+    return broadcaster
+
+
+def send_access_log(server, monkeypatch, entries):
+    monkeypatch.setattr(server, "GATEWAY_KEYS", {"gw1": "segreto"})
+    body = json.dumps({"entries": entries}).encode("utf-8")
+    timestamp = int(time.time())
+    signature = server.gateway_signature(
+        "segreto", "POST", "/gallery/access-log", "", timestamp, body
+    )
+    return server.app.test_client().post(
+        "/gallery/access-log",
+        data=body,
+        content_type="application/json",
+        headers={
+            "X-Gateway-Id": "gw1",
+            "X-Timestamp": str(timestamp),
+            "X-Signature": signature,
+        },
+    )
+
+
+def test_offline_gateway_entries_reach_the_stream(server, stream, monkeypatch):
+    entries = [
+        {
+            "entry_id": "e1",
+            "recognized_at": "2026-10-18T08:00:00",
+            "patient_id": "p1",
+            "success": True,
+            "confidence": 0.9,
+        },
+        {"entry_id": "e2", "recognized_at": "2026-10-18T08:05:00", "success": False},
+        {"entry_id": "e3", "recognized_at": "non una data"},
+    ]
+
+    response = send_access_log(server, monkeypatch, entries)
+
+    assert response.status_code == 200
+    assert response.get_json()["accepted"] == 2
+    assert stream.pending_events == [
+        {"time": "2026-10-18T08:00:00", "confidence": 0.9, "success": True},
+        {"time": "2026-10-18T08:05:00", "confidence": 0, "success": False},
+    ]
+
+
+def test_duplicate_offline_entries_are_not_published_twice(server, stream, monkeypatch):
+    entries = [{"entry_id": "e1", "recognized_at": "2026-10-18T08:00:00"}]
+    send_access_log(server, monkeypatch, entries)
+    stream.pending_events.clear()
+
+    response = send_access_log(server, monkeypatch, entries)
+
+    assert response.get_json()["duplicates"] == 1
+    assert stream.pending_events == []